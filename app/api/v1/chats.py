@@ -1,10 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query, UploadFile, File
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 
 from app.db import database, models, schemas
 from app.api.deps import get_current_active_user
-from app.services import chat_service
+from app.services import chat_service, message_service
 
 router = APIRouter(
     prefix="/v1/chats",
@@ -13,7 +13,11 @@ router = APIRouter(
 )
 
 # --- ХЕЛПЕР ДЛЯ ДИНАМИЧЕСКОГО ИМЕНИ И АВАТАРКИ ---
-def _format_chat_response(chat: models.Chat, current_user_id: int) -> schemas.Chat:
+def _format_chat_response(
+    chat: models.Chat, current_user_id: int,
+    last_message: Optional[models.Message] = None, unread_count: int = 0,
+    is_blocked: bool = False
+) -> schemas.Chat:
     """
     Формирует ответ для фронтенда:
     - Private: Имя = Имя собеседника, Аватар = Аватар собеседника.
@@ -41,7 +45,10 @@ def _format_chat_response(chat: models.Chat, current_user_id: int) -> schemas.Ch
         chat_name=display_name,   # Итоговое имя
         avatar_url=display_avatar, # Итоговая аватарка
         owner_id=chat.owner_id,
-        participants=[schemas.UserPublic.from_orm(p) for p in participants]
+        participants=[schemas.UserPublic.from_orm(p) for p in participants],
+        last_message=schemas.Message.model_validate(last_message) if last_message else None,
+        unread_count=unread_count,
+        is_blocked=is_blocked
     )
 
 
@@ -70,12 +77,27 @@ def create_group_chat(
 # 3. ПОЛУЧИТЬ СПИСОК (С правильными именами)
 @router.get("/", response_model=List[schemas.Chat])
 def get_my_chats(
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = 0,
     current_user: models.User = Depends(get_current_active_user),
     db: Session = Depends(database.get_db)
 ):
-    chats = chat_service.get_user_chats(db, user_id=current_user.id)
+    """Чаты от самых свежих к старым, с последним сообщением и числом непрочитанных."""
+    chats = chat_service.get_user_chats(db, user_id=current_user.id, limit=limit, offset=offset)
     # Применяем форматирование ко всем чатам
-    return [_format_chat_response(chat, current_user.id) for chat in chats]
+    return [
+        _format_chat_response(chat, current_user.id, last_message, unread_count, is_blocked)
+        for chat, last_message, unread_count, is_blocked in chats
+    ]
+
+
+# 3.1 СУММА НЕПРОЧИТАННЫХ (для бейджа)
+@router.get("/unread-count")
+def get_unread_count(
+    current_user: models.User = Depends(get_current_active_user),
+    db: Session = Depends(database.get_db)
+):
+    return {"unread_count": message_service.get_total_unread(db, current_user.id)}
 
 
 # 4. ЗАГРУЗИТЬ АВАТАРКУ ГРУППЫ
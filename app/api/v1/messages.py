@@ -1,14 +1,18 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, Query, UploadFile, File, HTTPException
 from sqlalchemy.orm import Session
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 from pydantic import ValidationError
+import asyncio
 import uuid
 import os
 import shutil
 
 from app.db import database, schemas, models
-from app.services import message_service, user_service, notification_service
+from app.services import message_service, user_service
 from app.services.connection_manager import manager
+from app.services.notification_service import push_coalescer
+from app.services.read_receipts import read_debouncer
+from app.services.message_writer import message_writer
 from app.core import security
 from app.api.deps import get_current_active_user
 
@@ -18,7 +22,7 @@ router = APIRouter(
 )
 
 # --- Хелпер для авторизации в WebSocket ---
-def get_user_from_token(token: str, db: Session):
+def get_user_from_token(token: str):
     """Проверяет токен из URL и возвращает user_id."""
     try:
         payload = security.verify_and_decode_token(token)
@@ -32,12 +36,21 @@ def get_user_from_token(token: str, db: Session):
 @router.get("/history/{chat_id}", response_model=List[schemas.Message])
 def get_chat_history(
     chat_id: int,
-    limit: int = 50,
+    limit: int = Query(50, ge=1, le=200),
     offset: int = 0,
+    before_id: Optional[int] = None, # курсор: сообщения старше этого id
+    after_id: Optional[int] = None,  # курсор: сообщения новее этого id
     current_user: models.User = Depends(get_current_active_user),
     db: Session = Depends(database.get_db)
 ):
-    return message_service.get_chat_history(db, chat_id, current_user.id, limit, offset)
+    """
+    История сообщений (от новых к старым).
+    Для прокрутки вверх передавайте before_id = id самого старого загруженного
+    сообщения, для догрузки новых - after_id = id самого нового.
+    """
+    return message_service.get_chat_history(
+        db, chat_id, current_user.id, limit, offset, before_id=before_id, after_id=after_id
+    )
 
 
 # 🔵 HTTP Эндпоинт: Детали прочтения
@@ -80,21 +93,125 @@ def upload_message_attachment(
     return {"url": f"/static/{file_name}", "filename": file.filename}
 
 
+# --- Работа с БД для WebSocket-событий ---
+# Эти функции синхронные и выполняются в пуле потоков БД (database.run_in_session),
+# чтобы запросы к MySQL не блокировали event loop для остальных сокетов.
+
+def _get_push_body(message: models.Message) -> str:
+    """Текст пуша зависит от типа сообщения."""
+    push_body = "Новое сообщение"
+    if message.message_type == models.MessageTypeEnum.text:
+        try:
+            push_body = message.content.decode('utf-8')
+        except:
+            push_body = "Текст"
+    elif message.message_type == models.MessageTypeEnum.image:
+        push_body = "📷 Изображение"
+    elif message.message_type == models.MessageTypeEnum.file:
+        push_body = "📁 Файл"
+    elif message.message_type == models.MessageTypeEnum.audio:
+        push_body = "🎤 Голосовое сообщение"
+    return push_body
+
+
+def _message_event(new_msg: models.Message) -> dict:
+    """Событие new_message для WebSocket."""
+    return {
+        "type": "new_message",
+        "id": new_msg.id,
+        "chat_id": new_msg.chat_id,
+        "sender_id": new_msg.sender_id,
+        "content": new_msg.content.decode('utf-8') if isinstance(new_msg.content, bytes) else new_msg.content,
+        "message_type": new_msg.message_type, # Возвращаем тип
+        "sent_at": new_msg.sent_at.isoformat(),
+        "status": "sent"
+    }
+
+
+def _prepare_new_message(db: Session, user_id: int, msg_create: schemas.MessageCreate):
+    # Проверка прав (здесь же внутри проверяется ЧС) и значения для INSERT
+    values = message_service.prepare_message(db, user_id, msg_create)
+    participant_ids = message_service.get_chat_participants(db, chat_id=msg_create.chat_id)
+
+    # Получаем инфо об отправителе для Пуша
+    sender = db.query(models.User).filter(models.User.id == user_id).first()
+    sender_name = f"{sender.first_name} {sender.last_name or ''}".strip()
+
+    return values, participant_ids, sender_name
+
+
+async def _persist_message(values: dict):
+    """Сохраняет сообщение: пачкой через message_writer, если он включен, иначе сразу."""
+    if message_writer.enabled:
+        await message_writer.write(values)
+    else:
+        await database.run_in_session(message_service.insert_messages, [values])
+
+
+def _handle_edit(db: Session, user_id: int, msg_id: int, new_text: bytes):
+    updated_msg = message_service.update_message(db, msg_id, user_id, new_text)
+    if not updated_msg:
+        return None, []
+
+    edit_notify = {
+        "type": "message_edited",
+        "chat_id": updated_msg.chat_id,
+        "message_id": updated_msg.id,
+        "new_content": updated_msg.content.decode('utf-8')
+    }
+    parts = message_service.get_chat_participants(db, chat_id=updated_msg.chat_id)
+    return edit_notify, parts
+
+
+def _handle_delete(db: Session, user_id: int, msg_id: int):
+    msg_obj = db.query(models.Message).filter(models.Message.id == msg_id).first()
+    if not msg_obj or msg_obj.sender_id != user_id:
+        return None, []
+
+    target_chat_id = msg_obj.chat_id
+    success = message_service.delete_message(db, msg_id, user_id)
+    if not success:
+        return None, []
+
+    delete_notify = {
+        "type": "message_deleted",
+        "chat_id": target_chat_id,
+        "message_id": msg_id
+    }
+    parts = message_service.get_chat_participants(db, chat_id=target_chat_id)
+    return delete_notify, parts
+
+
+def _handle_pin(db: Session, user_id: int, msg_id: int, is_pinned: bool):
+    success = message_service.pin_message(db, msg_id, user_id, is_pinned)
+    if not success:
+        return None, []
+
+    msg_obj = db.query(models.Message).filter(models.Message.id == msg_id).first()
+    pin_notify = {
+        "type": "message_pinned",
+        "chat_id": msg_obj.chat_id,
+        "message_id": msg_id,
+        "is_pinned": is_pinned
+    }
+    parts = message_service.get_chat_participants(db, msg_obj.chat_id)
+    return pin_notify, parts
+
+
 # 🟢 WebSocket Эндпоинт (Живое общение)
 @router.websocket("/ws")
 async def websocket_endpoint(
     websocket: WebSocket,
-    token: str = Query(...), 
-    db: Session = Depends(database.get_db)
+    token: str = Query(...)
 ):
     # 1. Проверка авторизации
-    user_id = get_user_from_token(token, db)
+    user_id = get_user_from_token(token)
     if user_id is None:
         await websocket.close(code=1008)
         return
 
-    # 2. Подключаем пользователя
-    await manager.connect(websocket, user_id)
+    # 2. Подключаем устройство пользователя
+    connection = await manager.connect(websocket, user_id)
     
     try:
         while True:
@@ -103,6 +220,8 @@ async def websocket_endpoint(
             event_type = data.get("type")
             
             # --- РОУТИНГ СОБЫТИЙ ---
+            # Каждое обращение к БД - отдельная короткая сессия в пуле потоков,
+            # поэтому открытые сокеты не держат соединения и не блокируют loop.
             
             # === 1. НОВОЕ СООБЩЕНИЕ ===
             if event_type in (None, "new_message"):
@@ -120,64 +239,42 @@ async def websocket_endpoint(
                         content=raw_content,
                         message_type=msg_type_str
                     )
-                    
-                    # Сохраняем в БД (здесь же внутри проверяется ЧС)
-                    new_msg = message_service.create_message(
-                        db=db, 
-                        sender_id=user_id, 
-                        msg_data=msg_create
-                    )
 
-                    # Формируем ответ для WebSocket
-                    response_data = {
-                        "type": "new_message",
-                        "id": new_msg.id,
-                        "chat_id": new_msg.chat_id,
-                        "sender_id": user_id,
-                        "content": new_msg.content.decode('utf-8') if isinstance(new_msg.content, bytes) else new_msg.content,
-                        "message_type": new_msg.message_type, # Возвращаем тип
-                        "sent_at": new_msg.sent_at.isoformat(),
-                        "status": "sent"
-                    }
-
-                    participant_ids = message_service.get_chat_participants(db, chat_id=new_msg.chat_id)
-                    
-                    # Получаем инфо об отправителе для Пуша
-                    sender = db.query(models.User).filter(models.User.id == user_id).first()
-                    sender_name = f"{sender.first_name} {sender.last_name or ''}".strip()
-
-                    # Рассылка (WS + Push)
-                    for pid in participant_ids:
-                        # 1. WebSocket (мгновенно)
-                        await manager.send_personal_message(response_data, pid)
-                        
-                        # 2. Push-уведомление (если это не мы сами)
-                        if pid != user_id:
-                            # Текст пуша зависит от типа
-                            push_body = "Новое сообщение"
-                            if new_msg.message_type == models.MessageTypeEnum.text:
-                                try:
-                                    push_body = new_msg.content.decode('utf-8')
-                                except:
-                                    push_body = "Текст"
-                            elif new_msg.message_type == models.MessageTypeEnum.image:
-                                push_body = "📷 Изображение"
-                            elif new_msg.message_type == models.MessageTypeEnum.file:
-                                push_body = "📁 Файл"
-                            elif new_msg.message_type == models.MessageTypeEnum.audio:
-                                push_body = "🎤 Голосовое сообщение"
-
-                            # Отправляем пуш (Fire-and-forget)
-                            notification_service.send_push_to_user(
-                                db, pid, 
-                                title=sender_name, 
-                                body=push_body,
-                                data={"chat_id": str(new_msg.chat_id)}
-                            )
+                    values, participant_ids, sender_name = await database.run_in_session(
+                        _prepare_new_message, user_id, msg_create
+                    )
+                    new_msg = models.Message(**values)
+                    response_data = _message_event(new_msg)
+
+                    # 1. id и время уже назначены (Snowflake), поэтому запись в БД
+                    # идет параллельно с раскладкой по очередям участников
+                    persist = asyncio.create_task(_persist_message(values))
+                    delivered_ids = await manager.broadcast(response_data, participant_ids)
+                    try:
+                        await persist
+                    except Exception:
+                        # Не сохранилось: отзываем уже разосланное сообщение
+                        await manager.broadcast({
+                            "type": "message_deleted",
+                            "chat_id": new_msg.chat_id,
+                            "message_id": new_msg.id
+                        }, participant_ids)
+                        raise
+
+                    # 2. Push-уведомления (всем, кроме нас самих): онлайн-получатели
+                    # пуш не получают, офлайн - со склейкой; отправка идет в фоне
+                    push_coalescer.on_new_message(
+                        chat_id=response_data["chat_id"],
+                        message_id=response_data["id"],
+                        sender_name=sender_name,
+                        body=_get_push_body(new_msg),
+                        recipient_ids=[pid for pid in participant_ids if pid != user_id],
+                        delivered_ids=delivered_ids
+                    )
                         
                 except Exception as e:
                     # Если ошибка (например, ЧС), отправляем её только отправителю
-                    await websocket.send_json({"error": f"Message error: {str(e)}"})
+                    connection.enqueue({"error": f"Message error: {str(e)}"})
 
 
             # === 2. ПРОЧИТАНО (READ) ===
@@ -186,17 +283,12 @@ async def websocket_endpoint(
                 msg_id = data.get("message_id")
                 
                 if chat_id and msg_id:
-                    message_service.mark_messages_as_read(db, chat_id, user_id, msg_id)
-                    read_notification = {
-                        "type": "message_read",
-                        "chat_id": chat_id,
-                        "user_id": user_id,
-                        "last_read_id": msg_id
-                    }
-                    parts = message_service.get_chat_participants(db, chat_id=chat_id)
-                    for pid in parts:
-                        if pid != user_id:
-                            await manager.send_personal_message(read_notification, pid)
+                    # Склеиваем прочтения при прокрутке: в БД и участникам уйдет
+                    # только максимальный message_id за окно READ_DEBOUNCE_WINDOW
+                    try:
+                        read_debouncer.submit(user_id, int(chat_id), int(msg_id))
+                    except (TypeError, ValueError):
+                        connection.enqueue({"error": "Read error: 'chat_id' and 'message_id' must be integers"})
 
 
             # === 3. РЕДАКТИРОВАНИЕ (EDIT) ===
@@ -211,23 +303,15 @@ async def websocket_endpoint(
                     if isinstance(msg_id, float): msg_id = int(msg_id)
                     if isinstance(new_text, str): new_text = new_text.encode('utf-8')
 
-                    updated_msg = message_service.update_message(db, msg_id, user_id, new_text)
+                    edit_notify, parts = await database.run_in_session(_handle_edit, user_id, msg_id, new_text)
                     
-                    if updated_msg:
-                        edit_notify = {
-                            "type": "message_edited",
-                            "chat_id": updated_msg.chat_id,
-                            "message_id": updated_msg.id,
-                            "new_content": updated_msg.content.decode('utf-8')
-                        }
-                        parts = message_service.get_chat_participants(db, chat_id=updated_msg.chat_id)
-                        for pid in parts:
-                            await manager.send_personal_message(edit_notify, pid)
+                    if edit_notify:
+                        await manager.broadcast(edit_notify, parts)
                     else:
-                        await websocket.send_json({"error": "Edit failed: Not found or forbidden"})
+                        connection.enqueue({"error": "Edit failed: Not found or forbidden"})
                 
                 except Exception as e:
-                    await websocket.send_json({"error": f"Edit error: {str(e)}"})
+                    connection.enqueue({"error": f"Edit error: {str(e)}"})
 
 
             # === 4. УДАЛЕНИЕ (DELETE) ===
@@ -239,26 +323,15 @@ async def websocket_endpoint(
                         
                     if isinstance(msg_id, float): msg_id = int(msg_id)
 
-                    msg_obj = db.query(models.Message).filter(models.Message.id == msg_id).first()
+                    delete_notify, parts = await database.run_in_session(_handle_delete, user_id, msg_id)
 
-                    if msg_obj and msg_obj.sender_id == user_id:
-                        target_chat_id = msg_obj.chat_id
-                        success = message_service.delete_message(db, msg_id, user_id)
-                        
-                        if success:
-                            delete_notify = {
-                                "type": "message_deleted",
-                                "chat_id": target_chat_id,
-                                "message_id": msg_id
-                            }
-                            parts = message_service.get_chat_participants(db, chat_id=target_chat_id)
-                            for pid in parts:
-                                await manager.send_personal_message(delete_notify, pid)
+                    if delete_notify:
+                        await manager.broadcast(delete_notify, parts)
                     else:
-                         await websocket.send_json({"error": "Delete failed: Not found or forbidden"})
+                         connection.enqueue({"error": "Delete failed: Not found or forbidden"})
 
                 except Exception as e:
-                    await websocket.send_json({"error": f"Delete error: {str(e)}"})
+                    connection.enqueue({"error": f"Delete error: {str(e)}"})
 
             # === 5. ЗАКРЕПЛЕНИЕ (PIN) ===
             elif event_type == "pin":
@@ -271,34 +344,38 @@ async def websocket_endpoint(
                          
                     if isinstance(msg_id, float): msg_id = int(msg_id)
 
-                    success = message_service.pin_message(db, msg_id, user_id, is_pinned)
+                    pin_notify, parts = await database.run_in_session(_handle_pin, user_id, msg_id, is_pinned)
                     
-                    if success:
-                        msg_obj = db.query(models.Message).filter(models.Message.id == msg_id).first()
-                        pin_notify = {
-                            "type": "message_pinned",
-                            "chat_id": msg_obj.chat_id,
-                            "message_id": msg_id,
-                            "is_pinned": is_pinned
-                        }
-                        parts = message_service.get_chat_participants(db, msg_obj.chat_id)
-                        for pid in parts:
-                            await manager.send_personal_message(pin_notify, pid)
+                    if pin_notify:
+                        await manager.broadcast(pin_notify, parts)
                     else:
-                        await websocket.send_json({"error": "Pin failed"})
+                        connection.enqueue({"error": "Pin failed"})
                         
                 except Exception as e:
-                    await websocket.send_json({"error": f"Pin error: {str(e)}"})
+                    connection.enqueue({"error": f"Pin error: {str(e)}"})
+
+            # === 6. ПОДТВЕРЖДЕНИЕ ДОСТАВКИ (ACK) ===
+            elif event_type == "ack":
+                msg_id = data.get("message_id")
+                if msg_id:
+                    try:
+                        msg_id = int(msg_id)
+                    except (TypeError, ValueError):
+                        connection.enqueue({"error": "Ack error: 'message_id' must be an integer"})
+                    else:
+                        await push_coalescer.ack(user_id, msg_id)
 
-            # === 6. НЕИЗВЕСТНЫЙ ТИП ===
+            # === 7. НЕИЗВЕСТНЫЙ ТИП ===
             else:
-                await websocket.send_json({"error": f"Unknown event type: {event_type}"})
+                connection.enqueue({"error": f"Unknown event type: {event_type}"})
 
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
-        user_service.update_last_seen(db, user_id)
+        manager.disconnect(connection)
+        await read_debouncer.flush_user(user_id)
+        await database.run_in_session(user_service.update_last_seen, user_id)
         
     except Exception as e:
         print(f"WebSocket Error: {e}")
-        manager.disconnect(user_id)
-        user_service.update_last_seen(db, user_id)
\ No newline at end of file
+        manager.disconnect(connection)
+        await read_debouncer.flush_user(user_id)
+        await database.run_in_session(user_service.update_last_seen, user_id)
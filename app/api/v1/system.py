@@ -0,0 +1,46 @@
+from fastapi import APIRouter, Depends
+from typing import Any, Dict
+
+from app.api.deps import get_current_active_user
+from app.db import database
+from app.core.bloom_filter import bloom_service
+from app.core.loop_monitor import loop_monitor
+from app.services.connection_manager import manager
+from app.services.chat_cache import chat_cache
+from app.services.block_index import block_index
+from app.services.user_search import user_search
+from app.services.username_index import username_index
+from app.services.read_receipts import read_debouncer
+from app.services.message_writer import message_writer
+from app.services.notification_service import push_dispatcher, push_coalescer
+from app.services.worker_lease import worker_lease
+
+router = APIRouter(
+    prefix="/v1/system",
+    tags=["System"],
+    # Метрики раскрывают внутреннее состояние воркера: только для авторизованных
+    dependencies=[Depends(get_current_active_user)]
+)
+
+
+@router.get("/metrics", response_model=Dict[str, Any])
+def get_metrics():
+    """
+    Внутренние метрики этого воркера:
+    задержка event loop, пул потоков БД, WebSocket-соединения, пуши, кэши и прочтения.
+    """
+    return {
+        "worker_id": manager.worker_id,
+        "snowflake": worker_lease.stats(),
+        "event_loop": loop_monitor.stats(),
+        "db_executor": database.executor_stats(),
+        "connections": manager.stats(),
+        "push": {**push_dispatcher.stats, **push_coalescer.stats},
+        "chat_cache": chat_cache.stats(),
+        "block_index": block_index.stats(),
+        "user_search": user_search.stats(),
+        "username_index": username_index.stats(),
+        "bloom_filter": bloom_service.stats(),
+        "read_receipts": read_debouncer.stats,
+        "message_writer": {"enabled": message_writer.enabled, **message_writer.stats},
+    }
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Query
 from sqlalchemy.orm import Session
 from typing import Dict, List
 
@@ -6,6 +6,7 @@ from app.db import database, models, schemas
 from app.api.deps import get_current_active_user
 from app.services import user_service
 from app.services.connection_manager import manager
+from app.services.username_index import username_index
 from ...core.bloom_filter import bloom_service
 
 router = APIRouter(
@@ -13,6 +14,32 @@ router = APIRouter(
     tags=["Users"]
 )
 
+@router.get("", response_model=List[schemas.UserPublic])
+def read_users_by_ids(
+    ids: str = Query(..., description="id через запятую: 1,2,3"),
+    current_user: models.User = Depends(get_current_active_user),
+    db: Session = Depends(database.get_db)
+):
+    """
+    Несколько пользователей за один запрос (участники группы, отправители).
+    Порядок как в ids, повторы схлопываются, несуществующие пропускаются.
+    """
+    try:
+        user_ids = [int(part) for part in ids.split(",") if part.strip()]
+    except ValueError:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "ids: ожидаются числа через запятую")
+    if len(user_ids) > user_service.USERS_BATCH_MAX:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"Не больше {user_service.USERS_BATCH_MAX} id за запрос")
+
+    users = user_service.get_users_by_ids(db, user_ids)
+    online = manager.online_users(u.id for u in users)
+    result = []
+    for user in users:
+        user_public = schemas.UserPublic.model_validate(user)
+        user_public.is_online = user.id in online
+        result.append(user_public)
+    return result
+
 @router.get("/me", response_model=schemas.UserPublic)
 def read_users_me(
     current_user: models.User = Depends(get_current_active_user)
@@ -72,8 +99,28 @@ def check_username_availability(
     if bloom_service.contains(username):
         if user_service.get_user_by_username(db, username=username) is not None:
             is_available = False
+        bloom_service.note_db_check(taken=not is_available)
     return {"is_available": is_available}
 
+@router.post("/check-usernames", response_model=Dict[str, Dict[str, bool]])
+def check_usernames_availability(
+    request: schemas.UsernamesCheckRequest,
+    db: Session = Depends(database.get_db)
+):
+    """
+    Свободны ли юзернеймы (до 1000 за раз): {"usernames": {имя: свободен}}.
+    Фильтр проверяет всю пачку сразу, в БД одним запросом идут только "возможно занятые".
+    """
+    short = [name for name in request.usernames if len(name) < 3]
+    if short:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, f"Юзернейм слишком короткий: {short[0]}")
+
+    maybe_taken = [name for name, found in zip(request.usernames, bloom_service.contains_many(request.usernames)) if found]
+    taken = user_service.get_taken_usernames(db, maybe_taken)
+    for name in set(maybe_taken):
+        bloom_service.note_db_check(taken=name in taken)
+    return {"usernames": {name: name not in taken for name in request.usernames}}
+
 @router.get("/search", response_model=List[schemas.UserPublic])
 def search_for_users(
     q: str,
@@ -82,7 +129,34 @@ def search_for_users(
 ):
     if len(q) < 3:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, "Запрос слишком короткий")
-    return user_service.search_users(db, query_str=q)
+    return user_service.search_users(db, current_user.id, query_str=q)
+
+@router.post("/contacts/match", response_model=List[schemas.ContactMatch])
+def match_contacts(
+    request: schemas.ContactsMatchRequest,
+    current_user: models.User = Depends(get_current_active_user),
+    db: Session = Depends(database.get_db)
+):
+    """
+    Кто из адресной книги уже в Dialect: один запрос вместо поиска по каждому номеру.
+    Принимает номера и/или их SHA-256, в ответе у каждого найденного есть phone_hash.
+    """
+    matches = user_service.match_contacts(db, current_user.id, request.phone_numbers, request.phone_hashes)
+    result = []
+    for user in matches:
+        contact = schemas.ContactMatch.model_validate(user)
+        contact.is_online = manager.is_user_online(user.id)
+        result.append(contact)
+    return result
+
+@router.get("/autocomplete", response_model=Dict[str, List[str]])
+def autocomplete_username(
+    prefix: str = Query(..., min_length=1, max_length=50),
+    limit: int = Query(10, ge=1, le=50),
+    current_user: models.User = Depends(get_current_active_user)
+):
+    """Подсказки юзернеймов по началу ("@ale" -> alex, alexander, ...), из памяти без запросов к БД."""
+    return {"usernames": username_index.complete(prefix, limit)}
 
 @router.get("/{user_id}", response_model=schemas.UserPublic)
 def read_user_by_id(
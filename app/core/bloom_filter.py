@@ -1,57 +1,262 @@
-from pybloom_live import BloomFilter
-from typing import List
+from contextlib import contextmanager
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from typing import Any, Dict, List, Optional, Union
+import asyncio
+import json
 import os
 import logging
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: только блокировка внутри процесса
+    fcntl = None
+
+from app.core.counting_bloom import ScalableCountingBloomFilter, SharedCountingBloomFilter
+from app.db import models
 
 # Константы для нашего фильтра
 EXPECTED_USERNAMES = 1_000_000
 FALSE_POSITIVE_RATE = 0.001
 FILTER_FILEPATH = "username_filter.bloom"
+# Отметка о содержимом снимка: до какого users.id он заполнен
+META_SUFFIX = ".meta"
+# Файл для flock: запись в фильтр - по одному процессу за раз
+LOCK_SUFFIX = ".lock"
+# Журнал изменений старых версий (больше не ведется, удаляется при пересборке)
+LEGACY_LOG_SUFFIX = ".log"
+# Сколько юзернеймов читать из БД за раз при синхронизации
+SYNC_BATCH_SIZE = 50_000
+# Как часто сбрасывать изменения на диск (msync) и проверять, не подменен ли файл (секунды)
+FLUSH_INTERVAL = 1.0
 
 
 class BloomFilterService:
+    """
+    Фильтр Блума юзернеймов, общий для всех воркеров на машине.
+
+    Фильтр счетный и масштабируемый (см. counting_bloom): освободившийся
+    юзернейм можно удалить через remove(), а при росте сверх емкости
+    добавляется новый уровень, и доля ложных "да" не растет. Фактическую
+    долю видно в stats(): note_db_check() считает, сколько проверок в БД
+    после "возможно" фильтра закончились ничем.
+
+    Счетчики лежат в файле filepath, отображенном в память: все воркеры
+    читают одну копию, и юзернейм, добавленный одним воркером, сразу виден
+    остальным. Чтение без блокировок; запись (add/remove/синхронизация)
+    идет под flock на filepath + ".lock", так что писатель всегда один.
+    Пересборка подменяет файл целиком, и воркеры переоткрывают его
+    (перед каждой записью и раз в FLUSH_INTERVAL). Фильтры разных машин
+    независимы; от расхождений страхуют уникальные индексы БД.
+
+    Регистрация не ждет диска: страницы сбрасывает ОС, а фоновая задача
+    раз в FLUSH_INTERVAL делает msync, если были записи.
+
+    Рядом лежит отметка (filepath + ".meta"): максимальный users.id, по
+    который фильтр заполнен, и число юзернеймов в нем. Ее двигают
+    синхронизация и flush() после регистраций (add с user_id). Она пишется
+    после msync всего фильтра, поэтому даже после сбоя питания в фильтре
+    может не хватать только юзернеймов новее отметки. На старте sync_from_db
+    дочитывает из БД именно их, а полностью перестраивает фильтр, лишь если
+    отметки нет, она не сходится с БД или фильтр разросся на несколько уровней.
+    """
+
     def __init__(self, filepath: str = FILTER_FILEPATH):
         self.filepath = filepath
-        self.filter: BloomFilter
+        self.meta_path = filepath + META_SUFFIX
+        self._meta: Optional[dict] = None  # отметка открытого файла
+        self.filter: Union[SharedCountingBloomFilter, ScalableCountingBloomFilter]
+        self._lock = threading.Lock()  # писатели внутри процесса
+        self._lock_file = open(filepath + LOCK_SUFFIX, 'a+b') if fcntl else None
+        self._dirty = False
+        self._unmarked: List[int] = []  # id добавленных, но еще не учтенных в отметке
+        self._task: Optional[asyncio.Task] = None
+        self.stats_counters = {"flushes": 0, "removed": 0, "db_checks": 0, "false_positives": 0}
+
+        if not self._open():
+            # До sync_from_db фильтр только в памяти
+            self.filter = ScalableCountingBloomFilter(EXPECTED_USERNAMES, FALSE_POSITIVE_RATE)
 
-        # Попытка загрузить фильтр из файла
-        if os.path.exists(self.filepath):
+    def _open(self) -> bool:
+        """Открывает общий файл фильтра и его отметку. False - файла нет или он не читается."""
+        if not os.path.exists(self.filepath):
+            logging.info("Файл фильтра Блума не найден.")
+            return False
+        try:
+            self.filter = SharedCountingBloomFilter(self.filepath)
+        except Exception as e:
+            logging.warning(f"Ошибка загрузки фильтра {self.filepath}: {e}. Он будет пересобран.")
+            return False
+        self._meta = self._load_meta()
+        logging.info(f"Фильтр Блума открыт из {self.filepath}.")
+        return True
+
+    @property
+    def shared(self) -> bool:
+        return isinstance(self.filter, SharedCountingBloomFilter)
+
+    def _load_meta(self) -> Optional[dict]:
+        try:
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+            return {"max_user_id": int(meta["max_user_id"]), "usernames": int(meta["usernames"])}
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Отметка фильтра {self.meta_path} повреждена: {e}")
+            return None
+
+    @contextmanager
+    def _writing(self):
+        """Единственный писатель: блокировка потоков процесса + flock между воркерами."""
+        with self._lock:
+            if self._lock_file is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
             try:
-                with open(self.filepath, 'rb') as f:
-                    self.filter = BloomFilter.fromfile(f)
-                logging.info(f"Фильтр Блума загружен из {self.filepath}.")
-            except Exception as e:
-                logging.warning(f"Ошибка загрузки фильтра {self.filepath}: {e}. Создаем новый.")
-                self._create_new()
-        else:
-            logging.info("Файл фильтра Блума не найден. Создаем новый.")
-            self._create_new()
-
-    def _create_new(self):
-        """Вспомогательный метод для создания пустого фильтра."""
-        # ИСПРАВЛЕНИЕ: Мы создаем экземпляр, а не присваиваем класс
-        self.filter = BloomFilter(
-            capacity=EXPECTED_USERNAMES,
-            error_rate=FALSE_POSITIVE_RATE
-        )
-
-    def _save(self):
-        """Сохраняет состояние фильтра в файл."""
+                if self.shared:
+                    self.filter.refresh()
+                yield
+            finally:
+                if self._lock_file is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _replace_file(self, new_filter: ScalableCountingBloomFilter):
+        """Атомарно подменяет общий файл собранным в памяти фильтром (под _writing)."""
         try:
-            with open(self.filepath, 'wb') as f:
-                self.filter.tofile(f)
+            tmp_path = self.filepath + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                new_filter.tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.filepath)
+            _fsync_dir(self.filepath)
+            self.filter = SharedCountingBloomFilter(self.filepath)
         except Exception as e:
-            logging.error(f"Не удалось сохранить фильтр Блума: {e}")
+            logging.error(f"Не удалось сохранить фильтр Блума: {e}. Он будет только в памяти этого воркера.")
+            self.filter = new_filter
+        if os.path.exists(self.filepath + LEGACY_LOG_SUFFIX):
+            os.remove(self.filepath + LEGACY_LOG_SUFFIX)
+
+    def add(self, item: str, user_id: Optional[int] = None):
+        """
+        Добавляет юзернейм в фильтр; на диск он попадет с ближайшим flush().
+        user_id - id нового пользователя: flush() сдвинет на него отметку,
+        чтобы следующий старт не добавил этот юзернейм второй раз.
+        """
+        if not item:
+            return
+
+        # Без проверки "уже есть": счетчики должны совпадать с числом добавлений,
+        # иначе удаление одного из совпавших ключей сотрет чужие
+        with self._writing():
+            self.filter.add(item.encode('utf-8'))
+            self._dirty = True
+            if user_id is not None and self.shared:
+                self._unmarked.append(user_id)
+        if self._task is None:
+            # Фоновой записи нет (скрипты, тесты): сбрасываем сразу
+            self.flush()
 
-    def add(self, item: str):
-        """Добавляет юзернейм в фильтр и сохраняет на диск."""
+    def add_many(self, items: List[str], user_ids: Optional[List[int]] = None):
+        """add() для пачки юзернеймов (массовый импорт); user_ids - как в add()."""
+        keys = [item.encode('utf-8') for item in items if item]
+        with self._writing():
+            self.filter.add_many(keys)
+            self._dirty = True
+            if user_ids and self.shared:
+                self._unmarked.extend(user_id for item, user_id in zip(items, user_ids) if item)
+        if self._task is None:
+            self.flush()
+
+    def remove(self, item: str):
+        """
+        Удаляет освободившийся юзернейм (после commit в БД).
+        Вызывать только для юзернеймов, которые действительно были заняты.
+        """
         if not item:
             return
+        with self._writing():
+            if not self.filter.remove(item.encode('utf-8')):
+                return
+            self._dirty = True
+            self.stats_counters["removed"] += 1
+        if self._task is None:
+            self.flush()
 
-        item_bytes = item.encode('utf-8')
-        if item_bytes not in self.filter:
-            self.filter.add(item_bytes)
-            self._save()  # Сохраняем при каждом добавлении
+    def note_db_check(self, taken: bool):
+        """Учет проверки в БД после "возможно" фильтра: taken=False - ложное срабатывание."""
+        self.stats_counters["db_checks"] += 1
+        if not taken:
+            self.stats_counters["false_positives"] += 1
+
+    def flush(self):
+        """Сбрасывает изменения этого воркера на диск (msync), если они были."""
+        if not (self._dirty and self.shared):
+            return
+        # Забираем id до msync: их юзернеймы уже в файле и попадут на диск
+        with self._lock:
+            self._dirty = False
+            user_ids, self._unmarked = self._unmarked, []
+        try:
+            self.filter.flush()
+            self.stats_counters["flushes"] += 1
+        except Exception as e:
+            with self._lock:
+                self._dirty = True
+                self._unmarked = user_ids + self._unmarked
+            logging.error(f"Не удалось сбросить фильтр Блума на диск: {e}")
+            return
+        if user_ids:
+            self._advance_mark(user_ids)
+
+    def _advance_mark(self, user_ids: List[int]):
+        """
+        Учитывает в отметке юзернеймы, добавленные после синхронизации.
+
+        Отметку на диске могли сдвинуть другие воркеры, поэтому она
+        перечитывается под flock. Если эти пользователи уже попали в фильтр
+        через синхронизацию другого воркера, число в отметке окажется
+        больше, чем в БД, и следующий старт пересоберет фильтр - дублей
+        в счетчиках не останется.
+        """
+        try:
+            with self._writing():
+                meta = self._load_meta()
+                if meta is None:
+                    return  # отметки нет - следующий старт и так пересоберет фильтр
+                meta = {
+                    "max_user_id": max(meta["max_user_id"], max(user_ids)),
+                    "usernames": meta["usernames"] + len(user_ids),
+                }
+                _write_atomic(self.meta_path, json.dumps(meta).encode('utf-8'))
+                self._meta = meta
+        except Exception as e:
+            logging.error(f"Не удалось обновить отметку фильтра Блума: {e}")
+
+    def start(self):
+        """Запускает фоновый сброс на диск (вызывается в lifespan)."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу и сбрасывает остаток."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+        await asyncio.get_running_loop().run_in_executor(None, self.flush)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                if self.shared:
+                    self.filter.refresh()  # файл мог пересобрать другой воркер
+                await loop.run_in_executor(None, self.flush)
+            except Exception as e:
+                logging.error(f"Ошибка фоновой записи фильтра Блума: {e}")
 
     def contains(self, item: str) -> bool:
         """Проверяет, *возможно* ли юзернейм в фильтре."""
@@ -59,24 +264,123 @@ class BloomFilterService:
             return False
         return item.encode('utf-8') in self.filter
 
-    def sync_from_db(self, usernames: List[str]):
+    def contains_many(self, items: List[str]) -> List[bool]:
+        """contains() для пачки юзернеймов (векторно, если есть NumPy)."""
+        keys = [item.encode('utf-8') for item in items if item]
+        found = iter(self.filter.contains_many(keys))
+        return [next(found) if item else False for item in items]
+
+    def sync_from_db(self, db: Session):
         """
-        Полная синхронизация фильтра с базой данных.
-        (Вызывается ОДИН РАЗ при старте сервера).
+        Синхронизация фильтра с базой данных (вызывается при старте каждого воркера).
+
+        Воркеры синхронизируются по очереди (под flock): первый дочитывает
+        или пересобирает общий файл, остальные видят свежую отметку и
+        ничего не делают. Юзернеймы читаются потоком (yield_per), без
+        списка в памяти. Если отметка сходится с БД, добавляются только
+        пользователи новее нее; иначе фильтр строится заново.
         """
-        logging.info(f"Синхронизация {len(usernames)} юзернеймов в фильтр Блума...")
+        with self._writing():
+            # Файл мог создать или обновить другой воркер, пока мы ждали блокировку
+            if not self._open():
+                self._meta = None
+            self._sync_locked(db)
+
+    def _sync_locked(self, db: Session):
+        user = models.User
+        total, max_user_id = db.query(func.count(user.id), func.max(user.id)).filter(
+            user.username.isnot(None)
+        ).one()
+        max_user_id = max_user_id or 0
+
+        meta = self._meta
+        if meta is None or not self.shared:
+            reason = "нет общего файла или отметки"
+        elif max_user_id < meta["max_user_id"]:
+            reason = "в БД нет пользователей из снимка (другая или восстановленная БД)"
+        elif len(self.filter.tiers) > 1:
+            reason = f"фильтр разросся до {len(self.filter.tiers)} уровней"
+        else:
+            reason = None
 
-        self.filter = BloomFilter(
-            capacity=max(len(usernames) * 2, EXPECTED_USERNAMES),
-            error_rate=FALSE_POSITIVE_RATE
-        )
+        query = db.query(user.username).filter(user.username.isnot(None))
+        if reason is None:
+            # Кроме новых id число юзернеймов меняют только удаления и вставки
+            # ниже отметки - тогда дочитать хвост недостаточно
+            newer = 0
+            if max_user_id > meta["max_user_id"]:
+                newer = query.filter(user.id > meta["max_user_id"]).count()
+            if total != meta["usernames"] + newer:
+                reason = f"в БД {total} юзернеймов, по отметке ожидалось {meta['usernames'] + newer}"
 
-        for username in usernames:
+        if reason is None:
+            if max_user_id == meta["max_user_id"]:
+                return  # отметка свежая: уже синхронизировал другой воркер
+            logging.info(f"Фильтр Блума: дочитываем пользователей с id > {meta['max_user_id']}...")
+            query = query.filter(user.id > meta["max_user_id"])
+            target = self.filter
+        else:
+            logging.info(f"Фильтр Блума: полная синхронизация {total} юзернеймов ({reason})...")
+            target = ScalableCountingBloomFilter(max(total * 2, EXPECTED_USERNAMES), FALSE_POSITIVE_RATE)
+
+        added, batch = 0, []
+        for (username,) in query.yield_per(SYNC_BATCH_SIZE):
             if username:
-                self.filter.add(username.encode('utf-8'))
+                batch.append(username.encode('utf-8'))
+            if len(batch) >= SYNC_BATCH_SIZE:
+                target.add_many(batch)
+                added, batch = added + len(batch), []
+        target.add_many(batch)
+        added += len(batch)
+
+        if reason is not None:
+            self._replace_file(target)
+        elif self.shared:
+            self.filter.flush()
+        # Отметка - только после того, как фильтр целиком на диске
+        self._meta = {"max_user_id": max_user_id, "usernames": total}
+        if self.shared:
+            _write_atomic(self.meta_path, json.dumps(self._meta).encode('utf-8'))
+        logging.info(f"Синхронизация фильтра Блума завершена: добавлено {added}.")
+
+    def stats(self) -> Dict[str, Any]:
+        """Заполненность и ошибки фильтра (для /system/metrics)."""
+        bloom = self.filter
+        checks = self.stats_counters["db_checks"]
+        observed = self.stats_counters["false_positives"] / checks if checks else 0.0
+        return {
+            **self.stats_counters,
+            "shared": self.shared,
+            "usernames": bloom.count,
+            "capacity": bloom.capacity,
+            "tiers": len(bloom.tiers),
+            "memory_bytes": bloom.memory_bytes,
+            "fill_ratio": round(bloom.fill_ratio, 4),
+            "estimated_fpr": round(bloom.estimated_fpr, 6),
+            "observed_false_positive_share": round(observed, 4),
+        }
+
+
+def _write_atomic(path: str, data: bytes):
+    """Записывает файл целиком через временный файл и os.replace."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
 
-        self._save()
-        logging.info("Синхронизация фильтра Блума завершена.")
+def _fsync_dir(path: str):
+    """fsync каталога, чтобы переименование файла пережило падение."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return  # например, Windows
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 #
@@ -85,4 +389,4 @@ class BloomFilterService:
 # Создаем тот самый синглтон-экземпляр, который
 # импортируется во всем приложении.
 #
-bloom_service = BloomFilterService()
\ No newline at end of file
+bloom_service = BloomFilterService()
@@ -13,12 +13,49 @@ class Settings(BaseSettings):
     DB_HOST: str
     DB_PORT: int = 3306
     DB_NAME: str
+    # Потоки для запросов к БД из WebSocket (меньше, чем пул соединений 5+10)
+    DB_EXECUTOR_WORKERS: int = 8
+
+    # Номер процесса для Snowflake-id сообщений (0..1023). Обычно не задается:
+    # каждый процесс арендует свободный номер в БД (app/services/worker_lease.py).
+    # Заданный номер тоже арендуется - второй процесс с ним не запустится
+    WORKER_ID: Optional[int] = None
 
     # --- Настройки JWT (из .env) ---
     SECRET_KEY: str
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60 # 1 час
 
+    # --- Шина событий между воркерами (из .env) ---
+    # memory:// - один процесс, redis://host:port - несколько воркеров/серверов
+    EVENT_BUS_URL: str = "memory://"
+
+    # --- Кэши ---
+    # Сколько чатов держать в кэше участников (LRU)
+    CHAT_CACHE_SIZE: int = 50_000
+    # Сколько черных списков пользователей держать в памяти (LRU)
+    BLOCK_INDEX_SIZE: int = 100_000
+
+    # --- Push-уведомления ---
+    # fcm - Firebase, fake - без сети (для разработки и замеров)
+    PUSH_TRANSPORT: str = "fcm"
+    # Окно склейки пушей одного чата в "N новых сообщений" (секунды, 0 - выкл.)
+    PUSH_COALESCE_WINDOW: float = 5.0
+    # Если > 0, онлайн-получатель все равно получит пуш, когда не
+    # подтвердит доставку событием "ack" за столько секунд
+    PUSH_ACK_TIMEOUT: float = 0.0
+
+    # --- Пакетная запись сообщений (group commit) ---
+    # Сколько миллисекунд собирать сообщения в один INSERT + commit
+    # (0 - выкл., каждое сообщение своей транзакцией)
+    MESSAGE_BATCH_WINDOW_MS: float = 0.0
+    # Максимум сообщений в одной пачке
+    MESSAGE_BATCH_MAX_SIZE: int = 100
+
+    # --- Прочтения ---
+    # Окно склейки событий "read" одного пользователя в одном чате (секунды)
+    READ_DEBOUNCE_WINDOW: float = 0.5
+
     @computed_field
     @property
     def DATABASE_URL(self) -> str:
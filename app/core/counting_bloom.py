@@ -0,0 +1,363 @@
+import math
+import mmap
+import os
+import struct
+from hashlib import blake2b
+from typing import BinaryIO, List, Optional, Sequence
+
+try:
+    import numpy as np  # необязательно: ускоряет пакетные add_many/contains_many
+except ImportError:
+    np = None
+
+# 4 бита на счетчик: два счетчика в байте, максимум 15
+COUNTER_MAX = 15
+# Формат файла (рассчитан на mmap, все поля фиксированного размера):
+# заголовок, MAX_TIERS описаний уровней, затем счетчики уровней подряд
+FILE_MAGIC = b"DLCBF2\n\0"
+FILE_HEADER = struct.Struct("<8sQdI4x")  # magic, initial_capacity, error_rate, число уровней
+TIER_COUNT_OFFSET = 24
+TIER_HEADER = struct.Struct("<QdQQ")     # capacity, error_rate, count, nonzero
+MAX_TIERS = 16
+DATA_OFFSET = FILE_HEADER.size + TIER_HEADER.size * MAX_TIERS
+# Сколько ключей обрабатывать NumPy за раз (массив позиций - ключи x k x 8 байт)
+BATCH_CHUNK = 100_000
+
+
+class CountingBloomFilter:
+    """
+    Счетный фильтр Блума: вместо бита - 4-битный счетчик, поэтому
+    ключ можно удалить. Памяти в 4 раза больше, чем у обычного фильтра.
+
+    Переполненный счетчик (15) больше не уменьшается: так удаление
+    никогда не дает ложного "нет", только чуть больше ложных "да".
+    Удалять можно лишь то, что действительно добавлялось.
+
+    add_many/contains_many при наличии NumPy считают позиции и обновляют
+    счетчики векторно для всей пачки; без NumPy - тем же циклом по ключам.
+    Результат в обоих случаях одинаковый.
+    """
+
+    def __init__(self, capacity: int, error_rate: float, counters=None, totals: Optional[memoryview] = None):
+        """
+        counters и totals (два uint64: count, nonzero) можно передать готовыми,
+        например кусками отображенного в память файла; по умолчанию - свои.
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_slots = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.num_hashes = max(1, round(self.num_slots / capacity * math.log(2)))
+        self.counters = counters if counters is not None else bytearray(self.counters_size(capacity, error_rate))
+        if len(self.counters) != (self.num_slots + 1) // 2:
+            raise ValueError("Размер счетчиков не совпадает с параметрами фильтра")
+        self._totals = totals if totals is not None else memoryview(bytearray(16)).cast("Q")
+
+    @staticmethod
+    def counters_size(capacity: int, error_rate: float) -> int:
+        num_slots = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        return (num_slots + 1) // 2
+
+    @property
+    def count(self) -> int:
+        """Сколько ключей сейчас в фильтре."""
+        return self._totals[0]
+
+    @count.setter
+    def count(self, value: int):
+        self._totals[0] = value
+
+    @property
+    def nonzero(self) -> int:
+        """Сколько счетчиков больше нуля."""
+        return self._totals[1]
+
+    @nonzero.setter
+    def nonzero(self, value: int):
+        self._totals[1] = value
+
+    def _indexes(self, key: bytes) -> List[int]:
+        """k позиций двойным хешированием: h1 + i*h2 (по одному blake2b на ключ)."""
+        digest = blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_slots for i in range(self.num_hashes)]
+
+    def _index_matrix(self, keys: Sequence[bytes]):
+        """Позиции пачки ключей (ключи x k), те же, что у _indexes."""
+        digests = b"".join(blake2b(key, digest_size=16).digest() for key in keys)
+        halves = np.frombuffer(digests, dtype="<u8").reshape(-1, 2)
+        # По модулю m заранее: дальше нет переполнения uint64, и ответ совпадает с _indexes
+        slots = np.uint64(self.num_slots)
+        h1 = halves[:, 0] % slots
+        h2 = (halves[:, 1] | np.uint64(1)) % slots
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+        return (h1[:, None] + steps[None, :] * h2[:, None]) % slots
+
+    def _get_many(self, indexes):
+        counters = np.frombuffer(self.counters, dtype=np.uint8)
+        shifts = ((indexes & np.uint64(1)) << np.uint64(2)).astype(np.uint8)
+        return (counters[indexes >> np.uint64(1)] >> shifts) & np.uint8(COUNTER_MAX)
+
+    def _get(self, index: int) -> int:
+        return (self.counters[index >> 1] >> ((index & 1) << 2)) & COUNTER_MAX
+
+    def _set(self, index: int, value: int):
+        shift = (index & 1) << 2
+        byte = index >> 1
+        self.counters[byte] = (self.counters[byte] & ~(COUNTER_MAX << shift) & 0xFF) | (value << shift)
+
+    def add(self, key: bytes):
+        for index in self._indexes(key):
+            value = self._get(index)
+            if value < COUNTER_MAX:
+                self._set(index, value + 1)
+                if value == 0:
+                    self.nonzero += 1
+        self.count += 1
+
+    def add_many(self, keys: Sequence[bytes]):
+        """Добавляет пачку ключей (как add для каждого)."""
+        if np is None:
+            for key in keys:
+                self.add(key)
+            return
+        counters = np.frombuffer(self.counters, dtype=np.uint8)
+        for start in range(0, len(keys), BATCH_CHUNK):
+            chunk = keys[start:start + BATCH_CHUNK]
+            slots, hits = np.unique(self._index_matrix(chunk), return_counts=True)
+            current = self._get_many(slots)
+            updated = np.minimum(current.astype(np.int64) + hits, COUNTER_MAX).astype(np.uint8)
+            self.nonzero += int(np.count_nonzero(current == 0))
+            # Два счетчика в байте: четные и нечетные позиции пишем отдельно,
+            # внутри каждой группы байты не повторяются
+            for parity in (0, 1):
+                mask = (slots & np.uint64(1)) == parity
+                byte_index = slots[mask] >> np.uint64(1)
+                shift = parity * 4
+                keep = counters[byte_index] & np.uint8(0xFF ^ (COUNTER_MAX << shift))
+                counters[byte_index] = keep | (updated[mask] << np.uint8(shift))
+            self.count += len(chunk)
+
+    def contains_many(self, keys: Sequence[bytes]) -> List[bool]:
+        """Для каждого ключа: *возможно* ли он в фильтре."""
+        if np is None:
+            return [key in self for key in keys]
+        result: List[bool] = []
+        for start in range(0, len(keys), BATCH_CHUNK):
+            present = self._get_many(self._index_matrix(keys[start:start + BATCH_CHUNK])).all(axis=1)
+            result.extend(present.tolist())
+        return result
+
+    def remove(self, key: bytes) -> bool:
+        """Удаляет ключ. False, если его точно нет в фильтре."""
+        indexes = self._indexes(key)
+        if any(self._get(index) == 0 for index in indexes):
+            return False
+        for index in indexes:
+            value = self._get(index)
+            if value < COUNTER_MAX:
+                self._set(index, value - 1)
+                if value == 1:
+                    self.nonzero -= 1
+        self.count = max(0, self.count - 1)
+        return True
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self._get(index) for index in self._indexes(key))
+
+    @property
+    def fill_ratio(self) -> float:
+        """Доля ненулевых счетчиков."""
+        return self.nonzero / self.num_slots
+
+    @property
+    def estimated_fpr(self) -> float:
+        """Текущая вероятность ложного "да" по заполненности."""
+        return self.fill_ratio ** self.num_hashes
+
+
+class ScalableCountingBloomFilter:
+    """
+    Масштабируемый счетный фильтр: набор уровней CountingBloomFilter.
+
+    Когда последний уровень заполнен до своей емкости, добавляется новый:
+    вдвое больше, с вдвое меньшей долей ошибок. Сумма ошибок всех уровней
+    не превышает error_rate, сколько бы юзернеймов ни добавилось.
+    """
+
+    GROWTH = 2
+    TIGHTENING = 0.5
+
+    def __init__(self, initial_capacity: int, error_rate: float,
+                 tiers: Optional[List[CountingBloomFilter]] = None):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.tiers = tiers or [
+            CountingBloomFilter(initial_capacity, error_rate * (1 - self.TIGHTENING))
+        ]
+
+    def add(self, key: bytes):
+        tier = self.tiers[-1]
+        if tier.count >= tier.capacity:
+            tier = self._new_tier(tier.capacity * self.GROWTH, tier.error_rate * self.TIGHTENING)
+        tier.add(key)
+
+    def _new_tier(self, capacity: int, error_rate: float) -> CountingBloomFilter:
+        tier = CountingBloomFilter(capacity, error_rate)
+        self.tiers.append(tier)
+        return tier
+
+    def add_many(self, keys: Sequence[bytes]):
+        """Добавляет пачку ключей, заполняя уровни по очереди."""
+        start = 0
+        while start < len(keys):
+            tier = self.tiers[-1]
+            room = tier.capacity - tier.count
+            if room <= 0:
+                self.add(keys[start])  # создаст следующий уровень
+                start += 1
+                continue
+            tier.add_many(keys[start:start + room])
+            start += room
+
+    def contains_many(self, keys: Sequence[bytes]) -> List[bool]:
+        result = [False] * len(keys)
+        for tier in self.tiers:
+            rest = [i for i, found in enumerate(result) if not found]
+            if not rest:
+                break
+            for i, found in zip(rest, tier.contains_many([keys[i] for i in rest])):
+                result[i] = found
+        return result
+
+    def remove(self, key: bytes) -> bool:
+        """Удаляет ключ из самого нового уровня, где он есть."""
+        for tier in reversed(self.tiers):
+            if key in tier:
+                return tier.remove(key)
+        return False
+
+    def __contains__(self, key: bytes) -> bool:
+        return any(key in tier for tier in self.tiers)
+
+    @property
+    def capacity(self) -> int:
+        return sum(tier.capacity for tier in self.tiers)
+
+    @property
+    def count(self) -> int:
+        return sum(tier.count for tier in self.tiers)
+
+    @property
+    def fill_ratio(self) -> float:
+        """Заполненность последнего уровня (куда идут новые ключи)."""
+        return self.tiers[-1].fill_ratio
+
+    @property
+    def estimated_fpr(self) -> float:
+        """Вероятность ложного "да" хотя бы на одном уровне."""
+        miss = 1.0
+        for tier in self.tiers:
+            miss *= 1 - tier.estimated_fpr
+        return 1 - miss
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(len(tier.counters) for tier in self.tiers)
+
+    def tofile(self, f: BinaryIO):
+        """Пишет фильтр в формате, который открывает SharedCountingBloomFilter."""
+        if len(self.tiers) > MAX_TIERS:
+            raise ValueError(f"Больше {MAX_TIERS} уровней: фильтр нужно пересобрать")
+        f.write(FILE_HEADER.pack(FILE_MAGIC, self.initial_capacity, self.error_rate, len(self.tiers)))
+        for i in range(MAX_TIERS):
+            if i < len(self.tiers):
+                tier = self.tiers[i]
+                f.write(TIER_HEADER.pack(tier.capacity, tier.error_rate, tier.count, tier.nonzero))
+            else:
+                f.write(bytes(TIER_HEADER.size))
+        for tier in self.tiers:
+            f.write(tier.counters)
+
+
+class SharedCountingBloomFilter(ScalableCountingBloomFilter):
+    """
+    Масштабируемый счетный фильтр прямо в файле, отображенном в память
+    (mmap, MAP_SHARED): все процессы, открывшие файл, видят одни и те же
+    страницы, то есть одну копию фильтра и изменения друг друга сразу.
+
+    Чтение без блокировок. Запись должен упорядочивать вызывающий (один
+    писатель за раз, например flock) и перед ней звать refresh(). Новый
+    уровень дописывается в конец файла на месте; остальные процессы
+    замечают его по числу уровней в заголовке и переотображают файл.
+    Если файл подменили целиком (пересборка), это видит refresh().
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._map()
+
+    def _map(self):
+        with open(self.path, "r+b") as f:
+            self._inode = os.fstat(f.fileno()).st_ino
+            mapped = mmap.mmap(f.fileno(), 0)
+        magic, initial_capacity, error_rate, tier_count = FILE_HEADER.unpack_from(mapped, 0)
+        if magic != FILE_MAGIC:
+            raise ValueError("Неизвестный формат файла фильтра")
+
+        view = memoryview(mapped)
+        tiers, offset = [], DATA_OFFSET
+        for i in range(tier_count):
+            capacity, tier_error_rate, _, _ = TIER_HEADER.unpack_from(mapped, FILE_HEADER.size + i * TIER_HEADER.size)
+            size = CountingBloomFilter.counters_size(capacity, tier_error_rate)
+            if offset + size > len(mapped):
+                raise ValueError("Файл фильтра обрезан")
+            totals_offset = FILE_HEADER.size + i * TIER_HEADER.size + 16
+            tiers.append(CountingBloomFilter(
+                capacity, tier_error_rate,
+                counters=view[offset:offset + size],
+                totals=view[totals_offset:totals_offset + 16].cast("Q"),
+            ))
+            offset += size
+        # Старые отображения не закрываем: их еще могут читать другие потоки
+        self._mmap, self.tiers = mapped, tiers
+        self.initial_capacity, self.error_rate = initial_capacity, error_rate
+
+    def _tier_count(self) -> int:
+        return struct.unpack_from("<I", self._mmap, TIER_COUNT_OFFSET)[0]
+
+    def refresh(self):
+        """Переотображает файл, если его подменили или в нем появился уровень."""
+        try:
+            replaced = os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return
+        if replaced or self._tier_count() != len(self.tiers):
+            self._map()
+
+    def _new_tier(self, capacity: int, error_rate: float) -> CountingBloomFilter:
+        index = len(self.tiers)
+        if index >= MAX_TIERS:
+            raise ValueError(f"Больше {MAX_TIERS} уровней: фильтр нужно пересобрать")
+        end = DATA_OFFSET + sum(len(tier.counters) for tier in self.tiers)
+        with open(self.path, "r+b") as f:
+            f.truncate(end + CountingBloomFilter.counters_size(capacity, error_rate))  # дополняется нулями
+        TIER_HEADER.pack_into(self._mmap, FILE_HEADER.size + index * TIER_HEADER.size, capacity, error_rate, 0, 0)
+        # Число уровней пишется последним: читатели увидят уже готовый уровень
+        struct.pack_into("<I", self._mmap, TIER_COUNT_OFFSET, index + 1)
+        self._map()
+        return self.tiers[-1]
+
+    def __contains__(self, key: bytes) -> bool:
+        if self._tier_count() != len(self.tiers):
+            self._map()
+        return super().__contains__(key)
+
+    def contains_many(self, keys: Sequence[bytes]) -> List[bool]:
+        if self._tier_count() != len(self.tiers):
+            self._map()
+        return super().contains_many(keys)
+
+    def flush(self):
+        """msync: сбрасывает измененные страницы на диск."""
+        self._mmap.flush()
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Как часто измеряем задержку event loop (секунды)
+SAMPLE_INTERVAL = 0.1
+# Сколько последних замеров храним (600 * 0.1 = последние ~60 секунд)
+WINDOW_SIZE = 600
+# Задержка, после которой пишем предупреждение в лог (секунды)
+WARN_THRESHOLD = 0.1
+
+
+class EventLoopMonitor:
+    """
+    Измеряет "лаг" event loop: насколько позже запланированного
+    просыпается asyncio.sleep. Если какой-то код блокирует loop
+    (синхронный запрос к БД, тяжелые вычисления), лаг растет
+    сразу у всех подключенных пользователей.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL, window: int = WINDOW_SIZE):
+        self.interval = interval
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запускает фоновый замер (вызывается в lifespan)."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - started - self.interval, 0.0)
+
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > WARN_THRESHOLD:
+                logger.warning(f"Event loop заблокирован на {lag * 1000:.0f} мс")
+
+    def stats(self) -> Dict[str, float]:
+        """Статистика за окно последних замеров (в миллисекундах)."""
+        if not self.samples:
+            return {"samples": 0, "current_ms": 0.0, "avg_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+
+        ordered = sorted(self.samples)
+        p99 = ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)]
+        return {
+            "samples": len(ordered),
+            "current_ms": round(self.samples[-1] * 1000, 2),
+            "avg_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+            "p99_ms": round(p99 * 1000, 2),
+            "max_ms": round(self.max_lag * 1000, 2),
+        }
+
+
+# Глобальный экземпляр (один на процесс)
+loop_monitor = EventLoopMonitor()
@@ -0,0 +1,96 @@
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+# Начало отсчета времени в id (2024-01-01 UTC, мс): 41 бита хватит до ~2093 года
+EPOCH_MS = 1_704_067_200_000
+
+TIMESTAMP_BITS = 41
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+WORKER_SHIFT = SEQUENCE_BITS
+TIMESTAMP_SHIFT = SEQUENCE_BITS + WORKER_BITS
+
+
+class SnowflakeGenerator:
+    """
+    64-битные id, упорядоченные по времени: [41 бит мс | 10 бит воркер | 12 бит счетчик].
+
+    id и время отправки назначаются в процессе, без обращения к БД, поэтому
+    событие new_message можно рассылать, не дожидаясь INSERT, а воркеры
+    не конкурируют за AUTO_INCREMENT. До 4096 id в миллисекунду на воркер.
+
+    id растут строго монотонно в пределах воркера (даже если часы откатились
+    назад). Между воркерами порядок задают часы; чтобы ответ на сообщение
+    с другого воркера всегда получал больший id, воркер подтягивает свое
+    время через observe() для каждого увиденного чужого id.
+
+    Номер воркера уникален на весь кластер: его выдает аренда в БД
+    (app/services/worker_lease.py). Пока номера нет, next_id() падает,
+    а не выдает id, которые могут совпасть с чужими.
+
+    Внимание: id больше 2^53, JS-клиентам нужно читать их как BigInt/строку.
+    """
+
+    def __init__(self, worker_id: Optional[int] = None):
+        self.worker_id: Optional[int] = None
+        self._last_ms = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self.assign(worker_id)
+
+    def assign(self, worker_id: Optional[int]):
+        """Назначает номер воркера (None - снять, например при потере аренды)."""
+        if worker_id is not None and not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id должен быть от 0 до {MAX_WORKER_ID}")
+        with self._lock:
+            self.worker_id = worker_id
+
+    def next_id(self) -> int:
+        """Новый id (потокобезопасно)."""
+        with self._lock:
+            if self.worker_id is None:
+                raise RuntimeError("Номер воркера для Snowflake-id не назначен (нет аренды)")
+            now = max(self._now_ms(), self._last_ms)
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Счетчик исчерпан в этой мс: занимаем следующую
+                    now += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (now << TIMESTAMP_SHIFT) | (self.worker_id << WORKER_SHIFT) | self._sequence
+
+    def observe(self, other_id: int):
+        """Учитывает чужой id: следующие id этого воркера будут больше него."""
+        other_ms = other_id >> TIMESTAMP_SHIFT
+        with self._lock:
+            if other_ms >= self._last_ms:
+                self._last_ms = other_ms
+                self._sequence = MAX_SEQUENCE  # следующий id уйдет в новую мс
+
+    @staticmethod
+    def _now_ms() -> int:
+        """Миллисекунды от EPOCH_MS."""
+        return time.time_ns() // 1_000_000 - EPOCH_MS
+
+
+def max_id_until(timestamp: float) -> int:
+    """Наибольший id, который мог быть выдан к моменту timestamp (секунды Unix)."""
+    ms = int(timestamp * 1000) - EPOCH_MS
+    return (ms << TIMESTAMP_SHIFT) | ((1 << TIMESTAMP_SHIFT) - 1)
+
+
+def id_to_datetime(snowflake_id: int) -> datetime:
+    """Время создания id (naive UTC, как остальные TIMESTAMP в БД)."""
+    ms = (snowflake_id >> TIMESTAMP_SHIFT) + EPOCH_MS
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).replace(tzinfo=None)
+
+
+# Глобальный генератор (один на процесс); номер назначает worker_lease в lifespan
+snowflake = SnowflakeGenerator()
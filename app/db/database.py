@@ -1,3 +1,9 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, Callable, Dict, Iterator
+
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, Session
 from app.core.config import settings # Импортируем наши настройки
@@ -42,6 +48,54 @@ def get_db() -> Session:
     finally:
         db.close() # Закрываем сессию после того, как эндпоинт отработал
 
+# 4. Короткая сессия для кода вне HTTP-запросов (WebSocket, фоновые задачи)
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """
+    Открывает сессию на время одного блока `with` и сразу возвращает
+    соединение в пул. В отличие от get_db, не привязана к жизни запроса:
+    WebSocket берет сессию только на обработку одного события.
+    """
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# 5. Пул потоков для работы с БД из async-кода
+# SQLAlchemy и PyMySQL синхронные: если вызвать их прямо в `async def`,
+# каждый запрос останавливает event loop для всех подключенных сокетов.
+# Поэтому WebSocket выполняет всю работу с БД здесь. Размер пула ограничивает
+# число одновременных запросов и не дает выбрать весь пул соединений.
+db_executor = ThreadPoolExecutor(
+    max_workers=settings.DB_EXECUTOR_WORKERS,
+    thread_name_prefix="db-worker"
+)
+_executor_stats: Dict[str, int] = {"in_flight": 0}
+
+
+def _call_in_session(func: Callable, args: tuple, kwargs: dict) -> Any:
+    with session_scope() as db:
+        return func(db, *args, **kwargs)
+
+
+async def run_in_session(func: Callable, *args, **kwargs) -> Any:
+    """
+    Выполняет func(db, *args, **kwargs) в пуле потоков БД с новой короткой
+    сессией и возвращает результат, не блокируя event loop.
+    """
+    loop = asyncio.get_running_loop()
+    _executor_stats["in_flight"] += 1
+    try:
+        return await loop.run_in_executor(db_executor, partial(_call_in_session, func, args, kwargs))
+    finally:
+        _executor_stats["in_flight"] -= 1
+
+
+def executor_stats() -> Dict[str, int]:
+    """Состояние пула потоков БД (для /system/metrics)."""
+    return {"workers": settings.DB_EXECUTOR_WORKERS, **_executor_stats}
+
 # --- Функция для создания таблиц ---
 def create_all_tables():
     """
@@ -52,6 +106,9 @@ def create_all_tables():
     try:
         print("Создание таблиц в БД (если их нет)...")
         Base.metadata.create_all(bind=engine)
+        # Индексы/колонки, добавленные в models.py после создания таблиц
+        from app.db.migrations import run_migrations
+        run_migrations(engine)
         print("Таблицы успешно созданы/проверены.")
     except Exception as e:
         print(f"Ошибка при создании таблиц: {e}")
@@ -0,0 +1,209 @@
+"""
+Простые идемпотентные миграции для уже существующих таблиц.
+
+Base.metadata.create_all создает только отсутствующие таблицы: новые
+индексы и колонки в старых таблицах он не добавляет. Эти шаги проверяют
+схему через inspector и досоздают недостающее, поэтому их можно
+запускать при каждом старте.
+
+Ручной запуск: python -m app.db.migrations
+Перенос старых прочтений: python -m app.db.migrations --backfill-reads
+Пересчет счетчиков непрочитанных: python -m app.db.migrations --repair-unread
+Хеши телефонов для поиска контактов: python -m app.db.migrations --backfill-phone-hashes
+"""
+import argparse
+import logging
+
+from typing import List, Optional
+
+from sqlalchemy import func, inspect, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn
+
+from app.db import models
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_indexes(engine: Engine):
+    """Создает индексы из models.py, которых еще нет в БД."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    for table in models.Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue  # таблицу (вместе с индексами) создаст create_all
+        existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info(f"Миграция: создаю индекс {index.name} на {table.name}")
+                index.create(bind=engine)
+
+
+def ensure_columns(engine: Engine) -> List[str]:
+    """
+    Добавляет колонки из models.py, которых нет в существующих таблицах.
+    Без значения по умолчанию можно добавить только nullable-колонку.
+    Возвращает добавленные колонки ("таблица.колонка").
+    """
+    added = []
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    for table in models.Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {col["name"] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable and column.server_default is None:
+                logger.error(f"Миграция: колонку {table.name}.{column.name} нужно добавить вручную")
+                continue
+            ddl = CreateColumn(column).compile(dialect=engine.dialect)
+            logger.info(f"Миграция: добавляю колонку {table.name}.{column.name}")
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def backfill_read_watermarks(engine: Engine, batch_size: int = 1000) -> int:
+    """
+    Переносит прочтения из message_reads в водяные знаки chat_participants:
+    last_read_message_id = max(message_id), last_read_at = max(read_at)
+    по каждой паре (чат, пользователь). Знак только растет, поэтому
+    повторный запуск безопасен. Возвращает число обновленных участников.
+    """
+    read = models.MessageRead
+    message = models.Message
+    participant = models.ChatParticipant.__table__
+
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select(message.chat_id, read.user_id, func.max(read.message_id), func.max(read.read_at))
+            .join(message, message.id == read.message_id)
+            .group_by(message.chat_id, read.user_id)
+        ).all()
+
+    updated = 0
+    for start in range(0, len(rows), batch_size):
+        with engine.begin() as conn:
+            for chat_id, user_id, max_message_id, max_read_at in rows[start:start + batch_size]:
+                result = conn.execute(
+                    participant.update()
+                    .where(
+                        participant.c.chat_id == chat_id,
+                        participant.c.user_id == user_id,
+                        func.coalesce(participant.c.last_read_message_id, 0) < max_message_id
+                    )
+                    .values(last_read_message_id=max_message_id, last_read_at=max_read_at)
+                )
+                updated += result.rowcount
+    logger.info(f"Перенос прочтений: обновлено участников {updated} из {len(rows)}")
+    return updated
+
+
+def repair_unread_counts(engine: Engine, chat_id: Optional[int] = None) -> int:
+    """
+    Пересчитывает chat_participants.unread_count от водяных знаков прочтения
+    (все чаты или один chat_id). Счетчики ведутся инкрементально, поэтому
+    это сверка на случай расхождений; запускать можно в любой момент.
+    Заодно опускает водяные знаки выше последнего сообщения чата.
+    Возвращает число обновленных участников.
+    """
+    from app.services.message_service import unread_count_query
+
+    participant = models.ChatParticipant
+    # Знак выше последнего сообщения чата (старые клиенты слали любые id) - к нему
+    last_id = select(func.max(models.Message.id)).where(
+        models.Message.chat_id == participant.chat_id
+    ).scalar_subquery()
+    clamp = update(participant).where(participant.last_read_message_id > last_id).values(
+        last_read_message_id=last_id
+    )
+    statement = update(participant).values(
+        unread_count=unread_count_query(
+            participant.chat_id, participant.user_id,
+            participant.last_read_message_id, participant.last_cleared_at
+        )
+    )
+    if chat_id is not None:
+        clamp = clamp.where(participant.chat_id == chat_id)
+        statement = statement.where(participant.chat_id == chat_id)
+
+    with engine.begin() as conn:
+        conn.execute(clamp)
+        updated = conn.execute(statement).rowcount
+    logger.info(f"Пересчет непрочитанных: обновлено участников {updated}")
+    return updated
+
+
+def backfill_phone_hashes(engine: Engine, batch_size: int = 1000) -> int:
+    """
+    Заполняет users.phone_hash там, где он пуст (порциями по id).
+    Повторный запуск безопасен. Возвращает число обновленных пользователей.
+    """
+    from app.services.user_service import hash_phone
+
+    users = models.User.__table__
+    updated, last_id = 0, 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(users.c.id, users.c.phone_number)
+                .where(users.c.phone_hash.is_(None), users.c.id > last_id)
+                .order_by(users.c.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            for user_id, phone_number in rows:
+                conn.execute(
+                    users.update().where(users.c.id == user_id).values(phone_hash=hash_phone(phone_number))
+                )
+            updated += len(rows)
+            last_id = rows[-1][0]
+    logger.info(f"Хеши телефонов: заполнено {updated}")
+    return updated
+
+
+def run_migrations(engine: Engine):
+    """Все шаги по порядку. Вызывается из database.create_all_tables()."""
+    added = ensure_columns(engine)
+    ensure_indexes(engine)
+    if "chat_participants.unread_count" in added:
+        # Новая колонка: заполняем счетчики по текущим водяным знакам
+        repair_unread_counts(engine)
+    if "users.phone_hash" in added:
+        backfill_phone_hashes(engine)
+
+
+if __name__ == "__main__":
+    from app.db.database import engine
+
+    parser = argparse.ArgumentParser(description="Миграции схемы БД")
+    parser.add_argument(
+        "--backfill-reads", action="store_true",
+        help="перенести прочтения из message_reads в водяные знаки участников"
+    )
+    parser.add_argument(
+        "--repair-unread", action="store_true",
+        help="пересчитать счетчики непрочитанных по водяным знакам"
+    )
+    parser.add_argument(
+        "--backfill-phone-hashes", action="store_true",
+        help="заполнить пустые users.phone_hash"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run_migrations(engine)
+    if args.backfill_reads:
+        backfill_read_watermarks(engine)
+    if args.backfill_reads or args.repair_unread:
+        # После переноса прочтений счетчики тоже нужно пересчитать
+        repair_unread_counts(engine)
+    if args.backfill_phone_hashes:
+        backfill_phone_hashes(engine)
+    print("Миграции применены.")
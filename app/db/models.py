@@ -1,7 +1,7 @@
 import enum
 from sqlalchemy import (
     Column, Integer, String, ForeignKey, Enum, TIMESTAMP, TEXT, BLOB, BIGINT,
-    create_engine, UniqueConstraint, Boolean
+    create_engine, UniqueConstraint, Boolean, Index
 )
 from sqlalchemy.orm import relationship, declarative_base
 from sqlalchemy.sql import func
@@ -31,6 +31,8 @@ class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
     phone_number = Column(String(20), unique=True, index=True, nullable=False)
+    # SHA-256 нормализованного номера, для поиска контактов (user_service.hash_phone)
+    phone_hash = Column(String(64), index=True, nullable=True)
     username = Column(String(50), unique=True, index=True, nullable=True)
     first_name = Column(String(100), nullable=False)
     last_name = Column(String(100), nullable=True)
@@ -104,7 +106,12 @@ class ChatParticipant(Base):
     custom_nickname = Column(String(100), nullable=True)
     joined_at = Column(TIMESTAMP, server_default=func.now(), nullable=False)
     last_cleared_at = Column(TIMESTAMP, nullable=True) 
+    # Водяной знак прочтения: все сообщения чата с id <= last_read_message_id прочитаны
     last_read_message_id = Column(BIGINT, default=0)
+    last_read_at = Column(TIMESTAMP, nullable=True)
+    # Счетчик непрочитанных (чужие сообщения с id > last_read_message_id), ведется
+    # инкрементально; сверка: python -m app.db.migrations --repair-unread
+    unread_count = Column(Integer, default=0, server_default="0", nullable=False)
 
     __table_args__ = (UniqueConstraint('user_id', 'chat_id', name='_user_chat_uc'),)
     user = relationship("User", back_populates="chat_links")
@@ -113,7 +120,8 @@ class ChatParticipant(Base):
 
 class Message(Base):
     __tablename__ = "messages"
-    id = Column(BIGINT, primary_key=True, index=True)
+    # Snowflake-id назначает приложение (app/core/snowflake.py), не AUTO_INCREMENT
+    id = Column(BIGINT, primary_key=True, index=True, autoincrement=False)
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
     sender_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
     
@@ -127,11 +135,16 @@ class Message(Base):
     status = Column(Enum(MessageStatusEnum), nullable=False, default=MessageStatusEnum.sent)
     is_pinned = Column(Boolean, default=False, nullable=False)
 
+    # Пагинация истории курсором: WHERE chat_id = ? AND id < ? ORDER BY id DESC
+    __table_args__ = (Index('ix_messages_chat_id_id', 'chat_id', 'id'),)
+
     chat = relationship("Chat", back_populates="messages")
     sender = relationship("User", back_populates="sent_messages")
     read_by = relationship("MessageRead", back_populates="message")
 
 
+# Устарело: прочтения хранятся водяными знаками в chat_participants.
+# Таблица оставлена для переноса старых данных (python -m app.db.migrations --backfill-reads)
 class MessageRead(Base):
     __tablename__ = "message_reads"
     id = Column(BIGINT, primary_key=True, index=True)
@@ -140,4 +153,13 @@ class MessageRead(Base):
     read_at = Column(TIMESTAMP, server_default=func.now(), nullable=False)
     __table_args__ = (UniqueConstraint('message_id', 'user_id', name='_msg_user_read_uc'),)
     message = relationship("Message", back_populates="read_by")
-    user = relationship("User", back_populates="read_receipts")
\ No newline at end of file
+    user = relationship("User", back_populates="read_receipts")
+
+
+# Номера воркеров для Snowflake-id: процесс арендует свободный при старте
+# и продлевает аренду, пока жив (app/services/worker_lease.py)
+class WorkerLease(Base):
+    __tablename__ = "worker_leases"
+    worker_id = Column(Integer, primary_key=True, autoincrement=False)
+    owner = Column(String(64), nullable=False)  # хост:pid:случайный суффикс
+    expires_at = Column(TIMESTAMP, nullable=False)
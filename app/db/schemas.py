@@ -1,4 +1,4 @@
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, List
 from datetime import datetime
 import enum
@@ -46,6 +46,18 @@ class UserPublic(BaseModel):
     last_seen_at: datetime
     is_online: bool = False
 
+class ContactsMatchRequest(BaseModel):
+    # Номера из адресной книги и/или их SHA-256 (hex) от нормализованного вида "+79001234567"
+    phone_numbers: List[str] = Field(default_factory=list, max_length=5000)
+    phone_hashes: List[str] = Field(default_factory=list, max_length=5000)
+
+class UsernamesCheckRequest(BaseModel):
+    usernames: List[str] = Field(min_length=1, max_length=1000)
+
+class ContactMatch(UserPublic):
+    # По какому хешу найден (чтобы клиент сопоставил с контактом)
+    phone_hash: str
+
 class UserInDB(UserBase):
     model_config = ConfigDict(from_attributes=True)
     id: int
@@ -82,6 +94,11 @@ class Chat(ChatBase):
     owner_id: Optional[int] = None
     avatar_url: Optional[str] = None
     participants: List[UserPublic] = []
+    # Для списка чатов (GET /chats/)
+    last_message: Optional["Message"] = None
+    unread_count: int = 0
+    # ЛС: собеседник в моем черном списке
+    is_blocked: bool = False
 
 # --- Message ---
 class ReadReceipt(BaseModel):
@@ -104,7 +121,7 @@ class MessageUpdate(BaseModel):
 
 class Message(MessageBase):
     model_config = ConfigDict(from_attributes=True)
-    id: int
+    id: int = Field(description="Snowflake-id, больше 2^53: JS-клиентам читать как BigInt/строку")
     chat_id: int
     sender_id: Optional[int]
     sent_at: datetime
@@ -112,6 +129,9 @@ class Message(MessageBase):
     is_pinned: bool = False
     message_type: MessageTypeEnum
 
+# Chat ссылается на Message, объявленный ниже
+Chat.model_rebuild()
+
 # --- Auth ---
 class Token(BaseModel):
     access_token: str
@@ -5,19 +5,29 @@ import os
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
 
 # --- Импорты наших компонентов ---
-from app.db import database, models
+from app.db import database
+from app.core.config import settings
 from app.core.bloom_filter import bloom_service
-from app.services import user_service
-from app.services.notification_service import init_firebase # <--- Импорт
+from app.core.loop_monitor import loop_monitor
+from app.services.notification_service import init_firebase, push_dispatcher, push_coalescer # <--- Импорт
+from app.services.connection_manager import manager
+from app.services.chat_cache import chat_cache
+from app.services.block_index import block_index
+from app.services.user_search import user_search
+from app.services.username_index import username_index
+from app.services.read_receipts import read_debouncer
+from app.services.message_writer import message_writer
+from app.services.event_bus import create_event_bus
+from app.services.worker_lease import worker_lease
 
 # --- Импорты наших роутеров (API) ---
 from app.api.v1 import auth as auth_v1
 from app.api.v1 import users as users_v1
 from app.api.v1 import chats as chats_v1
 from app.api.v1 import messages as messages_v1
+from app.api.v1 import system as system_v1
 
 # Настраиваем базовый логгер
 logging.basicConfig(level=logging.INFO)
@@ -42,22 +52,60 @@ async def lifespan(app: FastAPI):
     # 2. Создание таблиц БД
     logger.info("Проверка и создание таблиц в БД...")
     database.create_all_tables()
+
+    # 2.1 Уникальный номер воркера для Snowflake-id (аренда в БД, без него старт падает)
+    await worker_lease.start()
     
-    # 3. Синхронизация Фильтра Блума
+    # 3. Синхронизация Фильтра Блума (потоком, только новее сохраненной отметки)
     logger.info("Загрузка юзернеймов в Фильтр Блума...")
     db = database.SessionLocal()
     try:
-        users_with_usernames = db.query(models.User.username).filter(models.User.username.isnot(None)).all()
-        all_usernames = [u[0] for u in users_with_usernames]
-        bloom_service.sync_from_db(all_usernames)
+        bloom_service.sync_from_db(db)
     except Exception as e:
+        db.rollback()  # индексам ниже нужна рабочая сессия
         logger.error(f"Ошибка при синхронизации Фильтра Блума: {e}")
+
+    # 3.1 Индексы поиска и автодополнения юзернеймов
+    try:
+        user_search.rebuild(db)
+        username_index.rebuild(db)
+    except Exception as e:
+        logger.error(f"Ошибка при построении индексов поиска: {e}")
     finally:
         db.close()
 
+    # 4. Подключение к шине событий (доставка между воркерами)
+    logger.info("Подключение к шине событий...")
+    await manager.start(create_event_bus(settings.EVENT_BUS_URL))
+    await chat_cache.start(manager.bus)
+    await block_index.start(manager.bus)
+    await user_search.start(manager.bus)
+    await username_index.start(manager.bus)
+
+    # 5. Замер задержки event loop (см. /api/v1/system/metrics)
+    loop_monitor.start()
+
+    # 6. Фоновая отправка пушей
+    push_dispatcher.start()
+    await push_coalescer.start(manager.bus)
+
+    # 7. Пакетная запись сообщений (если включена MESSAGE_BATCH_WINDOW_MS)
+    message_writer.start()
+
+    # 8. Фоновый сброс фильтра Блума на диск (msync)
+    bloom_service.start()
+
     yield
 
     logger.info("Приложение останавливается...")
+    await message_writer.stop()
+    await read_debouncer.stop()
+    await bloom_service.stop()
+    push_coalescer.stop()  # до диспетчера: склейки уходят в его очередь
+    await push_dispatcher.stop()
+    loop_monitor.stop()
+    await manager.stop()
+    await worker_lease.stop()  # последним: после него id сообщений не выдаются
 
 
 # --- Создание основного приложения ---
@@ -82,6 +130,7 @@ app.include_router(auth_v1.router, prefix="/api")
 app.include_router(users_v1.router, prefix="/api")
 app.include_router(chats_v1.router, prefix="/api")
 app.include_router(messages_v1.router, prefix="/api")
+app.include_router(system_v1.router, prefix="/api")
 
 # Подключаем раздачу файлов
 app.mount("/static", StaticFiles(directory="uploads"), name="static")
@@ -1,3 +1,4 @@
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from fastapi import HTTPException, status
 from typing import Optional
@@ -32,6 +33,7 @@ def register_new_user(db: Session, user_data: schemas.UserCreate) -> models.User
 
             # ⭐ ШАГ 2.2: Если фильтр сказал "возможно", делаем точную проверку в БД
             db_user_by_username = user_service.get_user_by_username(db, username=user_data.username)
+            bloom_service.note_db_check(taken=db_user_by_username is not None)
             if db_user_by_username:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
@@ -41,11 +43,20 @@ def register_new_user(db: Session, user_data: schemas.UserCreate) -> models.User
         # и сразу переходим к созданию.
 
     # 3. Если все проверки пройдены, создаем пользователя
-    new_user = user_service.create_user(db, user_data=user_data)
+    try:
+        new_user = user_service.create_user(db, user_data=user_data)
+    except IntegrityError:
+        # Уникальные индексы БД - последняя линия: гонка двух регистраций
+        # или ложное "нет" фильтра после удаления юзернейма
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Этот юзернейм или номер телефона уже заняты.",
+        )
 
     # ⭐ ШАГ 4: Добавляем новый юзернейм в фильтр
     if new_user.username:
-        bloom_service.add(new_user.username)
+        bloom_service.add(new_user.username, user_id=new_user.id)
 
     return new_user
 
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+from sqlalchemy.orm import Session
+
+from app.db import models
+from app.core.config import settings
+from app.services.event_bus import publish_from_any_thread
+
+logger = logging.getLogger(__name__)
+
+# Канал шины для сброса индекса на всех воркерах
+BLOCK_INDEX_CHANNEL = "dialect:block-index"
+
+
+class BlockIndex:
+    """
+    Индекс черного списка в памяти: blocker_id -> frozenset(blocked_id).
+
+    Список пользователя загружается из user_blocks один раз при первом
+    обращении, дальше любые проверки is_blocked (в том числе отрицательные,
+    самые частые) идут без запросов к БД. block_user/unblock_user
+    обновляют индекс сразу, остальные воркеры сбрасывают запись через шину.
+
+    Число загруженных пользователей ограничено (LRU), методы потокобезопасны.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._entries: "OrderedDict[int, FrozenSet[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Растет при каждом изменении: загрузка, начатая раньше, не попадет в индекс
+        self._epoch = 0
+        self.bus = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.instance_id = uuid.uuid4().hex
+        self.stats_counters = {"hits": 0, "loads": 0, "evictions": 0}
+
+    async def start(self, bus=None):
+        """Подписывается на изменения с других воркеров (вызывается в lifespan)."""
+        self.loop = asyncio.get_running_loop()
+        self.bus = bus
+        if bus is not None:
+            await bus.subscribe(BLOCK_INDEX_CHANNEL, self._on_remote_change)
+
+    # --- Чтение ---
+
+    def blocked_by(self, db: Session, blocker_id: int) -> FrozenSet[int]:
+        """Кого заблокировал blocker_id."""
+        return self._get_many(db, [blocker_id])[blocker_id]
+
+    def is_blocked(self, db: Session, blocker_id: int, target_id: int) -> bool:
+        """Заблокировал ли blocker_id пользователя target_id."""
+        return target_id in self.blocked_by(db, blocker_id)
+
+    def filter_not_blocking(self, db: Session, target_id: int, user_ids: Iterable[int]) -> List[int]:
+        """
+        Оставляет только тех, кто НЕ заблокировал target_id.
+        Недостающие списки догружаются одним запросом на всю пачку.
+        """
+        user_ids = list(user_ids)
+        lists = self._get_many(db, user_ids)
+        return [uid for uid in user_ids if target_id not in lists[uid]]
+
+    def _get_many(self, db: Session, blocker_ids: List[int]) -> Dict[int, FrozenSet[int]]:
+        result: Dict[int, FrozenSet[int]] = {}
+        with self._lock:
+            for uid in blocker_ids:
+                entry = self._entries.get(uid)
+                if entry is not None:
+                    self._entries.move_to_end(uid)
+                    self.stats_counters["hits"] += 1
+                    result[uid] = entry
+            missing = [uid for uid in set(blocker_ids) if uid not in result]
+            epoch = self._epoch
+
+        if not missing:
+            return result
+
+        loaded: Dict[int, set] = {uid: set() for uid in missing}
+        rows = db.query(models.UserBlock.blocker_id, models.UserBlock.blocked_id).filter(
+            models.UserBlock.blocker_id.in_(missing)
+        ).all()
+        for blocker_id, blocked_id in rows:
+            loaded[blocker_id].add(blocked_id)
+
+        with self._lock:
+            self.stats_counters["loads"] += len(missing)
+            for uid, blocked in loaded.items():
+                result[uid] = frozenset(blocked)
+                if epoch == self._epoch:
+                    self._store(uid, result[uid])
+        return result
+
+    def _store(self, blocker_id: int, blocked: FrozenSet[int]):
+        self._entries[blocker_id] = blocked
+        self._entries.move_to_end(blocker_id)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.stats_counters["evictions"] += 1
+
+    # --- Изменения (вызывать после commit) ---
+
+    def on_block(self, blocker_id: int, blocked_id: int):
+        self._update(blocker_id, blocked_id, add=True)
+
+    def on_unblock(self, blocker_id: int, blocked_id: int):
+        self._update(blocker_id, blocked_id, add=False)
+
+    def _update(self, blocker_id: int, blocked_id: int, add: bool):
+        with self._lock:
+            self._epoch += 1
+            entry = self._entries.get(blocker_id)
+            if entry is not None:
+                self._store(blocker_id, entry | {blocked_id} if add else entry - {blocked_id})
+
+        publish_from_any_thread(
+            self.bus, self.loop, BLOCK_INDEX_CHANNEL,
+            {"blocker_id": blocker_id, "origin": self.instance_id}
+        )
+
+    async def _on_remote_change(self, event: dict):
+        if event.get("origin") == self.instance_id:
+            return
+        with self._lock:
+            self._epoch += 1
+            self._entries.pop(event["blocker_id"], None)
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики индекса (для /system/metrics)."""
+        with self._lock:
+            return {**self.stats_counters, "size": len(self._entries)}
+
+
+# Глобальный экземпляр индекса
+block_index = BlockIndex(capacity=settings.BLOCK_INDEX_SIZE)
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Optional
+
+from sqlalchemy.orm import Session
+
+from app.db import models
+from app.core.config import settings
+from app.services.event_bus import publish_from_any_thread
+
+logger = logging.getLogger(__name__)
+
+# Канал шины для сброса кэша на всех воркерах
+CHAT_CACHE_CHANNEL = "dialect:chat-cache"
+
+
+class ChatMeta:
+    """Закэшированные данные чата: тип, владелец и участники."""
+
+    __slots__ = ("chat_id", "chat_type", "owner_id", "participant_ids")
+
+    def __init__(self, chat_id: int, chat_type: models.ChatTypeEnum, owner_id: Optional[int],
+                 participant_ids: FrozenSet[int]):
+        self.chat_id = chat_id
+        self.chat_type = chat_type
+        self.owner_id = owner_id
+        self.participant_ids = participant_ids
+
+
+class ChatCache:
+    """
+    LRU-кэш состава чатов (chat_id -> ChatMeta).
+
+    На горячем пути (new_message, read, edit, delete, pin) список участников
+    берется отсюда, а не из chat_participants. Кэш сбрасывается явно из
+    chat_service при любом изменении состава, в том числе на других воркерах
+    через шину событий.
+
+    Методы вызываются из пула потоков БД, поэтому все под блокировкой.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._entries: "OrderedDict[int, ChatMeta]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Растет при каждом сбросе: загрузка, начатая до сброса, не попадет в кэш
+        self._epoch = 0
+        self.bus = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.instance_id = uuid.uuid4().hex
+        self.stats_counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    async def start(self, bus=None):
+        """Подписывается на сбросы с других воркеров (вызывается в lifespan)."""
+        self.loop = asyncio.get_running_loop()
+        self.bus = bus
+        if bus is not None:
+            await bus.subscribe(CHAT_CACHE_CHANNEL, self._on_remote_invalidate)
+
+    def get(self, db: Session, chat_id: int) -> Optional[ChatMeta]:
+        """Данные чата из кэша, при промахе - одним запросом из БД. None - чата нет."""
+        with self._lock:
+            meta = self._entries.get(chat_id)
+            if meta is not None:
+                self._entries.move_to_end(chat_id)
+                self.stats_counters["hits"] += 1
+                return meta
+            self.stats_counters["misses"] += 1
+            epoch = self._epoch
+
+        meta = self._load(db, chat_id)
+        if meta is None:
+            return None
+
+        with self._lock:
+            if epoch == self._epoch:
+                self._entries[chat_id] = meta
+                self._entries.move_to_end(chat_id)
+                while len(self._entries) > self.capacity:
+                    self._entries.popitem(last=False)
+                    self.stats_counters["evictions"] += 1
+        return meta
+
+    def _load(self, db: Session, chat_id: int) -> Optional[ChatMeta]:
+        rows = db.query(
+            models.Chat.chat_type, models.Chat.owner_id, models.ChatParticipant.user_id
+        ).outerjoin(
+            models.ChatParticipant, models.ChatParticipant.chat_id == models.Chat.id
+        ).filter(models.Chat.id == chat_id).all()
+
+        if not rows:
+            return None
+        chat_type, owner_id = rows[0][0], rows[0][1]
+        participants = frozenset(r[2] for r in rows if r[2] is not None)
+        return ChatMeta(chat_id, chat_type, owner_id, participants)
+
+    def _drop(self, chat_id: int):
+        with self._lock:
+            self._epoch += 1
+            self._entries.pop(chat_id, None)
+            self.stats_counters["invalidations"] += 1
+
+    def invalidate(self, chat_id: int):
+        """
+        Сбрасывает чат в кэше этого и всех остальных воркеров.
+        Вызывать после commit изменения состава чата.
+        """
+        self._drop(chat_id)
+        publish_from_any_thread(
+            self.bus, self.loop, CHAT_CACHE_CHANNEL, {"chat_id": chat_id, "origin": self.instance_id}
+        )
+
+    async def _on_remote_invalidate(self, event: dict):
+        if event.get("origin") != self.instance_id:
+            self._drop(event["chat_id"])
+
+    def stats(self) -> Dict[str, float]:
+        """Счетчики кэша (для /system/metrics)."""
+        with self._lock:
+            lookups = self.stats_counters["hits"] + self.stats_counters["misses"]
+            return {
+                **self.stats_counters,
+                "size": len(self._entries),
+                "hit_rate": round(self.stats_counters["hits"] / lookups, 4) if lookups else 0.0,
+            }
+
+
+# Глобальный экземпляр кэша
+chat_cache = ChatCache(capacity=settings.CHAT_CACHE_SIZE)
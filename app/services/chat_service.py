@@ -1,7 +1,7 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 from fastapi import HTTPException, status, UploadFile
-from sqlalchemy import func
-from typing import List
+from sqlalchemy import func, select
+from typing import List, Optional, Tuple
 from PIL import Image, UnidentifiedImageError
 import shutil
 import uuid
@@ -9,7 +9,9 @@ import os
 import datetime
 
 from app.db import models, schemas
-from app.services import user_service
+from app.services import message_service, user_service
+from app.services.block_index import block_index
+from app.services.chat_cache import chat_cache
 
 # --- ВАЛИДАТОР (Дублируем или импортируем, если бы был utils.py) ---
 MAX_FILE_SIZE = 5 * 1024 * 1024
@@ -80,6 +82,7 @@ def create_private_chat(db: Session, creator: models.User, target_user_id: int)
     db.add(models.ChatParticipant(user_id=target_user.id, chat_id=db_chat.id))
     
     db.commit()
+    chat_cache.invalidate(db_chat.id)
     db.refresh(db_chat)
     return db_chat
 
@@ -102,6 +105,7 @@ def create_group_chat(db: Session, creator: models.User, group_data: schemas.Cha
         db.add(models.ChatParticipant(user_id=uid, chat_id=db_chat.id))
     
     db.commit()
+    chat_cache.invalidate(db_chat.id)
     db.refresh(db_chat)
     return db_chat
 
@@ -160,10 +164,70 @@ def delete_chat_avatar(db: Session, chat_id: int, user_id: int) -> models.Chat:
     db.commit()
     return chat
 
-def get_user_chats(db: Session, user_id: int) -> List[models.Chat]:
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    if not user: raise HTTPException(404, "User not found")
-    return [link.chat for link in user.chat_links]
+def get_user_chats(
+    db: Session, user_id: int, limit: int = 50, offset: int = 0
+) -> List[Tuple[models.Chat, Optional[models.Message], int, bool]]:
+    """
+    Список чатов пользователя: [(чат, последнее сообщение, непрочитанные,
+    собеседник в черном списке)], от самых свежих к старым (по последнему
+    сообщению, пустые - по созданию).
+
+    Число запросов не зависит от количества чатов:
+    1) страница чатов вместе с последним сообщением (MAX(id) по индексу chat_id, id);
+    2) участники и их профили для страницы (selectinload, 2 запроса);
+    Непрочитанные берутся из счетчика unread_count участника, статус
+    последнего сообщения - из водяных знаков уже загруженных участников,
+    блокировки - из block_index (один список на всю страницу).
+    """
+    Participant, Message, Chat = models.ChatParticipant, models.Message, models.Chat
+
+    my_chat_ids = select(Participant.chat_id).where(Participant.user_id == user_id)
+    last_ids = (
+        select(Message.chat_id, func.max(Message.id).label("last_id"))
+        .where(Message.chat_id.in_(my_chat_ids))
+        .group_by(Message.chat_id)
+        .subquery()
+    )
+    page = (
+        db.query(Participant, Message)
+        .join(Chat, Chat.id == Participant.chat_id)
+        .outerjoin(last_ids, last_ids.c.chat_id == Participant.chat_id)
+        .outerjoin(Message, Message.id == last_ids.c.last_id)
+        .filter(Participant.user_id == user_id)
+        # sent_at с точностью до секунды: внутри секунды порядок задает id сообщения
+        .order_by(
+            func.coalesce(Message.sent_at, Chat.created_at).desc(),
+            func.coalesce(Message.id, 0).desc(),
+            Chat.id.desc()
+        )
+        .limit(limit).offset(offset)
+        .all()
+    )
+    if not page:
+        return []
+
+    chat_ids = [link.chat_id for link, _ in page]
+    chats = {
+        chat.id: chat for chat in db.query(Chat)
+        .options(selectinload(Chat.participant_links).selectinload(Participant.user))
+        .filter(Chat.id.in_(chat_ids))
+    }
+
+    blocked = block_index.blocked_by(db, user_id)
+    result = []
+    for link, last_message in page:
+        # Сообщения до очистки истории в превью не показываем
+        if last_message and link.last_cleared_at and last_message.sent_at <= link.last_cleared_at:
+            last_message = None
+        chat = chats[link.chat_id]
+        if last_message:
+            marks = [(p.user_id, p.last_read_message_id) for p in chat.participant_links]
+            message_service.set_read_status(db, [last_message], marks)
+        is_blocked = chat.chat_type == models.ChatTypeEnum.private and any(
+            p.user_id != user_id and p.user_id in blocked for p in chat.participant_links
+        )
+        result.append((chat, last_message, link.unread_count, is_blocked))
+    return result
 
 def add_user_to_chat(db: Session, chat_id: int, user_id: int, requester_id: int):
     chat = db.query(models.Chat).filter(models.Chat.id == chat_id).first()
@@ -181,6 +245,7 @@ def add_user_to_chat(db: Session, chat_id: int, user_id: int, requester_id: int)
         
     db.add(models.ChatParticipant(chat_id=chat_id, user_id=user_id))
     db.commit()
+    chat_cache.invalidate(chat_id)
     return True
 
 def remove_user_from_chat(db: Session, chat_id: int, user_id_to_remove: int, requester_id: int):
@@ -193,6 +258,7 @@ def remove_user_from_chat(db: Session, chat_id: int, user_id_to_remove: int, req
     if not part: raise HTTPException(404, "Not found")
     db.delete(part)
     db.commit()
+    chat_cache.invalidate(chat_id)
     return True
 
 def set_custom_nickname(db: Session, chat_id: int, target_user_id: int, nickname: str, requester_id: int):
@@ -229,15 +295,13 @@ def delete_chat(db: Session, chat_id: int, user_id: int, for_everyone: bool):
         part = db.query(models.ChatParticipant).filter_by(chat_id=chat_id, user_id=user_id).first()
         if part: db.delete(part)
     db.commit()
+    chat_cache.invalidate(chat_id)
     return True
 
 def clear_chat_history(db: Session, chat_id: int, user_id: int, for_everyone: bool):
     chat = db.query(models.Chat).filter(models.Chat.id == chat_id).first()
     if not chat: raise HTTPException(404, "Chat not found")
     
-    # Тут надо импортировать message_service внутри функции или в начале файла
-    from app.services import message_service 
-    
     if for_everyone:
         if chat.chat_type == models.ChatTypeEnum.group and chat.owner_id != user_id:
              raise HTTPException(403, "Owner only")
@@ -248,5 +312,6 @@ def clear_chat_history(db: Session, chat_id: int, user_id: int, for_everyone: bo
         part = db.query(models.ChatParticipant).filter_by(chat_id=chat_id, user_id=user_id).first()
         if not part: raise HTTPException(404, "Not member")
         part.last_cleared_at = func.now()
+        part.unread_count = 0
         db.commit()
     return True
\ No newline at end of file
@@ -1,35 +1,285 @@
-from typing import Dict, List
+import asyncio
+import logging
+import time
+import uuid
+from typing import Dict, Iterable, Optional, Set, Tuple
+
 from fastapi import WebSocket
 
+from app.core.snowflake import snowflake
+from app.services.event_bus import EventBus
+
+logger = logging.getLogger(__name__)
+
+# Максимум сообщений в очереди одного сокета. Если клиент не успевает
+# их забирать (плохая сеть), его соединение закрывается, а не тормозит остальных.
+SEND_QUEUE_SIZE = 256
+# Сколько секунд даем на отправку одного сообщения в сокет
+SEND_TIMEOUT = 10.0
+
+# --- Межворкерная доставка ---
+# Каналы шины: общий канал присутствия и персональный канал каждого воркера
+PRESENCE_CHANNEL = "dialect:presence"
+WORKER_CHANNEL_PREFIX = "dialect:worker:"
+# Как часто воркер рассылает полный список своих онлайн-пользователей
+PRESENCE_HEARTBEAT = 10.0
+# Через сколько секунд без heartbeat воркер считается умершим
+PRESENCE_TTL = 3 * PRESENCE_HEARTBEAT
+
+
+class ClientConnection:
+    """
+    Одно устройство пользователя.
+    У каждого сокета своя ограниченная очередь и своя задача-писатель,
+    поэтому отправка никогда не ждет медленного клиента.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.writer_task: Optional[asyncio.Task] = None
+        self.closed = False
+        self._close_sent = False
+
+    def enqueue(self, message: dict) -> bool:
+        """Кладет сообщение в очередь без ожидания. False - очередь переполнена."""
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def close(self, code: int = 1000):
+        """Закрывает сокет (если он еще жив)."""
+        self.closed = True
+        if self._close_sent:
+            return
+        self._close_sent = True
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
 class ConnectionManager:
     def __init__(self):
-        # Словарь: user_id -> WebSocket соединение
-        self.active_connections: Dict[int, WebSocket] = {}
+        # Словарь: user_id -> множество соединений (по одному на устройство)
+        self.active_connections: Dict[int, Set[ClientConnection]] = {}
+        # Сколько сообщений отброшено из-за медленных клиентов
+        self.dropped_messages = 0
+
+        # Идентификатор этого процесса в шине событий
+        self.worker_id = uuid.uuid4().hex
+        self.bus: Optional[EventBus] = None
+        # Присутствие на других воркерах: worker_id -> (время heartbeat, user_id)
+        self.remote_presence: Dict[str, Tuple[float, Set[int]]] = {}
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    # --- Шина событий ---
+
+    async def start(self, bus: EventBus):
+        """Подключает менеджер к шине событий (вызывается в lifespan)."""
+        self.bus = bus
+        await bus.subscribe(WORKER_CHANNEL_PREFIX + self.worker_id, self._on_worker_event)
+        await bus.subscribe(PRESENCE_CHANNEL, self._on_presence_event)
+        await bus.start()
+        # Просим остальные воркеры сразу прислать свое присутствие
+        await self._publish_presence("hello")
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        """Отключается от шины, сообщая остальным воркерам, что нас больше нет."""
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+        if self.bus:
+            await self._publish_presence("bye")
+            await self.bus.stop()
+            self.bus = None
+
+    async def _publish_presence(self, op: str, user_id: Optional[int] = None):
+        if self.bus is None:
+            return
+        event = {"op": op, "worker": self.worker_id}
+        if op in ("hello", "snapshot"):
+            event["users"] = list(self.active_connections.keys())
+        if user_id is not None:
+            event["user_id"] = user_id
+        await self.bus.publish(PRESENCE_CHANNEL, event)
+
+    def _publish_presence_soon(self, op: str, user_id: int):
+        """То же, что _publish_presence, но из синхронного кода."""
+        if self.bus is not None:
+            asyncio.create_task(self._publish_presence(op, user_id))
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT)
+            try:
+                await self._publish_presence("snapshot")
+            except Exception as e:
+                logger.error(f"Ошибка heartbeat присутствия: {e}")
 
-    async def connect(self, websocket: WebSocket, user_id: int):
-        """Принимает соединение и запоминает пользователя."""
+    async def _on_presence_event(self, event: dict):
+        worker = event.get("worker")
+        if not worker or worker == self.worker_id:
+            return
+
+        op = event.get("op")
+        if op == "bye":
+            self.remote_presence.pop(worker, None)
+            return
+        if op in ("hello", "snapshot"):
+            self.remote_presence[worker] = (time.monotonic(), set(event.get("users", [])))
+            if op == "hello":
+                # Новый воркер: отвечаем своим списком, не дожидаясь heartbeat
+                await self._publish_presence("snapshot")
+            return
+
+        _, users = self.remote_presence.setdefault(worker, (time.monotonic(), set()))
+        self.remote_presence[worker] = (time.monotonic(), users)
+        if op == "online":
+            users.add(event["user_id"])
+        elif op == "offline":
+            users.discard(event["user_id"])
+
+    async def _on_worker_event(self, event: dict):
+        """Событие от другого воркера для пользователей, подключенных к нам."""
+        message = event.get("message")
+        if message.get("type") == "new_message":
+            # Наши следующие id должны быть больше увиденного (порядок в чате)
+            snowflake.observe(message["id"])
+        for uid in event.get("user_ids", []):
+            self._deliver(message, uid)
+
+    def _live_remote_workers(self):
+        """Воркеры, от которых был heartbeat за последние PRESENCE_TTL секунд."""
+        deadline = time.monotonic() - PRESENCE_TTL
+        for worker, (seen_at, users) in list(self.remote_presence.items()):
+            if seen_at < deadline:
+                del self.remote_presence[worker]
+                continue
+            yield worker, users
+
+    async def connect(self, websocket: WebSocket, user_id: int) -> ClientConnection:
+        """Принимает соединение и запоминает устройство пользователя."""
         await websocket.accept()
-        self.active_connections[user_id] = websocket
+        connection = ClientConnection(websocket, user_id)
+        connection.writer_task = asyncio.create_task(self._writer(connection))
+        if user_id not in self.active_connections:
+            self.active_connections[user_id] = set()
+            await self._publish_presence("online", user_id)
+        self.active_connections[user_id].add(connection)
+        return connection
 
-    def disconnect(self, user_id: int):
-        """Удаляет пользователя из списка активных при разрыве."""
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
+    def disconnect(self, connection: ClientConnection):
+        """Удаляет устройство из списка активных при разрыве."""
+        connection.closed = True
+        connections = self.active_connections.get(connection.user_id)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del self.active_connections[connection.user_id]
+                self._publish_presence_soon("offline", connection.user_id)
+
+        if connection.writer_task and connection.writer_task is not asyncio.current_task():
+            connection.writer_task.cancel()
+
+    async def _writer(self, connection: ClientConnection):
+        """Задача-писатель: по одному забирает сообщения из очереди и шлет в сокет."""
+        try:
+            while True:
+                message = await connection.queue.get()
+                await asyncio.wait_for(connection.websocket.send_json(message), SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # Клиент умер или завис на отправке - отключаем только его
+            logger.info(f"Соединение пользователя {connection.user_id} закрыто при отправке: {e}")
+            self.disconnect(connection)
+            await connection.close(code=1011)
+
+    def _deliver(self, message: dict, user_id: int) -> bool:
+        """Раскладывает сообщение по очередям всех устройств пользователя."""
+        connections = self.active_connections.get(user_id)
+        if not connections:
+            return False
+
+        delivered = False
+        for connection in list(connections):
+            if connection.enqueue(message):
+                delivered = True
+            else:
+                # Очередь переполнена: клиент не успевает читать, сбрасываем его
+                self.dropped_messages += 1
+                logger.warning(f"Медленный клиент пользователя {user_id}: соединение сброшено")
+                self.disconnect(connection)
+                asyncio.create_task(connection.close(code=1013))
+        return delivered
 
-    async def send_personal_message(self, message: dict, user_id: int):
+    async def send_personal_message(self, message: dict, user_id: int) -> bool:
         """
-        Отправляет сообщение конкретному пользователю, если он онлайн.
+        Отправляет сообщение на все устройства пользователя, если он онлайн
+        (на этом воркере или на любом другом).
+        Не ждет самой отправки: сообщение уходит в очередь каждого сокета.
         """
+        return bool(await self.broadcast(message, [user_id]))
+
+    async def broadcast(self, message: dict, user_ids: Iterable[int]) -> Set[int]:
+        """
+        Рассылка одного события нескольким пользователям.
+        Локальные сокеты получают его сразу, остальным пользователям событие
+        уходит через шину только тем воркерам, где они подключены.
+        Возвращает множество user_id, которым сообщение было отправлено.
+        """
+        delivered = set()
+        remaining = set()
+        for uid in user_ids:
+            if self._deliver(message, uid):
+                delivered.add(uid)
+            else:
+                remaining.add(uid)
+
+        if remaining and self.bus is not None:
+            for worker, users in self._live_remote_workers():
+                targets = remaining & users
+                # Не ушло через шину - не доставлено: таким получателям нужен пуш
+                if targets and await self.bus.publish(
+                    WORKER_CHANNEL_PREFIX + worker,
+                    {"user_ids": list(targets), "message": message}
+                ):
+                    delivered |= targets
+        return delivered
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики соединений этого воркера (для /system/metrics)."""
+        return {
+            "users": len(self.active_connections),
+            "sockets": sum(len(c) for c in list(self.active_connections.values())),
+            "remote_workers": len(self.remote_presence),
+            "dropped_messages": self.dropped_messages,
+        }
+
+    def is_user_online(self, user_id: int) -> bool:
+        """Проверяет, подключен ли пользователь (к любому воркеру)."""
         if user_id in self.active_connections:
-            connection = self.active_connections[user_id]
-            # Отправляем JSON данные
-            await connection.send_json(message)
             return True
-        return False
-    
-    def is_user_online(self, user_id: int) -> bool:
-        """Проверяет, подключен ли пользователь."""
-        return user_id in self.active_connections
+        return any(user_id in users for _, users in self._live_remote_workers())
+
+    def online_users(self, user_ids: Iterable[int]) -> Set[int]:
+        """Кто из user_ids онлайн: один проход по воркерам на всю пачку."""
+        remaining = set(user_ids)
+        online = {uid for uid in remaining if uid in self.active_connections}
+        remaining -= online
+        for _, users in self._live_remote_workers():
+            if not remaining:
+                break
+            found = remaining & users
+            online |= found
+            remaining -= found
+        return online
 
 # Создаем глобальный экземпляр менеджера
-manager = ConnectionManager()
\ No newline at end of file
+manager = ConnectionManager()
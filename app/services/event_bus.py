@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Обработчик события: получает уже разобранный dict
+Handler = Callable[[dict], Awaitable[None]]
+
+# Пауза перед переподключением к Redis после обрыва
+RECONNECT_DELAY = 1.0
+
+
+class EventBus:
+    """
+    Базовый интерфейс шины событий (pub/sub) между воркерами.
+    ConnectionManager работает только через эти методы и не знает,
+    что находится внутри: память процесса или Redis.
+    """
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, channel: str, message: dict) -> bool:
+        """Публикует событие. False - событие не ушло (получатели его не увидят)."""
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str, handler: Handler):
+        raise NotImplementedError
+
+
+class InMemoryEventBus(EventBus):
+    """
+    Шина внутри одного процесса.
+    Подходит для запуска с одним воркером (и для локальной разработки).
+    """
+
+    def __init__(self):
+        self.handlers: Dict[str, List[Handler]] = {}
+
+    async def publish(self, channel: str, message: dict) -> bool:
+        for handler in list(self.handlers.get(channel, [])):
+            try:
+                await handler(message)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика канала {channel}: {e}")
+        return True
+
+    async def subscribe(self, channel: str, handler: Handler):
+        self.handlers.setdefault(channel, []).append(handler)
+
+
+# --- Redis (RESP) ---
+
+class RedisReplyError(Exception):
+    """Ответ сервера "-ERR ...": команда не выполнена, соединение при этом живо."""
+
+
+def _encode_command(*args) -> bytes:
+    """Кодирует команду в протокол RESP: массив bulk-строк."""
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        parts.append(f"${len(arg)}\r\n".encode())
+        parts.append(arg + b"\r\n")
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    """Читает один ответ RESP (строка, число, bulk, массив или ошибка)."""
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Redis закрыл соединение")
+
+    prefix, payload = line[:1], line[1:-2]
+    if prefix == b"+":
+        return payload.decode()
+    if prefix == b"-":
+        raise RedisReplyError(f"Redis error: {payload.decode()}")
+    if prefix == b":":
+        return int(payload)
+    if prefix == b"$":
+        length = int(payload)
+        if length == -1:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if prefix == b"*":
+        length = int(payload)
+        if length == -1:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Неизвестный ответ Redis: {line!r}")
+
+
+class RedisEventBus(EventBus):
+    """
+    Шина поверх Redis Pub/Sub (или любого сервера, говорящего на RESP).
+    Держит два соединения: одно для PUBLISH, второе для SUBSCRIBE,
+    и переподписывается после обрыва связи.
+    """
+
+    def __init__(self, url: str):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+
+        self.handlers: Dict[str, List[Handler]] = {}
+        self._pub_reader: Optional[asyncio.StreamReader] = None
+        self._pub_writer: Optional[asyncio.StreamWriter] = None
+        self._pub_lock = asyncio.Lock()
+        self._sub_writer: Optional[asyncio.StreamWriter] = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def _open(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(_encode_command("AUTH", self.password))
+            await writer.drain()
+            await _read_reply(reader)
+        return reader, writer
+
+    async def start(self):
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._listener:
+            self._listener.cancel()
+        for writer in (self._pub_writer, self._sub_writer):
+            if writer:
+                writer.close()
+        self._pub_writer = self._sub_writer = None
+
+    async def publish(self, channel: str, message: dict) -> bool:
+        payload = json.dumps(message)
+        async with self._pub_lock:
+            for attempt in range(2):
+                try:
+                    if self._pub_writer is None:
+                        self._pub_reader, self._pub_writer = await self._open()
+                    self._pub_writer.write(_encode_command("PUBLISH", channel, payload))
+                    await self._pub_writer.drain()
+                    await _read_reply(self._pub_reader)
+                    return True
+                except RedisReplyError as e:
+                    # Сервер отказал (OOM, READONLY, ...): повтор не поможет
+                    logger.error(f"Не удалось опубликовать событие в {channel}: {e}")
+                    return False
+                except (ConnectionError, OSError) as e:
+                    # Одна попытка переподключения, дальше - ошибка в лог
+                    self._pub_writer = None
+                    if attempt:
+                        logger.error(f"Не удалось опубликовать событие в {channel}: {e}")
+        return False
+
+    async def subscribe(self, channel: str, handler: Handler):
+        is_new = channel not in self.handlers
+        self.handlers.setdefault(channel, []).append(handler)
+        if is_new and self._sub_writer is not None:
+            self._sub_writer.write(_encode_command("SUBSCRIBE", channel))
+            await self._sub_writer.drain()
+
+    async def _listen(self):
+        """Фоновая задача: читает сообщения подписки и раздает обработчикам."""
+        while True:
+            try:
+                reader, writer = await self._open()
+                self._sub_writer = writer
+                if self.handlers:
+                    writer.write(_encode_command("SUBSCRIBE", *self.handlers.keys()))
+                    await writer.drain()
+
+                while True:
+                    reply = await _read_reply(reader)
+                    if not isinstance(reply, list) or len(reply) != 3 or reply[0] != b"message":
+                        continue  # подтверждения subscribe и т.п.
+                    channel = reply[1].decode()
+                    message = json.loads(reply[2])
+                    for handler in list(self.handlers.get(channel, [])):
+                        try:
+                            await handler(message)
+                        except Exception as e:
+                            logger.error(f"Ошибка обработчика канала {channel}: {e}")
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Соединение с шиной событий потеряно: {e}. Переподключение...")
+                self._sub_writer = None
+                await asyncio.sleep(RECONNECT_DELAY)
+
+
+def publish_from_any_thread(bus: Optional[EventBus], loop: Optional[asyncio.AbstractEventLoop],
+                            channel: str, message: dict):
+    """
+    Публикует событие без ожидания из любого контекста: из event loop
+    или из потока (sync-эндпоинт FastAPI, пул потоков БД).
+    Если шина еще не подключена, ничего не делает.
+    """
+    if bus is None or loop is None:
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        loop.create_task(bus.publish(channel, message))
+    else:
+        asyncio.run_coroutine_threadsafe(bus.publish(channel, message), loop)
+
+
+def create_event_bus(url: str) -> EventBus:
+    """
+    Создает шину по URL из настроек:
+    - memory://            -> InMemoryEventBus (один процесс)
+    - redis://host:port    -> RedisEventBus
+    """
+    scheme = urlparse(url).scheme
+    if scheme == "redis":
+        return RedisEventBus(url)
+    if scheme in ("", "memory"):
+        return InMemoryEventBus()
+    raise ValueError(f"Неизвестный тип шины событий: {url}")
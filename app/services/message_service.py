@@ -1,10 +1,17 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import update, and_, func
-from typing import List
+from sqlalchemy import update, insert, select, and_, or_, func
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
+import time
 from fastapi import HTTPException, status
 
 from app.db import models, schemas
 from app.services import user_service
+from app.services.chat_cache import chat_cache
+from app.core.snowflake import snowflake, id_to_datetime, max_id_until
+
+# На сколько секунд id в событии read может опережать часы воркера
+READ_ID_CLOCK_SKEW = 5
 
 def check_is_participant(db: Session, chat_id: int, user_id: int):
     participant = db.query(models.ChatParticipant).filter(
@@ -15,110 +22,233 @@ def check_is_participant(db: Session, chat_id: int, user_id: int):
         raise HTTPException(status.HTTP_403_FORBIDDEN, "Вы не участник")
     return participant
 
-def create_message(
-    db: Session, 
-    sender_id: int, 
-    msg_data: schemas.MessageCreate
-) -> models.Message:
-    # 1. Проверка участия
-    participant = check_is_participant(db, msg_data.chat_id, sender_id)
+def ensure_participant(db: Session, chat_id: int, user_id: int):
+    """
+    То же, что check_is_participant, но по кэшу состава чата (без запроса к БД).
+    Возвращает ChatMeta, если строка участника не нужна.
+    """
+    meta = chat_cache.get(db, chat_id)
+    if meta is None or user_id not in meta.participant_ids:
+        raise HTTPException(status.HTTP_403_FORBIDDEN, "Вы не участник")
+    return meta
+
+def authorize_send(db: Session, chat_id: int, sender_id: int):
+    """
+    Может ли sender_id писать в чат: участник ли он и не в ЧС ли у собеседника.
+    Тип и состав чата берутся из кэша, поэтому для групп это ноль запросов,
+    для ЛС - только проверка блокировки.
+    """
+    # 1. Проверка участия (тип чата и состав берем из кэша)
+    chat = ensure_participant(db, chat_id, sender_id)
     
     # 2. Проверка ЧС (Для ЛС)
-    chat = db.query(models.Chat).filter(models.Chat.id == msg_data.chat_id).first()
     if chat.chat_type == models.ChatTypeEnum.private:
         # Ищем собеседника
-        other_participant = db.query(models.ChatParticipant).filter(
-            models.ChatParticipant.chat_id == msg_data.chat_id,
-            models.ChatParticipant.user_id != sender_id
-        ).first()
+        other_id = next((uid for uid in chat.participant_ids if uid != sender_id), None)
         
-        if other_participant:
+        if other_id is not None:
             # Проверяем: "Заблокировал ли СОБЕСЕДНИК (other) МЕНЯ (sender)?"
-            if user_service.is_blocked(db, blocker_id=other_participant.user_id, target_id=sender_id):
+            if user_service.is_blocked(db, blocker_id=other_id, target_id=sender_id):
                 raise HTTPException(status.HTTP_403_FORBIDDEN, "Вы находитесь в черном списке этого пользователя")
+    return chat
 
-    # 3. Создаем запись
-    db_msg = models.Message(
+def prepare_message(db: Session, sender_id: int, msg_data: schemas.MessageCreate) -> dict:
+    """
+    Проверяет право на отправку и готовит значения строки messages.
+    id (Snowflake) и sent_at назначаются здесь же, в процессе: сообщение
+    можно рассылать, не дожидаясь INSERT, и перечитывать строку не нужно.
+    """
+    authorize_send(db, msg_data.chat_id, sender_id)
+    message_id = snowflake.next_id()
+    return dict(
+        id=message_id,
         chat_id=msg_data.chat_id,
         sender_id=sender_id,
         content=msg_data.content,
         message_type=msg_data.message_type,
-        status=models.MessageStatusEnum.sent
+        sent_at=id_to_datetime(message_id).replace(microsecond=0), # точность TIMESTAMP
+        status=models.MessageStatusEnum.sent,
+        is_pinned=False
     )
-    
-    db.add(db_msg)
+
+def unread_count_query(chat_id, user_id, after_id, cleared_at=None):
+    """
+    Подзапрос: сколько в чате чужих сообщений новее after_id (и новее очистки
+    истории cleared_at). Аргументы - значения или колонки chat_participants
+    (тогда подзапрос коррелирует со строкой участника в UPDATE).
+    """
+    query = select(func.count(models.Message.id)).where(
+        models.Message.chat_id == chat_id,
+        models.Message.id > func.coalesce(after_id, 0),
+        models.Message.sender_id != user_id
+    )
+    if cleared_at is not None:
+        query = query.where(or_(cleared_at.is_(None), models.Message.sent_at > cleared_at))
+    return query.scalar_subquery()
+
+def insert_messages(db: Session, rows: List[dict]):
+    """
+    Вставляет готовые сообщения (с id) одним INSERT и в той же транзакции
+    увеличивает unread_count остальным участникам чата.
+
+    Сообщение рассылается до INSERT, поэтому получатель мог уже прочитать его
+    (водяной знак >= id): такие сообщения в счетчик не попадают.
+    """
+    db.execute(insert(models.Message), rows)
+
+    per_sender: Dict[Tuple[int, int], List[int]] = {}
+    for row in rows:
+        per_sender.setdefault((row["chat_id"], row["sender_id"]), []).append(row["id"])
+    for (chat_id, sender_id), ids in per_sender.items():
+        watermark = func.coalesce(models.ChatParticipant.last_read_message_id, 0)
+        if len(ids) == 1:
+            statement = update(models.ChatParticipant).where(watermark < ids[0]).values(
+                unread_count=models.ChatParticipant.unread_count + 1
+            )
+        else:
+            # Из пачки считаем только то, что новее водяного знака участника
+            unread = select(func.count(models.Message.id)).where(
+                models.Message.id.in_(ids), models.Message.id > watermark
+            ).scalar_subquery()
+            statement = update(models.ChatParticipant).where(watermark < max(ids)).values(
+                unread_count=models.ChatParticipant.unread_count + unread
+            )
+        db.execute(statement.where(
+            models.ChatParticipant.chat_id == chat_id, models.ChatParticipant.user_id != sender_id
+        ))
     db.commit()
-    db.refresh(db_msg)
-    return db_msg
 
-def get_chat_history(db: Session, chat_id: int, user_id: int, limit: int = 50, offset: int = 0) -> List[models.Message]:
+def create_message(
+    db: Session, 
+    sender_id: int, 
+    msg_data: schemas.MessageCreate
+) -> models.Message:
+    values = prepare_message(db, sender_id, msg_data)
+    insert_messages(db, [values])
+
+    # Объект вне сессии: обращение к полям не вызывает запросов
+    return models.Message(**values)
+
+def get_chat_history(
+    db: Session, chat_id: int, user_id: int, limit: int = 50, offset: int = 0,
+    before_id: Optional[int] = None, after_id: Optional[int] = None
+) -> List[models.Message]:
+    """
+    История чата, от новых к старым.
+
+    Пагинация курсором по индексу (chat_id, id), скорость не зависит от глубины:
+    - before_id: сообщения старше этого id (листаем вверх);
+    - after_id: сообщения новее этого id (догружаем пропущенное).
+    Без курсоров работает старый режим limit/offset.
+    """
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Укажите только один курсор: before_id или after_id")
     participant = check_is_participant(db, chat_id, user_id)
     query = db.query(models.Message).filter(models.Message.chat_id == chat_id)
     if participant.last_cleared_at:
         query = query.filter(models.Message.sent_at > participant.last_cleared_at)
-    return query.order_by(models.Message.sent_at.desc()).limit(limit).offset(offset).all()
+
+    if before_id is not None:
+        query = query.filter(models.Message.id < before_id)
+    elif after_id is not None:
+        # Берем ближайшие к курсору по возрастанию и разворачиваем
+        newer = query.filter(models.Message.id > after_id).order_by(models.Message.id.asc()).limit(limit).all()
+        return apply_read_status(db, chat_id, newer[::-1])
+
+    query = query.order_by(models.Message.id.desc()).limit(limit)
+    if before_id is None and offset:
+        query = query.offset(offset)
+    return apply_read_status(db, chat_id, query.all())
 
 def get_chat_participants(db: Session, chat_id: int) -> List[int]:
-    parts = db.query(models.ChatParticipant.user_id).filter(models.ChatParticipant.chat_id == chat_id).all()
-    return [p[0] for p in parts]
+    meta = chat_cache.get(db, chat_id)
+    return list(meta.participant_ids) if meta else []
+
+def get_read_watermarks(db: Session, chat_id: int) -> List[tuple]:
+    """(user_id, last_read_message_id, last_read_at) всех участников чата."""
+    return db.query(
+        models.ChatParticipant.user_id,
+        models.ChatParticipant.last_read_message_id,
+        models.ChatParticipant.last_read_at
+    ).filter(models.ChatParticipant.chat_id == chat_id).all()
+
+def apply_read_status(db: Session, chat_id: int, messages: List[models.Message]) -> List[models.Message]:
+    """
+    Проставляет status=read по водяным знакам: сообщение прочитано,
+    если его прочитал хоть кто-то, кроме отправителя. Один запрос на страницу.
+    Объекты отсоединяются от сессии, чтобы смена статуса не ушла в БД.
+    """
+    if not messages:
+        return messages
+    marks = [(uid, mark) for uid, mark, _ in get_read_watermarks(db, chat_id)]
+    return set_read_status(db, messages, marks)
+
+def set_read_status(db: Session, messages: List[models.Message], marks: List[tuple]) -> List[models.Message]:
+    """То же по уже загруженным водяным знакам [(user_id, last_read_message_id)]."""
+    marks = [(uid, mark or 0) for uid, mark in marks]
+    for message in messages:
+        db.expunge(message)
+        if any(mark >= message.id for uid, mark in marks if uid != message.sender_id):
+            message.status = models.MessageStatusEnum.read
+    return messages
+
+def read_id_ceiling() -> int:
+    """
+    Наибольший message_id, который клиент может честно прочитать сейчас.
+    Сообщение рассылается до INSERT, поэтому существование в БД не проверяем,
+    но id из будущего (дальше READ_ID_CLOCK_SKEW) - нет: такой знак пометил бы
+    прочитанными все будущие сообщения чата.
+    """
+    return max_id_until(time.time() + READ_ID_CLOCK_SKEW)
 
-# ⭐ ОБНОВЛЕННАЯ ФУНКЦИЯ ПРОЧТЕНИЯ
 def mark_messages_as_read(db: Session, chat_id: int, user_id: int, last_message_id: int):
     """
-    Помечает сообщения как прочитанные:
-    1. Находит все сообщения в чате <= last_message_id, которые еще не прочитаны этим юзером.
-    2. Добавляет записи в message_reads.
-    3. Обновляет last_read_message_id в chat_participants (для оптимизации).
+    Сдвигает водяной знак прочтения участника до last_message_id.
+
+    Один UPDATE независимо от числа непрочитанных: строки в message_reads
+    больше не пишутся, статус сообщений вычисляется при чтении.
+    Знак только растет - старое событие read его не откатит.
+    unread_count пересчитывается от нового знака (обычно это 0 строк).
+    id больше read_id_ceiling() и последнего сообщения чата урезается до них.
     """
-    participant = check_is_participant(db, chat_id, user_id)
-    
-    # 1. Оптимизация: берем только сообщения новее, чем то, что мы читали в последний раз
-    last_read_id = participant.last_read_message_id or 0
-    
-    if last_message_id <= last_read_id:
-        return # Уже всё прочитано
+    ensure_participant(db, chat_id, user_id)
+    ceiling = read_id_ceiling()
+    if last_message_id > ceiling:
+        # Сообщения с другого воркера могут опережать наши часы: их id тоже допустимы
+        last_id = db.query(func.max(models.Message.id)).filter(models.Message.chat_id == chat_id).scalar()
+        last_message_id = min(last_message_id, max(ceiling, last_id or 0))
 
-    # 2. Находим ID сообщений, которые нужно пометить
-    # (Чужие сообщения, ID > последнего прочитанного и <= текущего)
-    unread_messages = db.query(models.Message.id).filter(
-        models.Message.chat_id == chat_id,
-        models.Message.id > last_read_id,
-        models.Message.id <= last_message_id,
-        models.Message.sender_id != user_id # Свои читать не надо
-    ).all()
-    
-    # 3. Массовая вставка в message_reads
-    if unread_messages:
-        new_reads = [
-            models.MessageRead(message_id=msg[0], user_id=user_id) 
-            for msg in unread_messages
-        ]
-        db.add_all(new_reads)
-        
-        # 4. Обновляем статус самих сообщений на 'read' (для совместимости)
-        # Это упрощение: ставим read, если хоть кто-то прочитал. 
-        msg_ids = [m[0] for m in unread_messages]
-        db.execute(
-            update(models.Message)
-            .where(models.Message.id.in_(msg_ids))
-            .values(status=models.MessageStatusEnum.read)
+    db.execute(
+        update(models.ChatParticipant)
+        .where(
+            models.ChatParticipant.chat_id == chat_id,
+            models.ChatParticipant.user_id == user_id,
+            func.coalesce(models.ChatParticipant.last_read_message_id, 0) < last_message_id
         )
-
-    # 5. Обновляем "курсор" прочтения у участника
-    participant.last_read_message_id = last_message_id
+        .values(
+            last_read_message_id=last_message_id,
+            last_read_at=datetime.utcnow().replace(microsecond=0),
+            unread_count=unread_count_query(
+                chat_id, user_id, last_message_id, models.ChatParticipant.last_cleared_at
+            )
+        )
+    )
     db.commit()
 
-def get_message_read_details(db: Session, message_id: int, user_id: int) -> List[models.MessageRead]:
-    """Получить список всех, кто прочитал сообщение."""
+def get_message_read_details(db: Session, message_id: int, user_id: int) -> List[dict]:
+    """Получить список всех, кто прочитал сообщение (по водяным знакам участников)."""
     message = db.query(models.Message).filter(models.Message.id == message_id).first()
     if not message: return []
     
     # Проверяем доступ к чату
-    check_is_participant(db, message.chat_id, user_id)
+    ensure_participant(db, message.chat_id, user_id)
     
-    return db.query(models.MessageRead).filter(
-        models.MessageRead.message_id == message_id
-    ).all()
+    return [
+        # Для перенесенных данных без времени прочтения берем время отправки
+        {"user_id": uid, "read_at": read_at or message.sent_at}
+        for uid, mark, read_at in get_read_watermarks(db, message.chat_id)
+        if uid != message.sender_id and (mark or 0) >= message.id
+    ]
 
 def update_message(db: Session, message_id: int, user_id: int, new_content: bytes):
     message = db.query(models.Message).filter(models.Message.id == message_id).first()
@@ -133,9 +263,25 @@ def delete_message(db: Session, message_id: int, user_id: int):
     message = db.query(models.Message).filter(models.Message.id == message_id).first()
     if not message: return None
     is_author = (message.sender_id == user_id)
-    chat = db.query(models.Chat).filter(models.Chat.id == message.chat_id).first()
+    chat = chat_cache.get(db, message.chat_id)
     is_owner = (chat and chat.owner_id == user_id)
     if is_author or is_owner:
+        # Тем, кто еще не прочитал сообщение, уменьшаем счетчик. Условия те же,
+        # что в unread_count_query: после очистки истории сообщение не считалось
+        db.execute(
+            update(models.ChatParticipant)
+            .where(
+                models.ChatParticipant.chat_id == message.chat_id,
+                models.ChatParticipant.user_id != message.sender_id,
+                func.coalesce(models.ChatParticipant.last_read_message_id, 0) < message.id,
+                or_(
+                    models.ChatParticipant.last_cleared_at.is_(None),
+                    models.ChatParticipant.last_cleared_at < message.sent_at
+                ),
+                models.ChatParticipant.unread_count > 0
+            )
+            .values(unread_count=models.ChatParticipant.unread_count - 1)
+        )
         db.delete(message)
         db.commit()
         return True
@@ -144,11 +290,18 @@ def delete_message(db: Session, message_id: int, user_id: int):
 def pin_message(db: Session, message_id: int, user_id: int, is_pinned: bool):
     message = db.query(models.Message).filter(models.Message.id == message_id).first()
     if not message: return None
-    check_is_participant(db, message.chat_id, user_id)
+    ensure_participant(db, message.chat_id, user_id)
     message.is_pinned = is_pinned
     db.commit()
     return True
 
 def delete_all_messages_in_chat(db: Session, chat_id: int):
     db.query(models.Message).filter(models.Message.chat_id == chat_id).delete()
-    db.commit()
\ No newline at end of file
+    db.query(models.ChatParticipant).filter(models.ChatParticipant.chat_id == chat_id).update({"unread_count": 0})
+    db.commit()
+
+def get_total_unread(db: Session, user_id: int) -> int:
+    """Сумма непрочитанных по всем чатам (для бейджа): O(число чатов)."""
+    return db.query(func.coalesce(func.sum(models.ChatParticipant.unread_count), 0)).filter(
+        models.ChatParticipant.user_id == user_id
+    ).scalar()
\ No newline at end of file
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+from app.db import database
+from app.core.config import settings
+from app.services import message_service
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBuffer:
+    """
+    Group commit для новых сообщений (включается MESSAGE_BATCH_WINDOW_MS > 0).
+
+    Сообщения от разных отправителей копятся в очереди не дольше window
+    и не больше max_batch штук, затем пишутся одним многострочным INSERT
+    и одним commit. Так на пачку приходится один fsync, а не на сообщение.
+
+    Надежность такая же, как без буфера: write() завершается только после
+    успешного commit, иначе бросает ошибку записи. Пачка пишется атомарно;
+    если она не записалась, строки повторяются по одной, и ошибка достается
+    только "плохому" сообщению. Цена - до window мс задержки подтверждения
+    (рассылка участникам ее не ждет, id назначаются заранее).
+    """
+
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"batches": 0, "messages": 0, "max_batch": 0, "fallbacks": 0, "failed": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        """Запускает писателя (вызывается в lifespan), если буфер включен."""
+        if self.window > 0 and self._task is None:
+            # Ограниченная очередь: при перегрузке БД отправители ждут, а не копят память
+            self._queue = asyncio.Queue(maxsize=self.max_batch * 10)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дописывает все, что уже в очереди, и останавливает писателя."""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        self._task = None
+
+    async def write(self, values: dict):
+        """Ставит сообщение (с готовым id) в пачку и ждет commit."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((values, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                logger.error(f"Ошибка пакетной записи сообщений: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch: List[Tuple[dict, asyncio.Future]]):
+        rows = [values for values, _ in batch]
+        try:
+            await database.run_in_session(message_service.insert_messages, rows)
+        except Exception as e:
+            # Транзакция откатилась целиком: пишем по одному, чтобы не терять соседей
+            self.stats["fallbacks"] += 1
+            logger.warning(f"Пачка из {len(batch)} сообщений не записалась ({e}), пишем по одному")
+            await asyncio.gather(*(self._write_one(values, future) for values, future in batch))
+            return
+
+        self.stats["batches"] += 1
+        self.stats["messages"] += len(batch)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def _write_one(self, values: dict, future: asyncio.Future):
+        try:
+            await database.run_in_session(message_service.insert_messages, [values])
+        except Exception as e:
+            self.stats["failed"] += 1
+            if not future.done():
+                future.set_exception(e)
+            return
+        self.stats["messages"] += 1
+        if not future.done():
+            future.set_result(None)
+
+
+# Глобальный экземпляр
+message_writer = MessageWriteBuffer(
+    window_ms=settings.MESSAGE_BATCH_WINDOW_MS,
+    max_batch=settings.MESSAGE_BATCH_MAX_SIZE
+)
@@ -1,12 +1,28 @@
 import firebase_admin
 from firebase_admin import messaging, credentials
 from sqlalchemy.orm import Session
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+import asyncio
+import json
 import logging
+import time
 
-from app.db import models
+from app.db import models, database
+from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
+# --- Настройки диспетчера пушей ---
+# FCM принимает не больше 500 токенов в одном multicast-запросе
+FCM_MULTICAST_LIMIT = 500
+# Сколько ждем новые задачи, прежде чем отправить пачку (секунды)
+PUSH_BATCH_WINDOW = 0.05
+# Максимум задач в очереди; при переполнении новые пуши отбрасываются
+PUSH_QUEUE_SIZE = 10_000
+# Потоков для одновременных запросов к FCM
+PUSH_WORKERS = 4
+
 # Инициализация Firebase (будет вызвана в main.py)
 # В продакшене путь к файлу ключа лучше брать из .env
 def init_firebase():
@@ -19,35 +35,374 @@ def init_firebase():
     except Exception as e:
         logger.warning(f"Firebase init failed (Push notifications won't work): {e}")
 
-def send_push_to_user(db: Session, user_id: int, title: str, body: str, data: dict = None):
+
+# --- Транспорт (куда реально уходят пуши) ---
+
+class FcmTransport:
+    """Отправка через Firebase Cloud Messaging."""
+
+    def send(
+        self, tokens: List[str], title: str, body: str, data: Dict[str, str],
+        collapse_key: Optional[str] = None
+    ) -> Tuple[int, int]:
+        """
+        Отправляет один multicast (до 500 токенов). Возвращает (успешно, ошибок).
+        collapse_key - пуши с одним ключом заменяют друг друга на устройстве.
+        """
+        android = apns = None
+        if collapse_key:
+            android = messaging.AndroidConfig(
+                collapse_key=collapse_key,
+                notification=messaging.AndroidNotification(tag=collapse_key),
+            )
+            apns = messaging.APNSConfig(
+                headers={"apns-collapse-id": collapse_key},
+                payload=messaging.APNSPayload(aps=messaging.Aps(thread_id=collapse_key)),
+            )
+
+        message = messaging.MulticastMessage(
+            notification=messaging.Notification(title=title, body=body),
+            data=data,
+            tokens=tokens,
+            android=android,
+            apns=apns,
+        )
+        # В firebase-admin 7 send_multicast удален, используем send_each_for_multicast
+        send = getattr(messaging, "send_each_for_multicast", None) or messaging.send_multicast
+        response = send(message)
+        return response.success_count, response.failure_count
+
+
+class FakeFcmTransport:
     """
-    Отправляет пуш на ВСЕ устройства пользователя.
+    Подставной транспорт без сети: запоминает отправки и имитирует задержку FCM.
+    Нужен для локальной разработки и замеров пропускной способности.
     """
-    # 1. Получаем токены пользователя
-    devices = db.query(models.UserDevice).filter(models.UserDevice.user_id == user_id).all()
-    if not devices:
-        return
-
-    tokens = [d.fcm_token for d in devices]
-    
-    if not tokens:
-        return
-
-    # 2. Формируем сообщение
-    message = messaging.MulticastMessage(
-        notification=messaging.Notification(
-            title=title,
-            body=body,
-        ),
-        data=data or {}, # Доп. данные (id чата и т.д.) для обработки клика
-        tokens=tokens,
-    )
-
-    # 3. Отправляем
-    try:
-        response = messaging.send_multicast(message)
-        logger.info(f"Push sent to user {user_id}: {response.success_count} success")
-        
-        # (Опционально) Удалить невалидные токены на основе response.responses
-    except Exception as e:
-        logger.error(f"Error sending push: {e}")
\ No newline at end of file
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = 0
+        self.tokens_sent = 0
+
+    def send(
+        self, tokens: List[str], title: str, body: str, data: Dict[str, str],
+        collapse_key: Optional[str] = None
+    ) -> Tuple[int, int]:
+        if self.latency:
+            time.sleep(self.latency)
+        self.requests += 1
+        self.tokens_sent += len(tokens)
+        return len(tokens), 0
+
+
+def create_transport(name: str):
+    """Выбор транспорта по настройке PUSH_TRANSPORT: fcm или fake."""
+    if name == "fake":
+        return FakeFcmTransport()
+    if name == "fcm":
+        return FcmTransport()
+    raise ValueError(f"Неизвестный транспорт пушей: {name}")
+
+
+# --- Диспетчер ---
+
+class PushJob:
+    """Один пуш с одинаковым текстом для нескольких получателей."""
+
+    def __init__(
+        self, user_ids: Iterable[int], title: str, body: str,
+        data: Optional[dict] = None, collapse_key: Optional[str] = None
+    ):
+        self.user_ids = list(user_ids)
+        self.title = title
+        self.body = body
+        self.data = {k: str(v) for k, v in (data or {}).items()}
+        self.collapse_key = collapse_key
+
+    def payload_key(self) -> tuple:
+        return (self.title, self.body, json.dumps(self.data, sort_keys=True), self.collapse_key)
+
+
+def _load_tokens(db: Session, user_ids: List[int]) -> Dict[int, List[str]]:
+    """Токены всех получателей пачки одним запросом."""
+    rows = db.query(models.UserDevice.user_id, models.UserDevice.fcm_token).filter(
+        models.UserDevice.user_id.in_(user_ids)
+    ).all()
+    tokens: Dict[int, List[str]] = {}
+    for user_id, token in rows:
+        tokens.setdefault(user_id, []).append(token)
+    return tokens
+
+
+class PushDispatcher:
+    """
+    Фоновая отправка пушей.
+    WebSocket только кладет задачу в очередь и сразу продолжает работу.
+    Диспетчер собирает задачи за короткое окно, объединяет одинаковые,
+    одним запросом достает токены всех получателей, режет их на пачки
+    по 500 и отправляет пачки параллельно в пуле потоков.
+    """
+
+    def __init__(self, transport=None, workers: int = PUSH_WORKERS):
+        self.transport = transport
+        self.workers = workers
+        self.queue: Optional[asyncio.Queue] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sending: set = set()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.stats = {"queued": 0, "dropped": 0, "requests": 0, "sent": 0, "failed": 0}
+
+    def start(self):
+        """Запускает фоновую задачу (вызывается в lifespan)."""
+        if self.transport is None:
+            self.transport = create_transport(settings.PUSH_TRANSPORT)
+        self.queue = asyncio.Queue(maxsize=PUSH_QUEUE_SIZE)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="push")
+        self._slots = asyncio.Semaphore(self.workers)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Отправляет то, что осталось в очереди, и останавливается."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+
+        pending = []
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        if pending:
+            await self._flush(pending)
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+    def enqueue(
+        self, user_ids: Iterable[int], title: str, body: str,
+        data: Optional[dict] = None, collapse_key: Optional[str] = None
+    ) -> bool:
+        """Ставит пуш в очередь без ожидания. False - диспетчер не запущен или очередь полна."""
+        job = PushJob(user_ids, title, body, data, collapse_key)
+        if not job.user_ids or self.queue is None:
+            return False
+        try:
+            self.queue.put_nowait(job)
+            self.stats["queued"] += 1
+            return True
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            logger.warning("Очередь пушей переполнена, пуш пропущен")
+            return False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await self.queue.get()]
+            # Добираем все, что придет за окно PUSH_BATCH_WINDOW
+            deadline = loop.time() + PUSH_BATCH_WINDOW
+            while (timeout := deadline - loop.time()) > 0:
+                try:
+                    jobs.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._flush(jobs)
+            except Exception as e:
+                logger.error(f"Ошибка отправки пачки пушей: {e}")
+
+    async def _flush(self, jobs: List[PushJob]):
+        # 1. Объединяем одинаковые пуши (один текст -> много получателей)
+        merged: Dict[tuple, Tuple[PushJob, set]] = {}
+        for job in jobs:
+            entry = merged.setdefault(job.payload_key(), (job, set()))
+            entry[1].update(job.user_ids)
+
+        # 2. Токены всех получателей одним запросом
+        all_users = sorted(set().union(*(users for _, users in merged.values())))
+        tokens_by_user = await database.run_in_session(_load_tokens, all_users)
+
+        # 3. Режем на пачки по 500 токенов и отправляем параллельно
+        for job, users in merged.values():
+            tokens = [t for uid in users for t in tokens_by_user.get(uid, [])]
+            for i in range(0, len(tokens), FCM_MULTICAST_LIMIT):
+                await self._slots.acquire()
+                task = asyncio.create_task(self._send(job, tokens[i:i + FCM_MULTICAST_LIMIT]))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+
+    async def _send(self, job: PushJob, tokens: List[str]):
+        loop = asyncio.get_running_loop()
+        try:
+            success, failure = await loop.run_in_executor(
+                self.executor, self.transport.send, tokens, job.title, job.body, job.data, job.collapse_key
+            )
+            self.stats["requests"] += 1
+            self.stats["sent"] += success
+            self.stats["failed"] += failure
+        except Exception as e:
+            self.stats["failed"] += len(tokens)
+            logger.error(f"Error sending push: {e}")
+        finally:
+            self._slots.release()
+
+
+# --- Подавление и склейка пушей ---
+
+# Канал шины, по которому подтверждения доставки доходят до воркера отправителя
+PUSH_ACK_CHANNEL = "dialect:push-acks"
+
+
+def _new_messages_text(count: int) -> str:
+    """'1 новое сообщение', '3 новых сообщения', '5 новых сообщений'."""
+    if count % 10 == 1 and count % 100 != 11:
+        return f"{count} новое сообщение"
+    if 2 <= count % 10 <= 4 and not 12 <= count % 100 <= 14:
+        return f"{count} новых сообщения"
+    return f"{count} новых сообщений"
+
+
+class _Burst:
+    """Сообщения одного чата для одного получателя, пришедшие за окно склейки."""
+
+    def __init__(self):
+        self.count = 0
+        self.senders: set = set()
+        self.last_title = ""
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class PushCoalescer:
+    """
+    Решает, кому и какой пуш нужен для нового сообщения:
+
+    1. Получателям онлайн пуш не нужен - сообщение уже ушло в сокет.
+       Если задан PUSH_ACK_TIMEOUT, пуш все же уйдет, когда клиент
+       не подтвердит доставку событием "ack" за это время.
+    2. Для офлайн-получателей первое сообщение чата уходит сразу,
+       а все следующие за окно PUSH_COALESCE_WINDOW склеиваются в один
+       пуш "5 новых сообщений от X", который заменяет предыдущий на устройстве.
+    """
+
+    def __init__(self, dispatcher: PushDispatcher):
+        self.dispatcher = dispatcher
+        self.bursts: Dict[Tuple[int, int], _Burst] = {}
+        self.pending_acks: Dict[Tuple[int, int], asyncio.TimerHandle] = {}
+        self.bus = None
+        self.stats = {"suppressed": 0, "coalesced": 0, "ack_timeouts": 0}
+
+    async def start(self, bus=None):
+        """Подписывается на подтверждения с других воркеров (вызывается в lifespan)."""
+        self.bus = bus
+        if bus is not None and settings.PUSH_ACK_TIMEOUT > 0:
+            await bus.subscribe(PUSH_ACK_CHANNEL, self._on_remote_ack)
+
+    def on_new_message(
+        self, chat_id: int, message_id: int, sender_name: str, body: str,
+        recipient_ids: Iterable[int], delivered_ids: Iterable[int]
+    ):
+        """Вызывается после рассылки по сокетам с множеством тех, кому она дошла."""
+        delivered = set(delivered_ids)
+        offline = []
+        for uid in recipient_ids:
+            if uid not in delivered:
+                offline.append(uid)
+            elif settings.PUSH_ACK_TIMEOUT > 0:
+                self._expect_ack(uid, chat_id, message_id, sender_name, body)
+            else:
+                self.stats["suppressed"] += 1
+
+        if offline:
+            self.notify(offline, chat_id, sender_name, body)
+
+    def stop(self):
+        """
+        Досылает незакрытые склейки через диспетчер (вызывается в lifespan
+        до остановки диспетчера) и снимает таймеры ожидания подтверждений.
+        """
+        for key in list(self.bursts):
+            timer = self.bursts[key].timer
+            if timer is not None:
+                timer.cancel()
+            self._flush_burst(key)
+        for handle in self.pending_acks.values():
+            handle.cancel()
+        self.pending_acks.clear()
+
+    def notify(self, user_ids: Iterable[int], chat_id: int, sender_name: str, body: str):
+        """Пуш о сообщении с учетом склейки по (получатель, чат)."""
+        window = settings.PUSH_COALESCE_WINDOW
+        data = {"chat_id": str(chat_id)}
+        immediate = []
+        for uid in user_ids:
+            key = (uid, chat_id)
+            burst = self.bursts.get(key)
+            if burst is None:
+                # Первое сообщение - сразу; открываем окно для следующих
+                immediate.append(uid)
+                if window > 0:
+                    burst = self.bursts[key] = _Burst()
+                    burst.senders.add(sender_name)  # итог считает и первое сообщение
+                    burst.last_title = sender_name
+                    burst.timer = asyncio.get_running_loop().call_later(window, self._flush_burst, key)
+            else:
+                burst.count += 1
+                burst.senders.add(sender_name)
+                burst.last_title = sender_name
+                self.stats["coalesced"] += 1
+
+        if immediate:
+            self.dispatcher.enqueue(immediate, sender_name, body, data, collapse_key=f"chat_{chat_id}")
+
+    def _flush_burst(self, key: Tuple[int, int]):
+        burst = self.bursts.pop(key, None)
+        if burst is None or burst.count == 0:
+            return
+
+        user_id, chat_id = key
+        # Первое сообщение уже показано, итоговый пуш его заменяет
+        total = burst.count + 1
+        body = _new_messages_text(total)
+        if len(burst.senders) == 1:
+            body += f" от {burst.last_title}"
+        self.dispatcher.enqueue(
+            [user_id], burst.last_title, body, {"chat_id": str(chat_id)}, collapse_key=f"chat_{chat_id}"
+        )
+
+    # --- Подтверждения доставки ---
+
+    def _expect_ack(self, user_id: int, chat_id: int, message_id: int, sender_name: str, body: str):
+        key = (user_id, message_id)
+        self.pending_acks[key] = asyncio.get_running_loop().call_later(
+            settings.PUSH_ACK_TIMEOUT, self._on_ack_timeout, key, chat_id, sender_name, body
+        )
+
+    def _on_ack_timeout(self, key: Tuple[int, int], chat_id: int, sender_name: str, body: str):
+        if self.pending_acks.pop(key, None) is None:
+            return
+        self.stats["ack_timeouts"] += 1
+        self.notify([key[0]], chat_id, sender_name, body)
+
+    def _resolve_ack(self, user_id: int, message_id: int) -> bool:
+        handle = self.pending_acks.pop((user_id, message_id), None)
+        if handle is None:
+            return False
+        handle.cancel()
+        self.stats["suppressed"] += 1
+        return True
+
+    async def ack(self, user_id: int, message_id: int):
+        """Клиент подтвердил, что получил сообщение по сокету."""
+        if settings.PUSH_ACK_TIMEOUT <= 0:
+            return
+        if not self._resolve_ack(user_id, message_id) and self.bus is not None:
+            # Ожидание могло быть заведено на воркере отправителя
+            await self.bus.publish(PUSH_ACK_CHANNEL, {"user_id": user_id, "message_id": message_id})
+
+    async def _on_remote_ack(self, event: dict):
+        self._resolve_ack(event["user_id"], event["message_id"])
+
+
+# Глобальный диспетчер (запускается в lifespan)
+push_dispatcher = PushDispatcher()
+push_coalescer = PushCoalescer(push_dispatcher)
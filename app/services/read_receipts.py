@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from typing import Dict, List, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.db import database
+from app.core.config import settings
+from app.services import message_service
+from app.services.connection_manager import manager
+
+logger = logging.getLogger(__name__)
+
+
+def _persist_read(db: Session, user_id: int, chat_id: int, message_id: int) -> List[int]:
+    """Сдвигает водяной знак и возвращает участников чата для рассылки."""
+    message_service.mark_messages_as_read(db, chat_id, user_id, message_id)
+    return message_service.get_chat_participants(db, chat_id=chat_id)
+
+
+class ReadDebouncer:
+    """
+    Склеивает события "read" по паре (пользователь, чат).
+
+    При прокрутке клиент шлет read на каждое сообщение. Первое событие
+    запускает таймер на window секунд, следующие только поднимают
+    ожидающий message_id. По таймеру в БД пишется и рассылается один
+    message_read с максимальным id. При отключении пользователя его
+    ожидающие прочтения сбрасываются сразу.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._pending: Dict[Tuple[int, int], int] = {}
+        self._timers: Dict[Tuple[int, int], asyncio.Task] = {}
+        self.stats = {"received": 0, "flushed": 0, "errors": 0}
+
+    def submit(self, user_id: int, chat_id: int, message_id: int):
+        """Принимает событие read (вызывается из loop, не блокирует)."""
+        self.stats["received"] += 1
+        # id из будущего не должен стать ожидающим максимумом (см. read_id_ceiling)
+        message_id = min(message_id, message_service.read_id_ceiling())
+        key = (user_id, chat_id)
+        if message_id <= self._pending.get(key, 0):
+            return
+        self._pending[key] = message_id
+
+        if key not in self._timers:
+            self._timers[key] = asyncio.create_task(self._flush_later(key))
+
+    async def _flush_later(self, key: Tuple[int, int]):
+        await asyncio.sleep(self.window)
+        self._timers.pop(key, None)
+        await self._flush(key)
+
+    async def _flush(self, key: Tuple[int, int]):
+        message_id = self._pending.pop(key, None)
+        if message_id is None:
+            return
+        user_id, chat_id = key
+
+        try:
+            parts = await database.run_in_session(_persist_read, user_id, chat_id, message_id)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Не удалось сохранить прочтение {key} до {message_id}: {e}")
+            return
+
+        self.stats["flushed"] += 1
+        read_notification = {
+            "type": "message_read",
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "last_read_id": message_id
+        }
+        await manager.broadcast(read_notification, [pid for pid in parts if pid != user_id])
+
+    async def flush_user(self, user_id: int):
+        """Сразу сохраняет все ожидающие прочтения пользователя (при отключении)."""
+        await self._flush_keys([key for key in self._pending if key[0] == user_id])
+
+    async def stop(self):
+        """Сохраняет все ожидающие прочтения (при остановке приложения)."""
+        await self._flush_keys(list(self._pending))
+
+    async def _flush_keys(self, keys: List[Tuple[int, int]]):
+        for key in keys:
+            timer = self._timers.pop(key, None)
+            if timer:
+                timer.cancel()
+        # shield: отмена обработчика сокета не должна терять прочтения
+        await asyncio.shield(asyncio.gather(*(self._flush(key) for key in keys)))
+
+
+# Глобальный экземпляр
+read_debouncer = ReadDebouncer(window=settings.READ_DEBOUNCE_WINDOW)
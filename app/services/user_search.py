@@ -0,0 +1,305 @@
+import asyncio
+import heapq
+import logging
+import threading
+import uuid
+from array import array
+from bisect import bisect_left
+from functools import partial
+from itertools import chain, islice
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+try:
+    import numpy as np  # необязательно: ускоряет пересечение списков триграмм
+except ImportError:
+    np = None
+
+from app.db import models
+from app.services.event_bus import publish_from_any_thread
+
+logger = logging.getLogger(__name__)
+
+# Канал шины для обновления индекса на всех воркерах
+USER_SEARCH_CHANNEL = "dialect:user-search"
+# Сколько строк users читать за раз при построении индекса
+REBUILD_BATCH_SIZE = 10_000
+# Сколько кандидатов (прошедших все триграммы) ранжировать на один запрос
+SEARCH_CANDIDATE_LIMIT = 5_000
+# По сколько кандидатов проверять за раз в numpy (чтобы не идти по всему списку)
+NUMPY_CHUNK = 32_768
+# Списки длиннее самого короткого в столько раз проверяются бинарным поиском, а не множеством
+SET_RATIO = 4
+# Типкод массива id в списках триграмм: 4 байта на id (users.id - INT)
+POSTING_TYPECODE = "I"
+
+# (username, "имя фамилия", телефон) в нижнем регистре
+SearchFields = Tuple[str, str, str]
+# Поля пользователя хранятся одной строкой через разделитель: меньше объектов в памяти
+FIELD_SEPARATOR = "\x00"
+
+_EMPTY: Set[int] = frozenset()
+_EMPTY_POSTING = array(POSTING_TYPECODE)
+
+
+def _normalize(username: Optional[str], first_name: Optional[str], last_name: Optional[str],
+               phone_number: Optional[str]) -> SearchFields:
+    full_name = f"{first_name or ''} {last_name or ''}".strip()
+    return (username or "").lower(), full_name.lower(), (phone_number or "").lower()
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _field_trigrams(fields: SearchFields) -> Set[str]:
+    grams: Set[str] = set()
+    for field in fields:
+        grams |= _trigrams(field)
+    return grams
+
+
+def _pack(fields: SearchFields) -> str:
+    return FIELD_SEPARATOR.join(fields)
+
+
+def _unpack(packed: str) -> SearchFields:
+    username, full_name, phone = packed.split(FIELD_SEPARATOR)
+    return username, full_name, phone
+
+
+def _rank(fields: SearchFields, query: str) -> Optional[int]:
+    """0 - точный юзернейм, 1 - префикс юзернейма, 2 - префикс слова имени/телефона, 3 - подстрока."""
+    username, full_name, phone = fields
+    if username == query:
+        return 0
+    if username.startswith(query):
+        return 1
+    if (" " + full_name).find(" " + query) != -1 or phone.startswith(query):
+        return 2
+    if query in username or query in full_name or query in phone:
+        return 3
+    return None  # совпали только триграммы
+
+
+def _add_postings(postings: Dict[str, array], extra: Dict[str, Set[int]], grams: Iterable[str], user_id: int):
+    for gram in grams:
+        posting = postings.get(gram)
+        if posting is None:
+            postings[gram] = array(POSTING_TYPECODE, [user_id])
+        elif user_id > posting[-1]:
+            try:
+                posting.append(user_id)
+            except BufferError:
+                # Массив сейчас читает поиск через numpy: дописываем в копию
+                postings[gram] = posting + array(POSTING_TYPECODE, [user_id])
+        elif not _has(posting, len(posting), _EMPTY, user_id):
+            extra.setdefault(gram, set()).add(user_id)
+
+
+def _has(posting: array, size: int, extra: Set[int], user_id: int) -> bool:
+    i = bisect_left(posting, user_id, 0, size)
+    return (i < size and posting[i] == user_id) or user_id in extra
+
+
+def _intersect(lists: List[Tuple[array, int, Set[int]]], limit: int) -> List[int]:
+    """
+    Пересечение списков (posting, размер снимка, extra), самый короткий - первым.
+    Возвращает не больше limit id.
+    """
+    if np is not None:
+        return _intersect_numpy(lists, limit)
+
+    # Без numpy идем по короткому и останавливаемся на limit найденных. Списки
+    # сравнимой длины проверяем по множеству, длинные - бинарным поиском
+    (posting, size, extra), rest = lists[0], lists[1:]
+    checks = []
+    for other, other_size, other_extra in rest:
+        if other_size <= SET_RATIO * size:
+            members = set(islice(other, other_size))
+            members |= other_extra
+            checks.append(members.__contains__)
+        else:
+            checks.append(partial(_has, other, other_size, other_extra))
+
+    found = []
+    for user_id in chain(islice(posting, size), extra):
+        if all(check(user_id) for check in checks):
+            found.append(user_id)
+            if len(found) >= limit:
+                break
+    return found
+
+
+def _intersect_numpy(lists: List[Tuple[array, int, Set[int]]], limit: int) -> List[int]:
+    """
+    Кандидаты из короткого списка ищутся в остальных сразу пачкой (searchsorted),
+    без копирования массивов. Пачки по NUMPY_CHUNK, пока не наберется limit.
+    """
+    (posting, size, extra), rest = lists[0], lists[1:]
+    first = np.frombuffer(posting, dtype=np.uintc, count=size)
+    if extra:
+        first = np.union1d(first, np.fromiter(extra, dtype=np.uintc, count=len(extra)))
+    others = [
+        (np.frombuffer(other, dtype=np.uintc, count=other_size),
+         np.fromiter(other_extra, dtype=np.uintc, count=len(other_extra)) if other_extra else None)
+        for other, other_size, other_extra in rest
+    ]
+
+    found: List[int] = []
+    for start in range(0, len(first), NUMPY_CHUNK):
+        candidates = first[start:start + NUMPY_CHUNK]
+        for ids, ids_extra in others:
+            mask = np.zeros(len(candidates), dtype=bool)
+            if len(ids):
+                positions = np.minimum(np.searchsorted(ids, candidates), len(ids) - 1)
+                mask = ids[positions] == candidates
+            if ids_extra is not None:
+                mask |= np.isin(candidates, ids_extra)
+            candidates = candidates[mask]
+            if not len(candidates):
+                break
+        found += candidates[:limit - len(found)].tolist()
+        if len(found) >= limit:
+            break
+    return found
+
+
+class UserSearchIndex:
+    """
+    Триграммный индекс для поиска пользователей в памяти.
+
+    Заменяет LIKE '%q%' по четырем колонкам (полный скан users): для
+    запроса берутся списки пользователей по каждой его триграмме,
+    пересекаются (от самого короткого), кандидаты проверяются на подстроку
+    и ранжируются: точный юзернейм > префикс > подстрока.
+
+    Списки триграмм - отсортированные array('I') (4 байта на id вместо
+    ~70 у set): индекс строится по возрастанию id, новые пользователи
+    дописываются в конец. id меньше последнего (смена имени у старого
+    пользователя) попадают в небольшое множество extra этой триграммы.
+    Устаревшие записи после смены имени не удаляются: кандидата все равно
+    проверяет _rank по текущим полям, а при перестройке они исчезают.
+
+    Под блокировкой берется только снимок списков (массивы меняются лишь
+    дописыванием в конец), пересечение с лимитом SEARCH_CANDIDATE_LIMIT
+    и ранжирование идут без нее.
+
+    Строится при старте, обновляется при регистрации и изменении профиля,
+    на других воркерах - через шину. Пока индекс не построен, поиск идет
+    старым запросом к БД.
+    """
+
+    def __init__(self):
+        self._users: Dict[int, str] = {}
+        self._postings: Dict[str, array] = {}
+        self._extra: Dict[str, Set[int]] = {}
+        self._lock = threading.Lock()
+        self.ready = False
+        self.bus = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.instance_id = uuid.uuid4().hex
+        self.stats_counters = {"searches": 0, "updates": 0, "truncated": 0}
+
+    async def start(self, bus=None):
+        """Подписывается на обновления с других воркеров (вызывается в lifespan)."""
+        self.loop = asyncio.get_running_loop()
+        self.bus = bus
+        if bus is not None:
+            await bus.subscribe(USER_SEARCH_CHANNEL, self._on_remote_update)
+
+    def rebuild(self, db: Session):
+        """Строит индекс заново, читая users порциями по возрастанию id."""
+        users: Dict[int, str] = {}
+        postings: Dict[str, array] = {}
+        extra: Dict[str, Set[int]] = {}
+
+        rows = db.query(
+            models.User.id, models.User.username, models.User.first_name,
+            models.User.last_name, models.User.phone_number
+        ).order_by(models.User.id).yield_per(REBUILD_BATCH_SIZE)
+        for user_id, *fields in rows:
+            normalized = _normalize(*fields)
+            users[user_id] = _pack(normalized)
+            _add_postings(postings, extra, _field_trigrams(normalized), user_id)
+
+        with self._lock:
+            self._users, self._postings, self._extra = users, postings, extra
+            self.ready = True
+        logger.info(f"Индекс поиска пользователей построен: {len(users)} пользователей, {len(postings)} триграмм")
+
+    # --- Поиск ---
+
+    def search(self, query: str, limit: int = 10) -> List[int]:
+        """id найденных пользователей, лучшие первыми. Запрос - от 3 символов."""
+        query = query.strip().lower()
+        grams = _trigrams(query)
+        if not grams:
+            return []
+
+        with self._lock:
+            self.stats_counters["searches"] += 1
+            lists = []
+            for gram in grams:
+                posting = self._postings.get(gram, _EMPTY_POSTING)
+                lists.append((posting, len(posting), set(self._extra.get(gram, _EMPTY))))
+            users = self._users
+
+        lists.sort(key=lambda entry: entry[1] + len(entry[2]))
+        candidates = _intersect(lists, SEARCH_CANDIDATE_LIMIT)
+        if len(candidates) >= SEARCH_CANDIDATE_LIMIT:
+            self.stats_counters["truncated"] += 1
+
+        ranked = []
+        for user_id in candidates:
+            packed = users.get(user_id)
+            if packed is None:
+                continue
+            fields = _unpack(packed)
+            rank = _rank(fields, query)
+            if rank is not None:
+                ranked.append((rank, len(fields[0]), user_id))
+
+        return [user_id for _, _, user_id in heapq.nsmallest(limit, ranked)]
+
+    # --- Изменения (вызывать после commit) ---
+
+    def upsert(self, user: models.User):
+        """Добавляет или обновляет пользователя здесь и на остальных воркерах."""
+        values = [user.id, user.username, user.first_name, user.last_name, user.phone_number]
+        self._apply(values[0], _normalize(*values[1:]))
+        publish_from_any_thread(
+            self.bus, self.loop, USER_SEARCH_CHANNEL, {"user": values, "origin": self.instance_id}
+        )
+
+    def _apply(self, user_id: int, fields: SearchFields):
+        with self._lock:
+            self.stats_counters["updates"] += 1
+            old = self._users.get(user_id)
+            new_grams = _field_trigrams(fields)
+            if old is not None:
+                new_grams -= _field_trigrams(_unpack(old))  # эти уже есть в списках
+            _add_postings(self._postings, self._extra, new_grams, user_id)
+            self._users[user_id] = _pack(fields)
+
+    async def _on_remote_update(self, event: dict):
+        if event.get("origin") == self.instance_id:
+            return
+        user_id, *fields = event["user"]
+        self._apply(user_id, _normalize(*fields))
+
+    def stats(self) -> Dict[str, int]:
+        """Размер индекса (для /system/metrics)."""
+        with self._lock:
+            return {
+                **self.stats_counters,
+                "users": len(self._users),
+                "trigrams": len(self._postings),
+                "postings_bytes": sum(len(p) * p.itemsize for p in self._postings.values()),
+                "extra_ids": sum(len(ids) for ids in self._extra.values()),
+            }
+
+
+# Глобальный экземпляр индекса
+user_search = UserSearchIndex()
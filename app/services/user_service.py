@@ -1,12 +1,16 @@
 from sqlalchemy.orm import Session
 from sqlalchemy import or_
-from typing import Optional
+from typing import List, Optional, Set
 from datetime import datetime, timedelta
 from PIL import Image, UnidentifiedImageError # <-- Нужен Pillow
+import hashlib
 import io
 
 from app.db import models, schemas
 from app.core.security import get_password_hash
+from app.services.block_index import block_index
+from app.services.user_search import user_search
+from app.services.username_index import username_index
 
 from sqlalchemy.sql import func
 from fastapi import UploadFile, HTTPException, status
@@ -95,6 +99,29 @@ def check_status_expiration(user: models.User):
         user.status_expires_at = None
     return user
 
+# --- ТЕЛЕФОНЫ ---
+
+# Сколько хешей искать одним запросом
+CONTACTS_MATCH_CHUNK = 1000
+# Во сколько раз больше кандидатов берет поиск: часть отсеют блокировки
+SEARCH_OVERFETCH = 2
+# Сколько пользователей можно запросить пачкой (GET /users?ids=...)
+USERS_BATCH_MAX = 200
+
+def normalize_phone(phone_number: str) -> Optional[str]:
+    """Приводит номер к виду "+79001234567" (только цифры с плюсом)."""
+    digits = "".join(ch for ch in phone_number if ch.isdigit())
+    return f"+{digits}" if digits else None
+
+def hash_phone(phone_number: str) -> Optional[str]:
+    """
+    SHA-256 (hex) нормализованного номера. Клиент может прислать хеши вместо
+    номеров. Это не шифрование: номеров мало, хеш подбирается перебором,
+    поэтому хеши защищают только от случайной утечки в логах.
+    """
+    normalized = normalize_phone(phone_number)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest() if normalized else None
+
 # --- READ ---
 
 def get_user(db: Session, user_id: int) -> Optional[models.User]:
@@ -102,12 +129,30 @@ def get_user(db: Session, user_id: int) -> Optional[models.User]:
     if user: check_status_expiration(user)
     return user
 
+def get_users_by_ids(db: Session, user_ids: List[int]) -> List[models.User]:
+    """Пользователи одним запросом IN, в порядке user_ids (несуществующие пропускаются)."""
+    if not user_ids: return []
+    users = {u.id: u for u in db.query(models.User).filter(models.User.id.in_(set(user_ids))).all()}
+    result = []
+    for user_id in dict.fromkeys(user_ids):
+        user = users.get(user_id)
+        if user:
+            check_status_expiration(user)
+            result.append(user)
+    return result
+
 def get_user_by_phone(db: Session, phone_number: str) -> Optional[models.User]:
     return db.query(models.User).filter(models.User.phone_number == phone_number).first()
 
 def get_user_by_username(db: Session, username: str) -> Optional[models.User]:
     return db.query(models.User).filter(models.User.username == username).first()
 
+def get_taken_usernames(db: Session, usernames: List[str]) -> Set[str]:
+    """Какие из юзернеймов уже заняты (один запрос IN)."""
+    if not usernames: return set()
+    rows = db.query(models.User.username).filter(models.User.username.in_(set(usernames))).all()
+    return {username for (username,) in rows}
+
 # --- CREATE ---
 
 def create_user(db: Session, user_data: schemas.UserCreate) -> models.User:
@@ -118,15 +163,67 @@ def create_user(db: Session, user_data: schemas.UserCreate) -> models.User:
         first_name=user_data.first_name,
         last_name=user_data.last_name,
         public_key=user_data.public_key,
-        password_hash=hashed_password
+        password_hash=hashed_password,
+        phone_hash=hash_phone(user_data.phone_number)
     )
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    user_search.upsert(db_user)
+    username_index.add(db_user.username)
     return db_user
 
-def search_users(db: Session, query_str: str, limit: int = 10) -> list[models.User]:
+def match_contacts(
+    db: Session, requester_id: int, phone_numbers: List[str], phone_hashes: List[str]
+) -> List[models.User]:
+    """
+    Поиск контактов из адресной книги (у каждого заполнен phone_hash).
+    Номера хешируются здесь же, поиск - по индексу phone_hash порциями IN,
+    без себя и без тех, кто заблокировал запрашивающего.
+    """
+    hashes = {h.lower() for h in phone_hashes}
+    hashes.update(filter(None, (hash_phone(p) for p in phone_numbers)))
+    if not hashes: return []
+
+    hashes = list(hashes)
+    users: List[models.User] = []
+    for start in range(0, len(hashes), CONTACTS_MATCH_CHUNK):
+        users += db.query(models.User).filter(
+            models.User.phone_hash.in_(hashes[start:start + CONTACTS_MATCH_CHUNK]),
+            models.User.id != requester_id
+        ).all()
+
+    allowed = set(block_index.filter_not_blocking(db, requester_id, [u.id for u in users]))
+    result = [u for u in users if u.id in allowed]
+    for u in result: check_status_expiration(u)
+    return result
+
+def search_users(db: Session, requester_id: int, query_str: str, limit: int = 10) -> list[models.User]:
+    """
+    Поиск по юзернейму, имени и телефону через триграммный индекс, лучшие первыми.
+    Тех, кто заблокировал запрашивающего, в выдаче нет (как в match_contacts).
+    """
     if not query_str: return []
+    if not user_search.ready:
+        return _search_users_like(db, requester_id, query_str, limit)
+
+    ids = user_search.search(query_str, limit * SEARCH_OVERFETCH)
+    # Индекс ранжирует не больше SEARCH_CANDIDATE_LIMIT кандидатов: точный
+    # юзернейм добираем тем же запросом по уникальному индексу
+    username = query_str.strip()
+    found = {u.id: u for u in db.query(models.User).filter(
+        or_(models.User.id.in_(ids), models.User.username == username)
+    ).all()}
+    exact = next((u.id for u in found.values() if (u.username or "").lower() == username.lower()), None)
+    if exact is not None and exact not in ids:
+        ids = [exact] + ids
+    ids = block_index.filter_not_blocking(db, requester_id, [uid for uid in ids if uid in found])
+    users = [found[uid] for uid in ids[:limit]]
+    for u in users: check_status_expiration(u)
+    return users
+
+def _search_users_like(db: Session, requester_id: int, query_str: str, limit: int) -> list[models.User]:
+    """Старый поиск полным сканом (пока индекс не построен)."""
     search_pattern = f"%{query_str}%"
     users = db.query(models.User).filter(
         or_(
@@ -135,7 +232,9 @@ def search_users(db: Session, query_str: str, limit: int = 10) -> list[models.Us
             models.User.last_name.like(search_pattern),
             models.User.phone_number.like(search_pattern)
         )
-    ).limit(limit).all()
+    ).limit(limit * SEARCH_OVERFETCH).all()
+    allowed = set(block_index.filter_not_blocking(db, requester_id, [u.id for u in users]))
+    users = [u for u in users if u.id in allowed][:limit]
     for u in users: check_status_expiration(u)
     return users
 
@@ -163,6 +262,7 @@ def update_user_profile(db: Session, user_id: int, update_data: schemas.UserUpda
         
     db.commit()
     db.refresh(user)
+    user_search.upsert(user)
     return user
 
 def upload_avatar(db: Session, user_id: int, file: UploadFile) -> str:
@@ -282,13 +382,15 @@ def block_user(db: Session, blocker_id: int, blocked_id: int):
     block = models.UserBlock(blocker_id=blocker_id, blocked_id=blocked_id)
     db.add(block)
     db.commit()
+    block_index.on_block(blocker_id, blocked_id)
 
 def unblock_user(db: Session, blocker_id: int, blocked_id: int):
     block = db.query(models.UserBlock).filter_by(blocker_id=blocker_id, blocked_id=blocked_id).first()
     if block:
         db.delete(block)
         db.commit()
+        block_index.on_unblock(blocker_id, blocked_id)
 
 def is_blocked(db: Session, blocker_id: int, target_id: int) -> bool:
-    """Проверяет, заблокировал ли blocker_id пользователя target_id."""
-    return db.query(models.UserBlock).filter_by(blocker_id=blocker_id, blocked_id=target_id).first() is not None
\ No newline at end of file
+    """Проверяет, заблокировал ли blocker_id пользователя target_id (по индексу в памяти)."""
+    return block_index.is_blocked(db, blocker_id, target_id)
\ No newline at end of file
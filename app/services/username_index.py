@@ -0,0 +1,245 @@
+import asyncio
+import heapq
+import logging
+import sys
+import threading
+import uuid
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from app.db import models
+from app.services.event_bus import publish_from_any_thread
+
+logger = logging.getLogger(__name__)
+
+# Канал шины для новых юзернеймов с других воркеров
+USERNAME_INDEX_CHANNEL = "dialect:usernames"
+# Сколько строк users читать за раз при построении
+REBUILD_BATCH_SIZE = 50_000
+# После стольких новых юзернеймов дельта вливается в основной массив
+DELTA_LIMIT = 50_000
+
+
+def _pack(usernames: Iterable[str]) -> Tuple[bytes, array]:
+    """Упаковывает отсортированные юзернеймы в один bytes и массив смещений (потоком)."""
+    blob = bytearray()
+    offsets = array("I", [0])
+    for name in usernames:
+        blob += name.encode("utf-8")
+        offsets.append(len(blob))
+    return bytes(blob), offsets
+
+
+def _unpack(blob: bytes, offsets: array) -> Iterator[str]:
+    """Юзернеймы упакованного массива по порядку."""
+    for i in range(len(offsets) - 1):
+        yield blob[offsets[i]:offsets[i + 1]].decode("utf-8")
+
+
+def _sort_key(username: str) -> Tuple[str, str]:
+    return username.lower(), username
+
+
+class UsernamePrefixIndex:
+    """
+    Автодополнение юзернеймов ("@ale" -> alex, alexander, ...).
+
+    Основной массив компактный: все юзернеймы, отсортированные без учета
+    регистра, лежат одним bytes, а начало каждого - в array смещений
+    (около длины имени + 4 байта на юзернейм вместо ~60 у list[str]).
+    Префикс ищется бинарным поиском, затем читаются следующие k записей.
+
+    Новые юзернеймы попадают в небольшую отсортированную дельту; когда она
+    вырастает до DELTA_LIMIT, дельта вливается в основной массив в отдельном
+    потоке (не в event loop и не в запросе): новый массив строится рядом
+    и подменяет старый. Ответ сливает оба источника, так что регистрация
+    видна сразу.
+    """
+
+    def __init__(self, delta_limit: int = DELTA_LIMIT):
+        self.delta_limit = delta_limit
+        self._blob = b""
+        self._offsets = array("I", [0])
+        self._delta: List[Tuple[str, str]] = []  # (lower, username), отсортирована
+        self._lock = threading.Lock()
+        self._merging = False
+        self._merge_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="username-merge")
+        self.ready = False
+        self.bus = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.instance_id = uuid.uuid4().hex
+        self.stats_counters = {"lookups": 0, "merges": 0}
+
+    async def start(self, bus=None):
+        """Подписывается на новые юзернеймы с других воркеров (вызывается в lifespan)."""
+        self.loop = asyncio.get_running_loop()
+        self.bus = bus
+        if bus is not None:
+            await bus.subscribe(USERNAME_INDEX_CHANNEL, self._on_remote_add)
+
+    def rebuild(self, db: Session):
+        """
+        Строит индекс заново, читая юзернеймы из БД потоком (ORDER BY username).
+
+        Порядок БД зависит от collation и может расходиться с _sort_key
+        (например, '_' и цифры в utf8mb4_*_ci), поэтому каждая порция
+        досортировывается и упаковывается, а упакованные порции сливаются.
+        Целиком в памяти живут только компактные массивы, а не список строк.
+        """
+        rows = db.query(models.User.username).filter(
+            models.User.username.isnot(None)
+        ).order_by(models.User.username).yield_per(REBUILD_BATCH_SIZE)
+
+        runs, chunk = [], []
+        for (name,) in rows:
+            if name:
+                chunk.append(name)
+            if len(chunk) >= REBUILD_BATCH_SIZE:
+                runs.append(_pack(sorted(chunk, key=_sort_key)))
+                chunk = []
+        runs.append(_pack(sorted(chunk, key=_sort_key)))
+        if len(runs) == 1:
+            blob, offsets = runs[0]
+        else:
+            blob, offsets = _pack(heapq.merge(*(_unpack(*run) for run in runs), key=_sort_key))
+        del runs
+
+        with self._lock:
+            self._blob, self._offsets = blob, offsets
+            self._delta = []
+            self.ready = True
+        logger.info(f"Индекс юзернеймов построен: {len(offsets) - 1} шт., {self.stats()['base_bytes']} байт")
+
+    # --- Чтение ---
+
+    def _base_size(self) -> int:
+        return len(self._offsets) - 1
+
+    def _base_value(self, index: int) -> str:
+        return self._blob[self._offsets[index]:self._offsets[index + 1]].decode("utf-8")
+
+    def _lower_bound(self, key: str) -> int:
+        """Первая позиция основного массива, где имя (в нижнем регистре) >= key."""
+        low, high = 0, self._base_size()
+        while low < high:
+            middle = (low + high) // 2
+            if self._base_value(middle).lower() < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def complete(self, prefix: str, limit: int = 10) -> List[str]:
+        """До limit юзернеймов, начинающихся с prefix (без учета регистра), по алфавиту."""
+        key = prefix.lstrip("@").lower()
+        if not key:
+            return []
+
+        result: List[str] = []
+        with self._lock:
+            self.stats_counters["lookups"] += 1
+            base_index, base_size = self._lower_bound(key), self._base_size()
+            delta_index = bisect_left(self._delta, (key, ""))
+
+            base_next = self._base_value(base_index) if base_index < base_size else None
+            while len(result) < limit:
+                if base_next is not None and not base_next.lower().startswith(key):
+                    base_next = None
+                delta_next = self._delta[delta_index] if delta_index < len(self._delta) else None
+                if delta_next is not None and not delta_next[0].startswith(key):
+                    delta_next = None
+                if base_next is None and delta_next is None:
+                    break
+
+                if delta_next is None or (base_next is not None and _sort_key(base_next) <= delta_next):
+                    result.append(base_next)
+                    base_index += 1
+                    base_next = self._base_value(base_index) if base_index < base_size else None
+                else:
+                    result.append(delta_next[1])
+                    delta_index += 1
+        return result
+
+    def _contains(self, username: str) -> bool:
+        key = username.lower()
+        index = self._lower_bound(key)
+        while index < self._base_size():
+            value = self._base_value(index)
+            if value.lower() != key:
+                break
+            if value == username:
+                return True
+            index += 1
+        position = bisect_left(self._delta, _sort_key(username))
+        return position < len(self._delta) and self._delta[position][1] == username
+
+    # --- Изменения (вызывать после commit) ---
+
+    def add(self, username: Optional[str], publish: bool = True):
+        """Добавляет новый юзернейм здесь и на остальных воркерах."""
+        if not username:
+            return
+        merge = False
+        with self._lock:
+            if not self._contains(username):
+                insort(self._delta, _sort_key(username))
+                if len(self._delta) >= self.delta_limit and not self._merging:
+                    self._merging = merge = True
+
+        if publish:
+            publish_from_any_thread(
+                self.bus, self.loop, USERNAME_INDEX_CHANNEL, {"username": username, "origin": self.instance_id}
+            )
+        if merge:
+            # Слияние проходит по всем юзернеймам: не держим им ни loop, ни запрос
+            self._merge_executor.submit(self._merge)
+
+    def _merge(self):
+        """Вливает дельту в основной массив. Новый массив строится вне блокировки."""
+        try:
+            with self._lock:
+                blob, offsets, delta = self._blob, self._offsets, list(self._delta)
+
+            merged = heapq.merge(_unpack(blob, offsets), (name for _, name in delta), key=_sort_key)
+            new_blob, new_offsets = _pack(merged)
+
+            with self._lock:
+                self._blob, self._offsets = new_blob, new_offsets
+                # Пока шло слияние, дельта могла пополниться
+                merged_keys = set(delta)
+                self._delta = [item for item in self._delta if item not in merged_keys]
+                self.stats_counters["merges"] += 1
+        except Exception as e:
+            logger.error(f"Ошибка слияния индекса юзернеймов: {e}")
+        finally:
+            with self._lock:
+                self._merging = False
+
+    async def _on_remote_add(self, event: dict):
+        if event.get("origin") != self.instance_id:
+            self.add(event["username"], publish=False)
+
+    def stats(self) -> Dict[str, int]:
+        """Размер и занимаемая память (для /system/metrics)."""
+        with self._lock:
+            base_bytes = len(self._blob) + len(self._offsets) * self._offsets.itemsize
+            delta_bytes = sys.getsizeof(self._delta) + sum(
+                sys.getsizeof(item) + sys.getsizeof(item[0]) + sys.getsizeof(item[1]) for item in self._delta
+            )
+            size = self._base_size() + len(self._delta)
+            return {
+                **self.stats_counters,
+                "usernames": size,
+                "delta": len(self._delta),
+                "base_bytes": base_bytes,
+                "delta_bytes": delta_bytes,
+                "bytes_per_username": round((base_bytes + delta_bytes) / size, 1) if size else 0,
+            }
+
+
+# Глобальный экземпляр индекса
+username_index = UsernamePrefixIndex()
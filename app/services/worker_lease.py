@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.db import database, models
+from app.core.config import settings
+from app.core.snowflake import MAX_WORKER_ID, SnowflakeGenerator, snowflake
+
+logger = logging.getLogger(__name__)
+
+# Сколько живет аренда без продления (секунды)
+LEASE_TTL = 60
+# Как часто продлевать аренду (с запасом на паузы и недоступность БД)
+RENEW_INTERVAL = 15
+
+
+def _db_now(db: Session) -> datetime:
+    """
+    Текущее время по часам БД.
+
+    Сроки аренды пишутся и сравниваются только по ним: часы хостов
+    приложения могут расходиться, и отстающий хост иначе забрал бы
+    живую аренду.
+    """
+    return db.execute(select(func.current_timestamp())).scalar()
+
+
+class WorkerLease:
+    """
+    Аренда номера воркера для Snowflake-id в таблице worker_leases.
+
+    uvicorn --workers N запускает процессы с одинаковым окружением, а pid
+    совпадает на разных хостах, поэтому номер берется из БД: при старте
+    процесс занимает свободный (или просроченный) номер и продлевает аренду
+    каждые RENEW_INTERVAL секунд. Если свободных номеров нет или заданный
+    WORKER_ID уже занят живым процессом - старт падает.
+
+    Аренду упавшего процесса на этом же хосте (его pid больше не жив или
+    совпадает с нашим - перезапуск в контейнере) можно забрать сразу, не
+    дожидаясь LEASE_TTL. Аренду упавшего процесса на другом хосте проверить
+    нельзя: перезапуск с тем же WORKER_ID на новом хосте падает, пока она не
+    истечет (до LEASE_TTL секунд).
+
+    Если аренду не удалось продлить дольше LEASE_TTL или ее забрал другой
+    процесс, номер у генератора снимается (next_id() падает) до новой аренды.
+    """
+
+    def __init__(self, generator: SnowflakeGenerator):
+        self.generator = generator
+        self.owner = f"{socket.gethostname()[:40]}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.worker_id: Optional[int] = None
+        self._deadline = 0.0  # monotonic: до какого момента аренда точно наша
+        self._task: Optional[asyncio.Task] = None
+        self.stats_counters = {"renewals": 0, "renew_errors": 0, "lost": 0}
+
+    async def start(self):
+        """Арендует номер и запускает продление (вызывается в lifespan до отправки сообщений)."""
+        await database.run_in_session(self.acquire, settings.WORKER_ID)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает продление и освобождает номер."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.worker_id is not None:
+            self.generator.assign(None)
+            try:
+                await database.run_in_session(self.release)
+            except Exception as e:
+                logger.error(f"Не удалось освободить номер воркера {self.worker_id}: {e}")
+            self.worker_id = None
+
+    def acquire(self, db: Session, requested: Optional[int] = None) -> int:
+        """Занимает номер requested (или любой свободный) и назначает его генератору."""
+        now = _db_now(db)
+        expires_at = now + timedelta(seconds=LEASE_TTL)
+        leases = {
+            lease.worker_id: lease
+            for lease in db.query(models.WorkerLease.worker_id, models.WorkerLease.owner, models.WorkerLease.expires_at)
+        }
+
+        if requested is not None:
+            candidates = [requested]
+        else:
+            # Сначала никем не занятые, потом просроченные и брошенные упавшими процессами
+            candidates = [wid for wid in range(MAX_WORKER_ID + 1) if wid not in leases]
+            candidates += [
+                wid for wid, lease in leases.items()
+                if lease.expires_at < now or self._owner_is_dead(lease.owner)
+            ]
+
+        for worker_id in candidates:
+            if worker_id not in leases:
+                db.add(models.WorkerLease(worker_id=worker_id, owner=self.owner, expires_at=expires_at))
+                try:
+                    db.commit()
+                except IntegrityError:
+                    db.rollback()  # номер только что занял другой процесс
+                    continue
+            else:
+                lease = leases[worker_id]
+                if lease.expires_at < now:
+                    free = models.WorkerLease.expires_at < func.current_timestamp()
+                elif self._owner_is_dead(lease.owner):
+                    free = models.WorkerLease.owner == lease.owner
+                else:
+                    continue
+                taken = db.execute(
+                    update(models.WorkerLease)
+                    .where(models.WorkerLease.worker_id == worker_id, free)
+                    .values(owner=self.owner, expires_at=expires_at)
+                ).rowcount
+                db.commit()
+                if not taken:
+                    continue
+
+            self.worker_id = worker_id
+            self._deadline = time.monotonic() + LEASE_TTL
+            self.generator.assign(worker_id)
+            logger.info(f"Номер воркера для Snowflake-id: {worker_id} ({self.owner})")
+            return worker_id
+
+        if requested is not None:
+            raise RuntimeError(f"WORKER_ID={requested} уже занят другим процессом (worker_leases)")
+        raise RuntimeError(f"Нет свободных номеров воркера: заняты все {MAX_WORKER_ID + 1}")
+
+    def renew(self, db: Session) -> bool:
+        """Продлевает аренду. False - ее забрал другой процесс."""
+        renewed = db.execute(
+            update(models.WorkerLease)
+            .where(models.WorkerLease.worker_id == self.worker_id, models.WorkerLease.owner == self.owner)
+            .values(expires_at=_db_now(db) + timedelta(seconds=LEASE_TTL))
+        ).rowcount
+        db.commit()
+        if renewed:
+            self._deadline = time.monotonic() + LEASE_TTL
+        return bool(renewed)
+
+    def _owner_is_dead(self, owner: str) -> bool:
+        """True, если аренду держал уже несуществующий процесс этого хоста."""
+        host, pid, _ = owner.rsplit(":", 2)
+        own_host, own_pid, _ = self.owner.rsplit(":", 2)
+        if owner == self.owner or host != own_host:
+            return False
+        if pid == own_pid:
+            return True  # прошлый запуск с тем же pid (контейнер перезапущен)
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass  # процесс жив, но принадлежит другому пользователю
+        return False
+
+    def release(self, db: Session):
+        db.execute(
+            delete(models.WorkerLease)
+            .where(models.WorkerLease.worker_id == self.worker_id, models.WorkerLease.owner == self.owner)
+        )
+        db.commit()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(RENEW_INTERVAL)
+            try:
+                if self.worker_id is None or not await database.run_in_session(self.renew):
+                    self._lose("аренду забрал другой процесс")
+                    await database.run_in_session(self.acquire, settings.WORKER_ID)
+                else:
+                    self.stats_counters["renewals"] += 1
+            except Exception as e:
+                self.stats_counters["renew_errors"] += 1
+                logger.error(f"Ошибка продления номера воркера: {e}")
+                if self.worker_id is not None and time.monotonic() >= self._deadline:
+                    self._lose("аренда истекла")
+
+    def _lose(self, reason: str):
+        if self.worker_id is None:
+            return
+        logger.error(f"Номер воркера {self.worker_id} потерян: {reason}. Отправка сообщений остановлена до новой аренды")
+        self.stats_counters["lost"] += 1
+        self.generator.assign(None)
+        self.worker_id = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Текущий номер и счетчики продлений (для /system/metrics)."""
+        return {**self.stats_counters, "worker_id": self.worker_id}
+
+
+# Глобальная аренда (запускается в lifespan)
+worker_lease = WorkerLease(snowflake)
@@ -0,0 +1,125 @@
+"""
+Нагрузочный замер записи сообщений: по одному commit на сообщение против
+group commit через MessageWriteBuffer (MESSAGE_BATCH_WINDOW_MS).
+
+Каждый из --senders отправителей пишет --messages сообщений подряд, как
+сокет: следующее - после подтверждения предыдущего. Печатается пропускная
+способность и задержка подтверждения (p50/p99) для каждого режима.
+
+Запуск (БД из .env, таблицы создаются при необходимости):
+    python -m scripts.bench_message_writer --senders 50 --messages 40 --windows 0 2 5
+Для локальной проверки без MySQL - файл SQLite:
+    python -m scripts.bench_message_writer --url sqlite:///bench.db
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+from sqlalchemy import BIGINT, create_engine
+from sqlalchemy.ext.compiler import compiles
+
+from app.db import database, models
+from app.core.snowflake import id_to_datetime, snowflake
+from app.services import message_service
+from app.services.message_writer import MessageWriteBuffer
+from app.services.worker_lease import worker_lease
+
+
+def _use_url(url: str):
+    """Переключает приложение на другую БД (как tests/conftest.py)."""
+    if url.startswith("sqlite"):
+        @compiles(BIGINT, "sqlite")
+        def _bigint_as_integer(type_, compiler, **kw):
+            # В SQLite только INTEGER PRIMARY KEY хранит 64-битные id
+            return "INTEGER"
+
+        engine = create_engine(url, connect_args={"check_same_thread": False})
+    else:
+        engine = create_engine(url, pool_size=database.db_executor._max_workers)
+    database.engine = engine
+    database.SessionLocal.configure(bind=engine)
+
+
+def _make_chats(db, senders: int):
+    """Отправитель и его личный чат с получателем - на каждого отправителя."""
+    suffix = uuid.uuid4().hex[:8]
+    pairs = []
+    for i in range(senders):
+        users = [
+            models.User(phone_number=f"bench-{suffix}-{i}-{side}", first_name="Bench", password_hash="-", public_key="-")
+            for side in ("a", "b")
+        ]
+        chat = models.Chat(chat_type=models.ChatTypeEnum.private)
+        db.add_all(users + [chat])
+        db.flush()
+        db.add_all([models.ChatParticipant(chat_id=chat.id, user_id=u.id) for u in users])
+        pairs.append((users[0].id, chat.id))
+    db.commit()
+    return pairs
+
+
+def _row(sender_id: int, chat_id: int) -> dict:
+    """Значения строки как в message_service.prepare_message, без проверок прав."""
+    message_id = snowflake.next_id()
+    return dict(
+        id=message_id, chat_id=chat_id, sender_id=sender_id, content=b"bench",
+        message_type=models.MessageTypeEnum.text,
+        sent_at=id_to_datetime(message_id).replace(microsecond=0),
+        status=models.MessageStatusEnum.sent, is_pinned=False
+    )
+
+
+async def _run(pairs, messages: int, window_ms: float, max_batch: int):
+    writer = MessageWriteBuffer(window_ms=window_ms, max_batch=max_batch)
+    writer.start()
+    latencies = []
+
+    async def sender(sender_id: int, chat_id: int):
+        for _ in range(messages):
+            row = _row(sender_id, chat_id)
+            started = time.perf_counter()
+            if writer.enabled:
+                await writer.write(row)
+            else:
+                await database.run_in_session(message_service.insert_messages, [row])
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(sender_id, chat_id) for sender_id, chat_id in pairs))
+    elapsed = time.perf_counter() - started
+    await writer.stop()
+
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    mode = f"окно {window_ms:g} мс" if window_ms > 0 else "без буфера"
+    batches = f", пачек {writer.stats['batches']}" if window_ms > 0 else ""
+    print(
+        f"{mode:>14}: {len(latencies) / elapsed:8.0f} сообщ/с, "
+        f"p50 {statistics.median(latencies) * 1000:6.1f} мс, p99 {p99 * 1000:6.1f} мс{batches}"
+    )
+
+
+async def main(args):
+    if args.url:
+        _use_url(args.url)
+    database.create_all_tables()
+    await worker_lease.start()
+    try:
+        with database.session_scope() as db:
+            pairs = _make_chats(db, args.senders)
+        for window_ms in args.windows:
+            await _run(pairs, args.messages, window_ms, args.max_batch)
+    finally:
+        await worker_lease.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="URL БД вместо DATABASE_URL из .env")
+    parser.add_argument("--senders", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=40, help="сообщений на отправителя")
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 2, 5], help="окна в мс (0 - без буфера)")
+    parser.add_argument("--max-batch", type=int, default=100)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,99 @@
+"""
+Общая настройка тестов: приложение поднимается на SQLite в памяти,
+пуши идут через fake-транспорт, файлы (фильтр Блума, uploads) - во
+временном каталоге. Переменные окружения задаются до импорта app.
+
+Запуск: pytest tests/ -v
+"""
+import itertools
+import os
+import sys
+import tempfile
+
+os.environ.update(
+    DB_USER="test", DB_PASSWORD="test", DB_HOST="localhost", DB_NAME="test",
+    SECRET_KEY="test-secret-key-" + "x" * 32,
+    PUSH_TRANSPORT="fake", EVENT_BUS_URL="memory://", WORKER_ID="1",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="dialect-tests-"))
+
+import pytest
+from sqlalchemy import BIGINT, create_engine, event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.pool import StaticPool
+
+
+@compiles(BIGINT, "sqlite")
+def _bigint_as_integer(type_, compiler, **kw):
+    # В SQLite только INTEGER PRIMARY KEY хранит 64-битные id
+    return "INTEGER"
+
+
+from app.db import database  # noqa: E402
+
+engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+database.engine = engine
+database.SessionLocal.configure(bind=engine)
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app import main  # noqa: E402
+from app.core.security import create_access_token  # noqa: E402
+
+_phones = itertools.count(1)
+
+
+class QueryCounter:
+    """Считает SQL-запросы к тестовой БД внутри блока with."""
+
+    def __init__(self):
+        self.statements = []
+
+    def _on_execute(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(engine, "before_cursor_execute", self._on_execute)
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+
+@pytest.fixture
+def client():
+    """Приложение с выполненным lifespan. БД общая на сессию тестов, данные - уникальные."""
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def register(client):
+    """register(username, first_name) -> (user_id, заголовки, токен)."""
+
+    def _register(username: str, first_name: str = "Test"):
+        number = next(_phones)
+        response = client.post("/api/v1/auth/register", json={
+            "phone_number": f"+7900{number:07d}",
+            "username": f"{username}{number}",
+            "first_name": first_name,
+            "password": "password",
+            "public_key": "key",
+        })
+        assert response.status_code == 200, response.text
+        user_id = response.json()["id"]
+        token = create_access_token(user_id)
+        return user_id, {"Authorization": f"Bearer {token}"}, token
+
+    return _register
+
+
+@pytest.fixture
+def query_counter():
+    return QueryCounter()
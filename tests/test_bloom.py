@@ -0,0 +1,77 @@
+import logging
+import multiprocessing
+
+from app.core import bloom_filter as bf
+from app.core.counting_bloom import ScalableCountingBloomFilter
+from app.db import database, models
+
+
+def _service(tmp_path, monkeypatch):
+    monkeypatch.setattr(bf, "EXPECTED_USERNAMES", 1000)
+    return bf.BloomFilterService(str(tmp_path / "names.bloom"))
+
+
+def test_sync_rebuilds_when_usernames_disappear_below_the_mark(client, register, tmp_path, monkeypatch, caplog):
+    user_id, _, _ = register("gone")
+    register("stays")
+    service = _service(tmp_path, monkeypatch)
+    with database.session_scope() as db:
+        service.sync_from_db(db)
+        total = db.query(models.User).filter(models.User.username.isnot(None)).count()
+        assert service._meta["usernames"] == total
+
+        # Максимальный id не изменился, а одного юзернейма больше нет
+        db.query(models.User).filter(models.User.id == user_id).update({"username": None})
+        db.commit()
+        caplog.set_level(logging.INFO)
+        service.sync_from_db(db)
+
+    assert "полная синхронизация" in caplog.text
+    assert service._meta["usernames"] == total - 1
+
+
+def test_live_registrations_are_not_added_again_on_restart(client, register, tmp_path, monkeypatch, caplog):
+    register("before")
+    service = _service(tmp_path, monkeypatch)
+    with database.session_scope() as db:
+        service.sync_from_db(db)
+        user_id, _, _ = register("live")
+        service.add("live", user_id=user_id)  # как auth_service после commit
+
+        # Перезапуск: отметка уже учитывает "live", дочитывать нечего
+        caplog.set_level(logging.INFO)
+        restarted = bf.BloomFilterService(service.filepath)
+        restarted.sync_from_db(db)
+        total = db.query(models.User).filter(models.User.username.isnot(None)).count()
+
+    assert "дочитываем" not in caplog.text and "полная синхронизация" not in caplog.text
+    assert restarted._meta == {"max_user_id": user_id, "usernames": total}
+    assert restarted.stats()["usernames"] == total
+
+
+def _add_in_child(filepath, usernames, results):
+    service = bf.BloomFilterService(filepath)
+    service.add_many(usernames)
+    results.put((service.shared, service.contains(usernames[0])))
+
+
+def test_usernames_added_by_another_worker_are_visible(tmp_path, monkeypatch):
+    service = _service(tmp_path, monkeypatch)
+    with service._writing():
+        service._replace_file(ScalableCountingBloomFilter(1000, 0.01))
+    assert service.shared
+
+    # Воркеры - отдельные процессы с одним mmap-файлом; 3000 имен растят новый уровень
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    usernames = [f"worker{i}" for i in range(3000)]
+    child = context.Process(target=_add_in_child, args=(service.filepath, usernames, results))
+    child.start()
+    child.join(timeout=60)
+    assert child.exitcode == 0
+    assert results.get(timeout=5) == (True, True)
+
+    assert service.contains("worker0") and service.contains("worker2999")
+    assert all(service.contains_many(usernames))
+    assert service.stats()["usernames"] == 3000
+    assert service.stats()["tiers"] > 1
@@ -0,0 +1,117 @@
+import asyncio
+
+from fastapi import HTTPException
+
+from app.db import database, schemas
+from app.services import message_service
+from app.services.chat_cache import ChatCache, chat_cache
+from app.services.event_bus import InMemoryEventBus
+
+
+def _send(sender_id, chat_id):
+    with database.session_scope() as db:
+        return message_service.create_message(db, sender_id, schemas.MessageCreate(chat_id=chat_id, content=b"x")).id
+
+
+def _open_chats(client, register, headers, count):
+    chat_ids = []
+    for _ in range(count):
+        other_id, _, _ = register("peer")
+        response = client.post("/api/v1/chats/private", json={"target_user_id": other_id}, headers=headers)
+        chat_ids.append((response.json()["id"], other_id))
+    return chat_ids
+
+
+def test_chat_list_query_count_does_not_grow(client, register, query_counter):
+    _, headers, _ = register("lister")
+
+    counts = []
+    for extra_chats in (2, 8):
+        for chat_id, other_id in _open_chats(client, register, headers, extra_chats):
+            _send(other_id, chat_id)
+        with query_counter:
+            response = client.get("/api/v1/chats/", headers=headers)
+        assert response.status_code == 200
+        counts.append(query_counter.count)
+    # 2 -> 10 чатов: запросов столько же
+    assert counts[0] == counts[1]
+
+
+def test_chat_list_status_comes_from_watermarks(client, register):
+    sender_id, headers, _ = register("status")
+    reader_id, reader_headers, _ = register("status")
+    chat_id = client.post("/api/v1/chats/private", json={"target_user_id": reader_id}, headers=headers).json()["id"]
+    message_id = _send(sender_id, chat_id)
+
+    def last_status():
+        chats = client.get("/api/v1/chats/", headers=headers).json()
+        return next(c for c in chats if c["id"] == chat_id)["last_message"]["status"]
+
+    assert last_status() == "sent"
+    with database.session_scope() as db:
+        message_service.mark_messages_as_read(db, chat_id, reader_id, message_id)
+    assert last_status() == "read"
+
+
+def test_chat_list_marks_blocked_peers(client, register):
+    _, headers, _ = register("blocker")
+    (blocked_chat, blocked_id), (other_chat, _) = _open_chats(client, register, headers, 2)
+    client.post(f"/api/v1/users/block/{blocked_id}", headers=headers)
+
+    chats = {c["id"]: c for c in client.get("/api/v1/chats/", headers=headers).json()}
+    assert chats[blocked_chat]["is_blocked"] and not chats[other_chat]["is_blocked"]
+
+
+def _is_member(chat_id, user_id):
+    with database.session_scope() as db:
+        try:
+            message_service.ensure_participant(db, chat_id, user_id)
+        except HTTPException:
+            return False
+        return True
+
+
+def test_membership_changes_invalidate_the_chat_cache(client, register):
+    owner_id, headers, _ = register("owner")
+    member_id, _, _ = register("member")
+    newcomer_id, _, _ = register("newcomer")
+    chat_id = client.post(
+        "/api/v1/chats/group", json={"chat_name": "g", "participant_ids": [member_id]}, headers=headers
+    ).json()["id"]
+
+    # Состав в кэше; без сброса изменения ниже остались бы невидимы
+    assert _is_member(chat_id, member_id) and not _is_member(chat_id, newcomer_id)
+    hits = chat_cache.stats()["hits"]
+    assert _is_member(chat_id, member_id) and chat_cache.stats()["hits"] == hits + 1
+
+    client.post(f"/api/v1/chats/{chat_id}/users", params={"user_id": newcomer_id}, headers=headers)
+    assert _is_member(chat_id, newcomer_id)
+    client.delete(f"/api/v1/chats/{chat_id}/users/{member_id}", headers=headers)
+    assert not _is_member(chat_id, member_id)
+    client.delete(f"/api/v1/chats/{chat_id}", headers=headers)  # владелец вышел
+    assert not _is_member(chat_id, owner_id)
+
+
+def test_chat_cache_invalidation_reaches_other_workers(client, register):
+    _, headers, _ = register("local")
+    peer_id, _, _ = register("remote")
+    chat_id = client.post("/api/v1/chats/private", json={"target_user_id": peer_id}, headers=headers).json()["id"]
+
+    async def scenario():
+        bus = InMemoryEventBus()
+        local, remote = ChatCache(capacity=10), ChatCache(capacity=10)
+        await local.start(bus)
+        await remote.start(bus)
+        with database.session_scope() as db:
+            remote.get(db, chat_id)
+        assert remote.stats()["size"] == 1
+
+        # Сброс после commit идет из пула потоков БД
+        await asyncio.get_running_loop().run_in_executor(None, local.invalidate, chat_id)
+        for _ in range(100):
+            if remote.stats()["size"] == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert remote.stats()["size"] == 0 and remote.stats()["invalidations"] == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,93 @@
+import asyncio
+
+from sqlalchemy import event
+
+from app.services import connection_manager as cm
+from tests.conftest import engine
+
+
+class _CheckoutTracker:
+    """Сколько соединений пула сейчас выдано и максимум за время замера."""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+
+    def checkout(self, *args):
+        self.current += 1
+        self.peak = max(self.peak, self.current)
+
+    def checkin(self, *args):
+        self.current -= 1
+
+
+def test_idle_sockets_hold_no_db_connections(client, register):
+    """Открытые, но молчащие сокеты не держат соединений с БД, и HTTP продолжает работать."""
+    sockets = 50  # больше, чем пул по умолчанию (5 + 10)
+    users = [register("idle") for _ in range(sockets)]
+
+    tracker = _CheckoutTracker()
+    event.listen(engine, "checkout", tracker.checkout)
+    event.listen(engine, "checkin", tracker.checkin)
+    try:
+        opened = [client.websocket_connect(f"/api/v1/messages/ws?token={token}") for _, _, token in users]
+        for ws in opened:
+            ws.__enter__()
+        assert len(cm.manager.active_connections) >= sockets
+        assert tracker.current == 0
+
+        _, headers, _ = users[0]
+        response = client.get("/api/v1/users/me", headers=headers)
+        assert response.status_code == 200
+        assert tracker.current == 0  # HTTP-сессия вернула соединение
+        # Пока сокеты открыты, соединение бралось только под HTTP-запрос
+        assert tracker.peak <= 1
+
+        for ws in opened:
+            ws.__exit__(None, None, None)
+    finally:
+        event.remove(engine, "checkout", tracker.checkout)
+        event.remove(engine, "checkin", tracker.checkin)
+
+
+class _StuckWebSocket:
+    """Клиент, который никогда не дочитывает: send_json висит."""
+
+    def __init__(self):
+        self.closed_with = None
+        self._never = asyncio.Event()
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, message):
+        await self._never.wait()
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+def test_slow_client_is_dropped_without_blocking_others():
+    async def scenario():
+        manager = cm.ConnectionManager()
+        slow, fast = _StuckWebSocket(), _StuckWebSocket()
+        slow_connection = await manager.connect(slow, user_id=1)
+        await manager.connect(fast, user_id=2)
+
+        # Писатель забирает первое сообщение и виснет; остальные копятся в очереди
+        for i in range(cm.SEND_QUEUE_SIZE + 2):
+            delivered = await manager.broadcast({"n": i}, [1])
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+        assert slow_connection.closed
+        assert slow.closed_with == 1013
+        assert 1 not in manager.active_connections
+        assert manager.dropped_messages == 1
+        assert delivered == set()
+        # Второй пользователь не пострадал
+        assert await manager.broadcast({"n": "ok"}, [2]) == {2}
+        for connection in list(manager.active_connections[2]):
+            manager.disconnect(connection)
+
+    asyncio.run(scenario())
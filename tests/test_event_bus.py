@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+from app.services import connection_manager as cm
+from app.services.event_bus import EventBus, RedisEventBus
+
+
+class _FakeRedis:
+    """Минимальный сервер RESP: PUBLISH и SUBSCRIBE, по флагу - отказ на PUBLISH."""
+
+    def __init__(self):
+        self.subscribers = {}
+        self.fail_publish = False
+        self.server = None
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self._client, "127.0.0.1", 0)
+        return f"redis://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @staticmethod
+    def _bulk(value: bytes) -> bytes:
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    async def _read_command(self, reader):
+        header = await reader.readline()
+        if not header:
+            return None
+        args = []
+        for _ in range(int(header[1:])):
+            length = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    async def _client(self, reader, writer):
+        try:
+            while (command := await self._read_command(reader)) is not None:
+                name = command[0].upper()
+                if name == b"SUBSCRIBE":
+                    for channel in command[1:]:
+                        self.subscribers.setdefault(channel, set()).add(writer)
+                        writer.write(b"*3\r\n" + self._bulk(b"subscribe") + self._bulk(channel) + b":1\r\n")
+                elif name == b"PUBLISH" and self.fail_publish:
+                    writer.write(b"-ERR OOM command not allowed\r\n")
+                elif name == b"PUBLISH":
+                    channel, payload = command[1], command[2]
+                    receivers = self.subscribers.get(channel, set())
+                    for subscriber in receivers:
+                        subscriber.write(b"*3\r\n" + self._bulk(b"message") + self._bulk(channel) + self._bulk(payload))
+                    writer.write(b":%d\r\n" % len(receivers))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for receivers in self.subscribers.values():
+                receivers.discard(writer)
+            writer.close()
+
+
+async def _wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "событие не пришло"
+        await asyncio.sleep(0.01)
+
+
+def test_redis_bus_pub_sub_and_late_subscribe():
+    async def scenario():
+        server = _FakeRedis()
+        url = await server.start()
+        publisher, subscriber = RedisEventBus(url), RedisEventBus(url)
+        received = []
+
+        async def on_event(message):
+            received.append(message)
+
+        await subscriber.subscribe("early", on_event)
+        await subscriber.start()
+        await _wait_for(lambda: b"early" in server.subscribers)
+        assert await publisher.publish("early", {"n": 1}) is True
+
+        # Подписка после подключения уходит в уже открытое соединение
+        await subscriber.subscribe("late", on_event)
+        await _wait_for(lambda: b"late" in server.subscribers)
+        assert await publisher.publish("late", {"n": 2}) is True
+        await _wait_for(lambda: len(received) == 2)
+        assert received == [{"n": 1}, {"n": 2}]
+
+        # Отказ сервера и недоступный сервер - False, а не исключение
+        server.fail_publish = True
+        assert await publisher.publish("early", {"n": 3}) is False
+        await publisher.stop()
+        await subscriber.stop()
+        await server.stop()
+        assert await RedisEventBus(url).publish("early", {"n": 4}) is False
+
+    asyncio.run(scenario())
+
+
+class _FailingBus(EventBus):
+    async def publish(self, channel, message):
+        return False
+
+    async def subscribe(self, channel, handler):
+        pass
+
+
+def test_broadcast_does_not_count_failed_publish_as_delivered():
+    async def scenario():
+        manager = cm.ConnectionManager()
+        manager.bus = _FailingBus()
+        manager.remote_presence["other-worker"] = (time.monotonic(), {42})
+        assert await manager.broadcast({"n": 1}, [42]) == set()
+
+    asyncio.run(scenario())
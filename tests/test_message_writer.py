@@ -0,0 +1,78 @@
+import asyncio
+
+from sqlalchemy.exc import IntegrityError
+
+from app.db import database, models, schemas
+from app.services import message_service
+from app.services.message_writer import MessageWriteBuffer
+
+
+def _rows(client, register, count):
+    sender_id, headers, _ = register("writer")
+    peer_id, _, _ = register("writer")
+    chat_id = client.post("/api/v1/chats/private", json={"target_user_id": peer_id}, headers=headers).json()["id"]
+    with database.session_scope() as db:
+        return [
+            message_service.prepare_message(db, sender_id, schemas.MessageCreate(chat_id=chat_id, content=b"%d" % i))
+            for i in range(count)
+        ]
+
+
+def _stored(rows):
+    with database.session_scope() as db:
+        return db.query(models.Message).filter(models.Message.id.in_([r["id"] for r in rows])).count()
+
+
+def _write_all(writer, rows):
+    async def scenario():
+        writer.start()
+        results = await asyncio.gather(*(writer.write(row) for row in rows), return_exceptions=True)
+        await writer.stop()
+        return results
+
+    return asyncio.run(scenario())
+
+
+def test_writer_commits_concurrent_messages_as_one_batch(client, register):
+    rows = _rows(client, register, 20)
+    writer = MessageWriteBuffer(window_ms=50, max_batch=100)
+
+    assert _write_all(writer, rows) == [None] * 20
+    assert writer.stats == {"batches": 1, "messages": 20, "max_batch": 20, "fallbacks": 0, "failed": 0}
+    assert _stored(rows) == 20
+
+
+def test_writer_splits_batches_by_max_size(client, register):
+    rows = _rows(client, register, 7)
+    writer = MessageWriteBuffer(window_ms=1000, max_batch=3)
+
+    assert _write_all(writer, rows) == [None] * 7
+    assert writer.stats["batches"] == 3 and writer.stats["max_batch"] == 3
+    assert _stored(rows) == 7
+
+
+def test_failed_batch_is_retried_row_by_row(client, register):
+    rows = _rows(client, register, 5)
+    with database.session_scope() as db:
+        message_service.insert_messages(db, [rows[2]])  # дубль id: пачка целиком не запишется
+
+    writer = MessageWriteBuffer(window_ms=50, max_batch=100)
+    results = _write_all(writer, rows)
+
+    # Ошибка достается только дублю, соседи записаны
+    assert isinstance(results[2], IntegrityError)
+    assert [r for i, r in enumerate(results) if i != 2] == [None] * 4
+    assert writer.stats["fallbacks"] == 1 and writer.stats["failed"] == 1
+    assert writer.stats["batches"] == 0 and writer.stats["messages"] == 4
+    assert _stored(rows) == 5
+
+
+def test_disabled_writer_does_not_start():
+    writer = MessageWriteBuffer(window_ms=0, max_batch=100)
+
+    async def scenario():
+        writer.start()
+        assert not writer.enabled
+        await writer.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,94 @@
+import time
+from datetime import datetime
+
+from app.db import database, models, schemas
+from app.services import message_service
+
+
+def _private_chat(client, headers, target_id) -> int:
+    response = client.post("/api/v1/chats/private", json={"target_user_id": target_id}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()["id"]
+
+
+def test_history_rejects_both_cursors(client, register):
+    _, headers, _ = register("hist")
+    other_id, _, _ = register("hist")
+    chat_id = _private_chat(client, headers, other_id)
+
+    url = f"/api/v1/messages/history/{chat_id}"
+    assert client.get(url, params={"before_id": 10, "after_id": 5}, headers=headers).status_code == 400
+    assert client.get(url, params={"before_id": 10}, headers=headers).status_code == 200
+
+
+def test_delete_before_clear_keeps_unread_count(client, register):
+    sender_id, headers, _ = register("deleter")
+    reader_id, _, _ = register("reader")
+    chat_id = _private_chat(client, headers, reader_id)
+
+    with database.session_scope() as db:
+        old, new = (
+            message_service.create_message(db, sender_id, schemas.MessageCreate(chat_id=chat_id, content=b"x"))
+            for _ in range(2)
+        )
+        # old отправлено до очистки истории у читателя, new - после
+        db.query(models.Message).filter(models.Message.id == old.id).update({"sent_at": datetime(2020, 1, 1)})
+        part = db.query(models.ChatParticipant).filter_by(chat_id=chat_id, user_id=reader_id).one()
+        part.last_cleared_at = datetime(2021, 1, 1)
+        part.unread_count = 1
+        db.commit()
+
+        def unread():
+            db.expire_all()
+            return db.query(models.ChatParticipant.unread_count).filter_by(chat_id=chat_id, user_id=reader_id).scalar()
+
+        assert message_service.delete_message(db, old.id, sender_id)
+        assert unread() == 1
+        assert message_service.delete_message(db, new.id, sender_id)
+        assert unread() == 0
+
+
+def test_read_from_the_future_does_not_mark_new_messages(client, register, monkeypatch):
+    monkeypatch.setattr(message_service, "READ_ID_CLOCK_SKEW", 0)
+    sender_id, headers, _ = register("future")
+    reader_id, _, _ = register("future")
+    chat_id = _private_chat(client, headers, reader_id)
+
+    with database.session_scope() as db:
+        first = message_service.create_message(db, sender_id, schemas.MessageCreate(chat_id=chat_id, content=b"x"))
+        message_service.mark_messages_as_read(db, chat_id, reader_id, 2 ** 62)
+        mark = db.query(models.ChatParticipant.last_read_message_id).filter_by(
+            chat_id=chat_id, user_id=reader_id).scalar()
+        assert first.id <= mark <= message_service.read_id_ceiling()
+
+    time.sleep(0.01)
+    with database.session_scope() as db:
+        second = message_service.create_message(db, sender_id, schemas.MessageCreate(chat_id=chat_id, content=b"y"))
+    history = client.get(f"/api/v1/messages/history/{chat_id}", headers=headers).json()
+    assert [(m["id"], m["status"]) for m in history] == [(second.id, "sent"), (first.id, "read")]
+
+
+def test_read_before_commit_does_not_leave_unread(client, register):
+    sender_id, headers, _ = register("early")
+    reader_id, _, _ = register("early")
+    chat_id = _private_chat(client, headers, reader_id)
+
+    def unread(db):
+        db.expire_all()
+        return db.query(models.ChatParticipant.unread_count).filter_by(chat_id=chat_id, user_id=reader_id).scalar()
+
+    with database.session_scope() as db:
+        # Получатель увидел сообщение в сокете и прочитал его до INSERT
+        row = message_service.prepare_message(db, sender_id, schemas.MessageCreate(chat_id=chat_id, content=b"x"))
+        message_service.mark_messages_as_read(db, chat_id, reader_id, row["id"])
+        message_service.insert_messages(db, [row])
+        assert unread(db) == 0
+
+        # Пачка: прочитано до середины - в счетчике только последнее
+        rows = [
+            message_service.prepare_message(db, sender_id, schemas.MessageCreate(chat_id=chat_id, content=b"y"))
+            for _ in range(3)
+        ]
+        message_service.mark_messages_as_read(db, chat_id, reader_id, rows[1]["id"])
+        message_service.insert_messages(db, rows)
+        assert unread(db) == 1
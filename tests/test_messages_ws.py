@@ -0,0 +1,9 @@
+def test_malformed_ack_returns_error_and_keeps_socket(client, register):
+    _, _, token = register("acker")
+    with client.websocket_connect(f"/api/v1/messages/ws?token={token}") as ws:
+        ws.send_json({"type": "ack", "message_id": "not-a-number"})
+        assert ws.receive_json() == {"error": "Ack error: 'message_id' must be an integer"}
+
+        # Сокет жив: следующий запрос обрабатывается
+        ws.send_json({"type": "ack", "message_id": {"nested": 1}})
+        assert "error" in ws.receive_json()
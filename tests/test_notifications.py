@@ -0,0 +1,47 @@
+import asyncio
+
+from app.services.notification_service import PushCoalescer
+
+
+class _RecordingDispatcher:
+    def __init__(self):
+        self.sent = []
+
+    def enqueue(self, user_ids, title, body, data=None, collapse_key=None):
+        self.sent.append((list(user_ids), title, body, collapse_key))
+        return True
+
+
+def test_coalescer_stop_flushes_pending_bursts():
+    async def scenario():
+        dispatcher = _RecordingDispatcher()
+        coalescer = PushCoalescer(dispatcher)
+        for text in ("one", "two", "three"):
+            coalescer.notify([7], 1, "Alice", text)
+        assert len(dispatcher.sent) == 1  # первое сообщение ушло сразу, остальные ждут окна
+
+        coalescer.stop()
+        assert coalescer.bursts == {}
+        assert len(dispatcher.sent) == 2
+        user_ids, title, body, collapse_key = dispatcher.sent[1]
+        assert user_ids == [7] and title == "Alice" and collapse_key == "chat_1"
+        assert body.startswith("3 ")
+
+    asyncio.run(scenario())
+
+
+def test_burst_summary_credits_the_first_sender():
+    async def scenario():
+        dispatcher = _RecordingDispatcher()
+        coalescer = PushCoalescer(dispatcher)
+        coalescer.notify([7], 1, "Alice", "hi")
+        coalescer.notify([7], 1, "Bob", "hey")
+        coalescer.stop()
+        assert "от" not in dispatcher.sent[1][2]  # двое отправителей - без "от X"
+
+        coalescer.notify([8], 2, "Alice", "one")
+        coalescer.notify([8], 2, "Alice", "two")
+        coalescer.stop()
+        assert dispatcher.sent[-1][2].endswith("от Alice")
+
+    asyncio.run(scenario())
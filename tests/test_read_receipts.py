@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+from app.db import database, models, schemas
+from app.services import message_service, read_receipts
+from app.services.read_receipts import ReadDebouncer, read_debouncer
+
+
+def _chat_with_messages(client, register, count):
+    sender_id, headers, _ = register("sender")
+    reader_id, _, reader_token = register("reader")
+    chat_id = client.post("/api/v1/chats/private", json={"target_user_id": reader_id}, headers=headers).json()["id"]
+    with database.session_scope() as db:
+        ids = [
+            message_service.create_message(db, sender_id, schemas.MessageCreate(chat_id=chat_id, content=b"x")).id
+            for _ in range(count)
+        ]
+    return chat_id, reader_id, reader_token, ids
+
+
+def _watermark(chat_id, user_id):
+    with database.session_scope() as db:
+        return db.query(models.ChatParticipant.last_read_message_id).filter_by(
+            chat_id=chat_id, user_id=user_id
+        ).scalar()
+
+
+def _record_broadcasts(monkeypatch):
+    sent = []
+
+    async def broadcast(message, user_ids):
+        sent.append((message, list(user_ids)))
+        return set(user_ids)
+
+    monkeypatch.setattr(read_receipts.manager, "broadcast", broadcast)
+    return sent
+
+
+def test_submit_clamps_ids_from_the_future():
+    async def scenario():
+        debouncer = ReadDebouncer(window=60)
+        debouncer.submit(1, 10, 2 ** 62)
+        pending = debouncer._pending[(1, 10)]
+        assert pending <= read_receipts.message_service.read_id_ceiling()
+        for timer in debouncer._timers.values():
+            timer.cancel()
+
+    asyncio.run(scenario())
+
+
+def test_reads_within_window_are_coalesced(client, register, monkeypatch):
+    chat_id, reader_id, _, ids = _chat_with_messages(client, register, 3)
+    sent = _record_broadcasts(monkeypatch)
+
+    async def scenario():
+        debouncer = ReadDebouncer(window=0.05)
+        # Прокрутка с событиями не по порядку: в итоге пишется максимум
+        for message_id in (ids[0], ids[2], ids[1]):
+            debouncer.submit(reader_id, chat_id, message_id)
+        await asyncio.sleep(0.2)
+        return debouncer
+
+    debouncer = asyncio.run(scenario())
+    assert debouncer.stats == {"received": 3, "flushed": 1, "errors": 0}
+    assert _watermark(chat_id, reader_id) == ids[2]
+    assert [message["last_read_id"] for message, _ in sent] == [ids[2]]
+
+
+def test_flush_user_saves_pending_reads_immediately(client, register, monkeypatch):
+    chat_id, reader_id, _, ids = _chat_with_messages(client, register, 2)
+    other_chat, other_reader, _, other_ids = _chat_with_messages(client, register, 1)
+    _record_broadcasts(monkeypatch)
+
+    async def scenario():
+        debouncer = ReadDebouncer(window=60)
+        debouncer.submit(reader_id, chat_id, ids[1])
+        debouncer.submit(other_reader, other_chat, other_ids[0])
+        await debouncer.flush_user(reader_id)
+        # Чужие прочтения ждут своего таймера
+        assert list(debouncer._pending) == [(other_reader, other_chat)]
+        assert list(debouncer._timers) == [(other_reader, other_chat)]
+        await debouncer.stop()
+
+    asyncio.run(scenario())
+    assert _watermark(chat_id, reader_id) == ids[1]
+    assert _watermark(other_chat, other_reader) == other_ids[0]
+
+
+def test_disconnect_flushes_reads_before_the_window(client, register, monkeypatch):
+    chat_id, reader_id, token, ids = _chat_with_messages(client, register, 1)
+    monkeypatch.setattr(read_debouncer, "window", 60)
+
+    with client.websocket_connect(f"/api/v1/messages/ws?token={token}") as ws:
+        ws.send_json({"type": "read", "chat_id": chat_id, "message_id": ids[0]})
+
+    deadline = time.monotonic() + 5
+    while _watermark(chat_id, reader_id) != ids[0]:
+        assert time.monotonic() < deadline, "прочтение не сохранено при отключении"
+        time.sleep(0.02)
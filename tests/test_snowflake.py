@@ -0,0 +1,93 @@
+import socket
+import subprocess
+import sys
+import threading
+from datetime import datetime
+
+import pytest
+
+from app.core.snowflake import TIMESTAMP_SHIFT, WORKER_SHIFT, SnowflakeGenerator
+from app.db import database, models
+from app.services.worker_lease import WorkerLease
+
+
+def test_ids_stay_monotonic_when_observing_other_workers():
+    local, remote = SnowflakeGenerator(1), SnowflakeGenerator(2)
+    seen = [local.next_id()]
+    for step in range(2000):
+        if step % 3 == 0:
+            # Чужой id "из будущего" (часы соседа спешат) и из прошлого
+            ahead = remote.next_id() + ((step % 7) << TIMESTAMP_SHIFT)
+            local.observe(ahead)
+            local.observe(ahead >> TIMESTAMP_SHIFT << TIMESTAMP_SHIFT)
+            seen.append(ahead)
+        own = local.next_id()
+        assert own > max(seen)
+        assert (own >> WORKER_SHIFT) & 0x3FF == 1
+        seen.append(own)
+
+
+def test_ids_are_unique_across_threads():
+    generator = SnowflakeGenerator(3)
+    ids, lock = [], threading.Lock()
+
+    def produce():
+        batch = [generator.next_id() for _ in range(5000)]
+        with lock:
+            ids.extend(batch)
+
+    threads = [threading.Thread(target=produce) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(ids)) == len(ids) == 20000
+
+
+def test_generator_without_worker_id_refuses_to_issue_ids():
+    with pytest.raises(RuntimeError):
+        SnowflakeGenerator().next_id()
+
+
+def test_worker_ids_are_leased_uniquely(client):
+    first, second = WorkerLease(SnowflakeGenerator()), WorkerLease(SnowflakeGenerator())
+    second.owner = "other-host:1:00000000"  # процесс на другом хосте
+    with database.session_scope() as db:
+        taken = first.acquire(db)
+        assert first.generator.worker_id == taken
+
+        # Тот же WORKER_ID вторым процессом - ошибка старта, без него - другой номер
+        with pytest.raises(RuntimeError):
+            second.acquire(db, requested=taken)
+        assert second.acquire(db) != taken
+
+        # Просроченную аренду можно забрать, после этого первый ее не продлит
+        db.query(models.WorkerLease).filter_by(worker_id=taken).update({"expires_at": datetime(2020, 1, 1)})
+        db.commit()
+        third = WorkerLease(SnowflakeGenerator())
+        third.owner = "third-host:1:00000000"
+        assert third.acquire(db, requested=taken) == taken
+        assert not first.renew(db)
+
+        for lease in (second, third):
+            lease.release(db)
+        assert db.query(models.WorkerLease).filter_by(owner=third.owner).count() == 0
+
+
+def test_lease_of_crashed_local_process_is_taken_over(client):
+    crashed = subprocess.Popen([sys.executable, "-c", "pass"])
+    crashed.wait()
+    lease = WorkerLease(SnowflakeGenerator())
+    with database.session_scope() as db:
+        for worker_id, owner in ((5, f"{socket.gethostname()[:40]}:{crashed.pid}:deadbeef"),
+                                 (6, "other-host:1:deadbeef")):
+            db.add(models.WorkerLease(worker_id=worker_id, owner=owner, expires_at=datetime(2100, 1, 1)))
+        db.commit()
+
+        # Тот же хост, процесса нет - аренда наша сразу; чужой хост - ждем срока
+        assert lease.acquire(db, requested=5) == 5
+        with pytest.raises(RuntimeError):
+            WorkerLease(SnowflakeGenerator()).acquire(db, requested=6)
+        lease.release(db)
+        db.query(models.WorkerLease).delete()
+        db.commit()
@@ -0,0 +1,7 @@
+def test_metrics_require_auth(client, register):
+    assert client.get("/api/v1/system/metrics").status_code == 401
+
+    _, headers, _ = register("metrics")
+    response = client.get("/api/v1/system/metrics", headers=headers)
+    assert response.status_code == 200
+    assert "event_loop" in response.json()
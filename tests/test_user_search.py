@@ -0,0 +1,81 @@
+import random
+
+import numpy as np
+import pytest
+
+from app.db import database, models
+from app.services import user_search as us
+
+
+def _brute_force(users, query, limit):
+    ranked = []
+    for user_id, fields in users.items():
+        rank = us._rank(fields, query)
+        if rank is not None:
+            ranked.append((rank, len(fields[0]), user_id))
+    return [user_id for _, _, user_id in sorted(ranked)[:limit]]
+
+
+@pytest.mark.parametrize("with_numpy", [True, False])
+def test_search_matches_brute_force(monkeypatch, with_numpy):
+    if not with_numpy:
+        monkeypatch.setattr(us, "np", None)
+    rnd = random.Random(7)
+    names = ["иван", "мария", "ivan", "maria", "анна", "john"]
+    index, users = us.UserSearchIndex(), {}
+
+    # id идут вразнобой, часть пользователей меняет имя: задействованы extra и устаревшие записи
+    ids = list(range(1, 3001))
+    rnd.shuffle(ids)
+    for user_id in ids + ids[:500]:
+        fields = us._normalize(
+            f"{rnd.choice(names)}_{rnd.randint(0, 99)}", rnd.choice(names).title(),
+            rnd.choice(["Иванов", "Smith", None]), f"+79{rnd.randint(0, 10**9):09d}"
+        )
+        index._apply(user_id, fields)
+        users[user_id] = fields
+
+    for query in ["иван", "ivan_1", "мария ив", "anna", "+791", "smith", "nothing", "ан"]:
+        q = query.strip().lower()
+        assert index.search(query, 10) == (_brute_force(users, q, 10) if len(q) >= 3 else [])
+
+
+def test_appending_while_a_search_holds_the_buffer():
+    index = us.UserSearchIndex()
+    index._apply(1, us._normalize("alice", "Alice", None, None))
+    posting = index._postings["ali"]
+    view = np.frombuffer(posting, dtype=np.uintc)  # как во время _intersect_numpy
+
+    index._apply(2, us._normalize("alina", "Alina", None, None))
+    assert list(view) == [1]
+    assert index.search("ali", 10) == [1, 2]
+
+
+def test_exact_username_survives_the_candidate_limit(client, register, monkeypatch):
+    older_id, headers, _ = register("pear")
+    newer_id, _, _ = register("pear")
+    username = f"pear{newer_id}x"
+    with database.session_scope() as db:
+        # Старый пользователь содержит юзернейм нового как подстроку и идет первым по id
+        for user_id, name in ((older_id, f"big{username}"), (newer_id, username)):
+            user = db.get(models.User, user_id)
+            user.username = name
+            db.commit()
+            us.user_search.upsert(user)
+
+    monkeypatch.setattr(us, "SEARCH_CANDIDATE_LIMIT", 1)
+    found = client.get("/api/v1/users/search", params={"q": username}, headers=headers).json()
+    assert [u["id"] for u in found] == [newer_id, older_id]
+
+
+def test_search_hides_users_who_blocked_the_requester(client, register):
+    searcher_id, headers, _ = register("seeker")
+    blocker_id, blocker_headers, _ = register("hider")
+    visible_id, _, _ = register("hider")
+
+    def found_ids():
+        return {u["id"] for u in client.get("/api/v1/users/search", params={"q": "hider"}, headers=headers).json()}
+
+    assert {blocker_id, visible_id} <= found_ids()
+    client.post(f"/api/v1/users/block/{searcher_id}", headers=blocker_headers)
+    assert blocker_id not in found_ids() and visible_id in found_ids()
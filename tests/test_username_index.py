@@ -0,0 +1,39 @@
+import threading
+
+from app.db import database, models
+from app.services import username_index as ui
+
+
+def test_rebuild_streams_in_index_order(client, register, monkeypatch):
+    # В SQLite ORDER BY двоичный: "Zed" раньше "alice", а индексу нужен порядок без учета регистра
+    for name in ("Zed", "alice", "a_b", "a1b", "Bob", "bob"):
+        register(name)
+    monkeypatch.setattr(ui, "REBUILD_BATCH_SIZE", 4)  # несколько порций - проверяем слияние
+
+    index = ui.UsernamePrefixIndex()
+    with database.session_scope() as db:
+        index.rebuild(db)
+        expected = sorted((name for (name,) in db.query(models.User.username) if name), key=ui._sort_key)
+
+    assert list(ui._unpack(index._blob, index._offsets)) == expected
+    assert index.complete("bo", 50) == [name for name in expected if name.lower().startswith("bo")]
+
+
+def test_delta_merge_runs_off_the_calling_thread():
+    index = ui.UsernamePrefixIndex(delta_limit=3)
+    merged_on = []
+    original = index._merge
+
+    def tracking_merge():
+        merged_on.append(threading.current_thread().name)
+        original()
+
+    index._merge = tracking_merge
+    for name in ("carol", "Alice", "bob"):
+        index.add(name, publish=False)
+    index._merge_executor.submit(lambda: None).result()  # дождаться слияния
+
+    assert merged_on and merged_on[0].startswith("username-merge")
+    assert index.stats()["delta"] == 0 and index.stats()["merges"] == 1
+    assert index.complete("", 10) == [] and index.complete("a", 10) == ["Alice"]
+    assert list(ui._unpack(index._blob, index._offsets)) == ["Alice", "bob", "carol"]